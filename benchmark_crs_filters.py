@@ -0,0 +1,104 @@
+"""
+For benchmarking the CRS filter pipeline on a synthetic, CRS-shaped file.
+Compares the old approach (dtype guessing, row-by-row .apply filters) with explicit dtypes, usecols and vectorized
+filters from process_crs_data.
+"""
+import os
+import random
+import tempfile
+import time
+import pandas as pd
+import build_crs_database
+import process_crs_data
+
+NAME_COLUMNS = ['donorname', 'agencyname', 'recipientname', 'regionname', 'incomegroupname', 'flowname',
+                'purposename', 'sectorname', 'channelname']
+
+
+def write_synthetic_psv(path, num_rows):
+    """
+    Writes a processed-style .psv file with the CRS columns, the name columns and the unnecessary columns
+    """
+    rng = random.Random(0)
+    spec_columns = [column_name for column_name, column_type in build_crs_database.CRS_COLUMN_SPEC]
+    columns = spec_columns + NAME_COLUMNS + process_crs_data.UNNECESSARY_COLUMNS
+    countries = list(process_crs_data.DESIRED_COUNTRIES) + ['Country %d' % i for i in range(150)]
+
+    def make_value(column_name, column_type):
+        if column_name == 'Year':
+            return str(rng.randint(1995, 2012))
+        if column_name == 'purposecode':
+            return str(rng.randint(11, 99) * 1000 + rng.randint(0, 999))
+        if column_name == 'channelcode':
+            # sometimes missing, as in the real data
+            return '' if rng.random() < 0.3 else str(rng.randint(10000, 99999))
+        if column_type.startswith('integer'):
+            return str(rng.randint(1, 999))
+        if column_type.startswith('double precision'):
+            return '%.6f' % rng.random()
+        return 'text %d' % rng.randint(0, 5000)
+
+    with open(path, 'w') as psv_file:
+        psv_file.write(process_crs_data.RAW_CRS_DELIMITER.join(columns) + '\n')
+        for i in xrange(num_rows):
+            values = [make_value(column_name, column_type)
+                      for column_name, column_type in build_crs_database.CRS_COLUMN_SPEC]
+            values += [rng.choice(countries) if column == 'recipientname' else 'name %d' % rng.randint(0, 300)
+                       for column in NAME_COLUMNS]
+            values += ['%.3f' % rng.random() for column in process_crs_data.UNNECESSARY_COLUMNS]
+            psv_file.write(process_crs_data.RAW_CRS_DELIMITER.join(values) + '\n')
+
+
+def get_numeric_bytes(dataframe):
+    # pandas 0.12 has no memory_usage(), numeric column sizes are a fair proxy
+    return sum(dataframe[column].values.nbytes for column in dataframe.columns
+               if dataframe[column].dtype != object)
+
+
+def load_old(psv_path):
+    return pd.read_csv(psv_path, delimiter=process_crs_data.RAW_CRS_DELIMITER, low_memory=False)
+
+
+def filter_old(dataframe):
+    def is_desired_purpose_code(purpose_code):
+        return purpose_code / 1000 in process_crs_data.DESIRED_PURPOSE_CODE_PREFIXES
+
+    filtered = dataframe[dataframe.purposecode.apply(is_desired_purpose_code)]
+    filtered = filtered[filtered.Year >= process_crs_data.FIRST_DESIRED_YEAR]
+    return filtered[filtered.recipientname.apply(lambda x: x in process_crs_data.DESIRED_COUNTRIES)]
+
+
+def load_new(psv_path):
+    usecols = process_crs_data.get_useful_columns(process_crs_data.read_psv_header(psv_path))
+    return process_crs_data.read_psv_file(psv_path, usecols=usecols)
+
+
+def filter_new(dataframe):
+    filtered = process_crs_data.apply_purpose_code_filter(dataframe)
+    filtered = process_crs_data.apply_year_filter(filtered)
+    return process_crs_data.apply_country_filter(filtered)
+
+
+def benchmark(num_rows=200000):
+    psv_path = os.path.join(tempfile.mkdtemp(), 'CRS_synthetic.psv')
+    write_synthetic_psv(psv_path, num_rows)
+
+    try:
+        for name, load_function, filter_function in (('old', load_old, filter_old), ('new', load_new, filter_new)):
+            start_time = time.time()
+            dataframe = load_function(psv_path)
+            load_seconds = time.time() - start_time
+
+            start_time = time.time()
+            filtered = filter_function(dataframe)
+            filter_seconds = time.time() - start_time
+
+            print '{name}: load {load:.3f}s ({mb:.1f} MB of numeric columns), filter {filter:.3f}s, ' \
+                  '{rows} rows kept'.format(name=name, load=load_seconds, mb=get_numeric_bytes(dataframe) / 1e6,
+                                            filter=filter_seconds, rows=len(filtered))
+    finally:
+        os.remove(psv_path)
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,77 @@
+"""
+For benchmarking how a page of results gets from the database cursor into the results template.
+Compares the old approach (a DataFrame built from the cursor's rows, as pd.read_sql does, walked with iterrows) with
+the db_layer.ResultRow records, rendering the real query_results.html for each.
+Needs the Django settings to import (e.g. a DATABASE_URL), but not the database itself.
+"""
+import os
+import random
+import time
+import pandas as pd
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crs.settings')
+
+from django.template.loader import render_to_string
+from tj import db_layer
+from tj import paginator
+
+RESULT_FIELDS = db_layer.RESULT_PAGE_FIELDS + db_layer.RESULT_NAME_FIELDS
+
+
+def make_synthetic_pages(num_pages):
+    """
+    Returns lists of ROW_LIMIT tuples, as a cursor would return them for the results page query
+    (with the names already filled in, so that both approaches do the same work)
+    """
+    rng = random.Random(0)
+
+    def make_value(field):
+        if field in ('crs_pk', 'year') or field.endswith('code') or field.endswith('_id'):
+            return rng.randint(1, 99999)
+        if field == 'usd_disbursement_defl':
+            return rng.random()
+        if field == 'longdescription_truncated':
+            return rng.random() < 0.5
+        if field == 'longdescription':
+            return 'text %d ' % rng.randint(0, 5000) * 30
+        return 'text %d' % rng.randint(0, 5000)
+
+    return [[tuple(make_value(field) for field in RESULT_FIELDS) for i in xrange(db_layer.ROW_LIMIT)]
+            for page in xrange(num_pages)]
+
+
+def decode_old(values):
+    data_frame = pd.DataFrame.from_records(values, columns=RESULT_FIELDS)
+    return [row for i, row in data_frame.iterrows()]
+
+
+def decode_new(values):
+    return [db_layer.ResultRow(row_values) for row_values in values]
+
+
+def render_page(rows):
+    page = paginator.get_keyset_page(rows, 0, db_layer.ROW_LIMIT, len(rows))
+    # the inclusion and category menus are only shown to logged in users, there's no user here
+    return render_to_string('tj/query_results.html', {'page': page, 'inclusions': None, 'categories': None})
+
+
+def benchmark(num_pages=500):
+    pages = make_synthetic_pages(num_pages)
+
+    for name, decode_function in (('old', decode_old), ('new', decode_new)):
+        start_time = time.time()
+        decoded_pages = [decode_function(values) for values in pages]
+        decode_seconds = time.time() - start_time
+
+        start_time = time.time()
+        for rows in decoded_pages:
+            render_page(rows)
+        render_seconds = time.time() - start_time
+
+        print '{name}: decode {decode:.2f}ms, render {render:.2f}ms per page of {rows} rows'.format(
+            name=name, decode=decode_seconds * 1000 / num_pages, render=render_seconds * 1000 / num_pages,
+            rows=db_layer.ROW_LIMIT)
+
+
+if __name__ == "__main__":
+    benchmark()
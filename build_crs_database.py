@@ -3,72 +3,152 @@ For building PostgreSQL database tables to house CRS data for the web app.
 """
 
 import psycopg2
+import psycopg2.extras
+import datetime
 import os
+import re
+import time
+from multiprocessing.pool import ThreadPool
 import pandas as pd
 import StringIO
+import crs_store
+from crs_schema import CATEGORY_COLUMN_NAME, CRS_COLUMN_SPEC, INCLUSION_COLUMN_NAME, ROLLUP_CONFLICT_TARGET, \
+    ROLLUP_KEY_COLUMNS, ROLLUP_SUM_COLUMNS
 
 # somewhat different than what is in models.py
 # 'agency' is omitted here as it's more complicated
 CODE_TABLES = ['donor', 'recipient', 'region', 'incomegroup', 'flow', 'purpose', 'sector', 'channel']
+# the tables whose planner statistics are refreshed after a build
+ANALYZED_TABLES = CODE_TABLES + ['agency', 'tj_inclusion', 'tj_category', 'crs', 'crs_rollup']
+
+# rows per CSV chunk fed to COPY when loading the crs table
+COPY_BATCH_SIZE = 50000
+# bytes psycopg2 asks for at a time when reading COPY input
+COPY_READ_SIZE = 1024 * 1024
+# rows per multi-row INSERT statement when loading code tables
+INSERT_PAGE_SIZE = 1000
+# number of connections building crs indices at the same time
+INDEX_BUILD_CONNECTIONS = 4
+
+# columns that identify a CRS activity across refreshes (crs_pk does not survive a reload)
+NATURAL_KEY_COLUMNS = ['crsid', 'projectnumber', 'year', 'donorcode']
+# the natural key isn't unique, rows sharing one are told apart by these (then by the order they were loaded in)
+NATURAL_KEY_ORDER_COLUMNS = ['purposecode', 'agencycode', 'channelcode', 'usd_commitment', 'usd_disbursement']
+
+# Our text columns are in several different languages, so we guess the language of each row while loading it
+# (see detect_language) and store it as a text search configuration, used to build that row's searchable_text.
+LANGUAGE_COLUMN_NAME = 'text_language'
+DEFAULT_LANGUAGE = 'english'
+
+# text search configurations we detect, with common words that are (mostly) particular to each language
+# keep in sync with tj.db_layer.TEXT_SEARCH_LANGUAGES
+LANGUAGE_MARKER_WORDS = {
+    'english': frozenset(['the', 'and', 'of', 'to', 'for', 'with', 'on', 'is', 'by', 'support', 'project']),
+    'french': frozenset(['le', 'les', 'des', 'du', 'et', 'pour', 'dans', 'une', 'au', 'aux', 'sur', 'appui']),
+    'spanish': frozenset(['el', 'los', 'las', 'del', 'y', 'para', 'con', 'una', 'por', 'apoyo', 'proyecto']),
+}
+# the order in which ties between the counts of LANGUAGE_MARKER_WORDS are broken
+LANGUAGE_PRIORITY = [DEFAULT_LANGUAGE, 'french', 'spanish']
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+# only look at the start of the text, it's plenty to tell the languages apart
+LANGUAGE_DETECTION_CHARACTERS = 500
+
+# the expression behind the (generated) searchable_text column
+SEARCHABLE_TEXT_SQL = "to_tsvector(" + LANGUAGE_COLUMN_NAME + "," \
+                      "coalesce(projecttitle,'') || ' ' || " \
+                      "coalesce(shortdescription,'') || ' ' || " \
+                      "coalesce(longdescription,''))"
+
+
+def get_required_columns():
+    """
+    The columns of the processed CRS data that building the database actually reads
+    """
+    name_columns = [filter_type + 'name' for filter_type in CODE_TABLES + ['agency']]
+    return [column_name for column_name, column_type in CRS_COLUMN_SPEC] + name_columns
+
+
+def get_loaded_columns():
+    """
+    The columns loaded into crs by COPY: those of the CRS data, plus the detected language
+    """
+    return [column_name for column_name, column_type in CRS_COLUMN_SPEC] + [LANGUAGE_COLUMN_NAME]
+
+
+def detect_language(text):
+    """
+    A quick guess at the language of some text, by counting common words particular to each language
+    """
+    words = WORD_PATTERN.findall(text[:LANGUAGE_DETECTION_CHARACTERS].lower())
+    counts = dict((language, sum(1 for word in words if word in marker_words))
+                  for language, marker_words in LANGUAGE_MARKER_WORDS.iteritems())
+
+    best_count = max(counts.values())
+    if best_count == 0:
+        return DEFAULT_LANGUAGE
+    return [language for language in LANGUAGE_PRIORITY if counts[language] == best_count][0]
+
+
+def with_language_column(dataframe):
+    """
+    Returns the loaded columns of a dataframe, including the language detected from its text columns
+    """
+    dataframe = dataframe[[column_name for column_name, column_type in CRS_COLUMN_SPEC]].copy()
+
+    def as_text(value):
+        if isinstance(value, basestring):
+            return value.decode('utf-8') if isinstance(value, str) else value
+        return u''
+
+    languages = [detect_language(u' '.join([as_text(title), as_text(short), as_text(long_description)]))
+                 for title, short, long_description in zip(dataframe['projecttitle'], dataframe['shortdescription'],
+                                                           dataframe['longdescription'])]
+    dataframe[LANGUAGE_COLUMN_NAME] = languages
+    return dataframe
+
+
+def get_code_table_columns():
+    """
+    The columns of the processed CRS data that building the code tables (including agency) reads
+    """
+    code_columns = []
+    for filter_type in CODE_TABLES:
+        code_columns += [filter_type + 'code', filter_type + 'name']
+    return code_columns + ['agencycode', 'agencyname']
+
 
-# list of (column name, postgres type) tuples for the columns in the CRS data
-# note that postgres will remove any capitalization, e.g. Year -> year
-CRS_COLUMN_SPEC = [
-    ('Year', 'integer'),
-    ('donorcode', 'integer REFERENCES donor'),
-    ('agencycode', 'integer'),
-    ('crsid', 'varchar (63)'),
-    ('projectnumber', 'varchar (63)'),
-    ('initialreport', 'integer'),
-    ('recipientcode', 'integer REFERENCES recipient'),
-    ('regioncode', 'integer REFERENCES region'),
-    ('incomegroupcode', 'integer REFERENCES incomegroup'),
-    ('flowcode', 'integer REFERENCES flow'),
-    ('bi_multi', 'integer'),
-    ('category', 'integer'),
-    ('finance_t', 'integer'),
-    ('aid_t', 'varchar (63)'),
-    ('usd_commitment', 'double precision'),
-    ('usd_disbursement', 'double precision'),
-    ('usd_received', 'double precision'),
-    ('usd_commitment_defl', 'double precision'),
-    ('usd_disbursement_defl', 'double precision'),
-    ('usd_received_defl', 'double precision'),
-    ('usd_adjustment', 'double precision'),
-    ('usd_adjustment_defl', 'double precision'),
-    ('usd_amountuntied', 'double precision'),
-    ('usd_amountpartialtied', 'double precision'),
-    ('usd_amounttied', 'double precision'),
-    ('usd_amountuntied_defl', 'double precision'),
-    ('usd_amountpartialtied_defl', 'double precision'),
-    ('usd_amounttied_defl', 'double precision'),
-    ('usd_IRTC', 'double precision'),
-    ('usd_expert_commitment', 'double precision'),
-    ('usd_expert_extended', 'double precision'),
-    ('usd_export_credit', 'double precision'),
-    ('currencycode', 'integer'),
-    ('commitment_national', 'double precision'),
-    ('disbursement_national', 'double precision'),
-    ('shortdescription', 'text'),
-    ('projecttitle', 'text'),
-    ('purposecode', 'integer REFERENCES purpose'),
-    ('sectorcode', 'integer REFERENCES sector'),
-    # should be 'integer REFERENCES channel', but pandas data has channelcode as float to handle nulls
-    ('channelcode', 'double precision'),
-    ('channelreportedname', 'text'),
-    ('geography', 'text'),
-    ('expectedstartdate', 'varchar (63)'),
-    ('completiondate', 'varchar (63)'),
-    ('longdescription', 'text'),
-    ('gender', 'double precision'),
-    ('trade', 'double precision'),
-    ('FTC', 'double precision'),
-    ('PBA', 'double precision')
-]
-
-# custom columns we want to add to the data
-CATEGORY_COLUMN_NAME = 'tj_category_id'
-INCLUSION_COLUMN_NAME = 'tj_inclusion_id'
+class IteratorFile(object):
+    """
+    A minimal read-only file-like object over an iterator of strings,
+    so that copy_expert can be fed without materializing all of its input at once.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.current_chunk = ''
+        self.position = 0
+
+    def read(self, size=-1):
+        pieces = []
+        remaining = size
+        while size < 0 or remaining > 0:
+            if self.position >= len(self.current_chunk):
+                try:
+                    self.current_chunk = next(self.chunks)
+                except StopIteration:
+                    break
+                self.position = 0
+                continue
+
+            end = len(self.current_chunk) if size < 0 else min(self.position + remaining, len(self.current_chunk))
+            pieces.append(self.current_chunk[self.position:end])
+            remaining -= end - self.position
+            self.position = end
+
+        return ''.join(pieces)
+
+    def readline(self, size=-1):
+        # COPY FROM only ever calls read(), but file-likes are expected to have this
+        return self.read(size)
 
 
 def get_db_connection(host, database, user, password):
@@ -100,10 +180,23 @@ def get_all_name_code_pairs(dataframe, filter_type):
     return rows.rename(columns={code_column: 'code', name_column: 'name'})
 
 
+def get_code_table_values(rows):
+    """
+    Converts code/name rows (see get_all_name_code_pairs) into tuples of plain python values for execute_values
+    """
+    return [(int(code), name) for code, name in zip(rows['code'], rows['name'])]
+
+
+def get_agency_values(rows):
+    return [(int(donorcode), int(agencycode), agencyname)
+            for donorcode, agencycode, agencyname in zip(rows['donorcode'], rows['agencycode'], rows['agencyname'])]
+
+
 def build_code_tables(cursor, dataframe):
-    create_template = 'CREATE TABLE {table_name} ({code_column} integer primary key, {name_column} varchar(127));'
-    insert_template = "INSERT INTO {table_name} VALUES (%(code)s, %(name)s);"
-    index_template = 'CREATE UNIQUE INDEX ON {table_name} ({code_column});'
+    # the primary key (and its index) is only added once the table is populated
+    create_template = 'CREATE TABLE {table_name} ({code_column} integer, {name_column} varchar(127));'
+    insert_template = "INSERT INTO {table_name} VALUES %s;"
+    primary_key_template = 'ALTER TABLE {table_name} ADD PRIMARY KEY ({code_column});'
 
     for filter_type in CODE_TABLES:
         table_name = filter_type
@@ -120,11 +213,10 @@ def build_code_tables(cursor, dataframe):
         cursor.execute(create_sql)
 
         insert_sql = insert_template.format(**name_map)
-        for i, row in rows.iterrows():
-            cursor.execute(insert_sql, {'code': row['code'], 'name': row['name']})
+        psycopg2.extras.execute_values(cursor, insert_sql, get_code_table_values(rows), page_size=INSERT_PAGE_SIZE)
 
-        index_sql = index_template.format(**name_map)
-        cursor.execute(index_sql)
+        primary_key_sql = primary_key_template.format(**name_map)
+        cursor.execute(primary_key_sql)
 
 
 def build_agency_table(cursor, dataframe):
@@ -133,17 +225,14 @@ def build_agency_table(cursor, dataframe):
     """
     rows = dataframe[['donorcode', 'agencycode', 'agencyname']].drop_duplicates()
 
-    create_sql = 'CREATE TABLE agency (donorcode integer, agencycode integer, agencyname varchar(127), ' \
-                 'PRIMARY KEY(donorcode, agencycode));'
+    create_sql = 'CREATE TABLE agency (donorcode integer, agencycode integer, agencyname varchar(127));'
     cursor.execute(create_sql)
 
-    insert_sql = 'INSERT INTO agency VALUES (%(donorcode)s, %(agencycode)s, %(agencyname)s);'
-    for i, row in rows.iterrows():
-        cursor.execute(insert_sql, {'donorcode': row['donorcode'], 'agencycode': row['agencycode'],
-                                    'agencyname': row['agencyname']})
+    insert_sql = 'INSERT INTO agency VALUES %s;'
+    psycopg2.extras.execute_values(cursor, insert_sql, get_agency_values(rows), page_size=INSERT_PAGE_SIZE)
 
-    index_sql = 'CREATE UNIQUE INDEX ON agency(donorcode, agencycode);'
-    cursor.execute(index_sql)
+    primary_key_sql = 'ALTER TABLE agency ADD PRIMARY KEY (donorcode, agencycode);'
+    cursor.execute(primary_key_sql)
 
 
 def build_custom_data_tables(cursor):
@@ -155,98 +244,366 @@ def build_custom_data_tables(cursor):
                            " smallint PRIMARY KEY, tj_inclusion_name varchar(31));"
     cursor.execute(inclusion_create_sql)
 
-    inclusion_insert_sql = "INSERT INTO tj_inclusion VALUES (%(tj_inclusion_id)s, %(tj_inclusion_name)s);"
-    cursor.execute(inclusion_insert_sql, {'tj_inclusion_id': 0, 'tj_inclusion_name': 'Exclude'})
-    cursor.execute(inclusion_insert_sql, {'tj_inclusion_id': 1, 'tj_inclusion_name': 'Include'})
-    cursor.execute(inclusion_insert_sql, {'tj_inclusion_id': 2, 'tj_inclusion_name': 'Maybe include'})
-    # and if we ever come up with other tiers of inclusion, we can add them here
-
-    inclusion_index_sql = "CREATE UNIQUE INDEX on tj_inclusion (" + INCLUSION_COLUMN_NAME + ");"
-    cursor.execute(inclusion_index_sql)
+    inclusion_values = [
+        (0, 'Exclude'),
+        (1, 'Include'),
+        (2, 'Maybe include'),
+        # and if we ever come up with other tiers of inclusion, we can add them here
+    ]
+    psycopg2.extras.execute_values(cursor, "INSERT INTO tj_inclusion VALUES %s;", inclusion_values)
 
     category_create_sql = "CREATE TABLE tj_category (" + CATEGORY_COLUMN_NAME +\
                           " smallint PRIMARY KEY, tj_category_name varchar(31));"
     cursor.execute(category_create_sql)
 
-    category_insert_sql = "INSERT INTO tj_category VALUES (%(tj_category_id)s, %(tj_category_name)s);"
-    cursor.execute(category_insert_sql, {'tj_category_id': 1, 'tj_category_name': 'Truth and memory'})
-    cursor.execute(category_insert_sql, {'tj_category_id': 2, 'tj_category_name': 'Criminal justice'})
-    cursor.execute(category_insert_sql, {'tj_category_id': 3, 'tj_category_name': 'Reparations'})
-    cursor.execute(category_insert_sql, {'tj_category_id': 4, 'tj_category_name': 'Institutional reform'})
-    cursor.execute(category_insert_sql, {'tj_category_id': 5, 'tj_category_name': 'Reconciliation'})
-    cursor.execute(category_insert_sql, {'tj_category_id': 6, 'tj_category_name': 'General TJ'})
-    # if we ever come up with other categories, we can add them here
-    # add this as a 'null' category
-    cursor.execute(category_insert_sql, {'tj_category_id': 0, 'tj_category_name': 'None'})
-
-    category_index_sql = "CREATE UNIQUE INDEX on tj_category (" + CATEGORY_COLUMN_NAME + ");"
-    cursor.execute(category_index_sql)
+    category_values = [
+        (1, 'Truth and memory'),
+        (2, 'Criminal justice'),
+        (3, 'Reparations'),
+        (4, 'Institutional reform'),
+        (5, 'Reconciliation'),
+        (6, 'General TJ'),
+        # if we ever come up with other categories, we can add them here
+        # add this as a 'null' category
+        (0, 'None'),
+    ]
+    psycopg2.extras.execute_values(cursor, "INSERT INTO tj_category VALUES %s;", category_values)
+
+
+def split_column_type(column_type):
+    """
+    Splits a CRS_COLUMN_SPEC column type into the bare postgres type and the table it references (or None)
+    """
+    parts = column_type.split(' REFERENCES ')
+    return parts[0], parts[1] if len(parts) > 1 else None
 
 
 def create_crs_table(cursor):
+    """
+    Creates the crs table without any constraints or indices, so that loading it is as cheap as possible,
+    see add_crs_constraints.
+    The text search column is generated from the text columns as rows are written (this needs PostgreSQL 12+),
+    so there's no need for a second pass over the table to fill it in.
+    """
     sql = 'CREATE TABLE crs ('
 
     # auto-generated primary key
-    sql += 'crs_pk serial PRIMARY KEY,'
+    sql += 'crs_pk serial,'
 
     # custom columns
-    sql += INCLUSION_COLUMN_NAME + ' smallint REFERENCES tj_inclusion,'
-    sql += CATEGORY_COLUMN_NAME + ' smallint REFERENCES tj_category DEFAULT 0 NOT NULL,'
+    sql += INCLUSION_COLUMN_NAME + ' smallint,'
+    sql += CATEGORY_COLUMN_NAME + ' smallint DEFAULT 0 NOT NULL,'
 
     # desired columns from CRS file
-    column_spec_list = [column_name + ' ' + column_type for column_name, column_type in CRS_COLUMN_SPEC]
+    column_spec_list = [column_name + ' ' + split_column_type(column_type)[0]
+                        for column_name, column_type in CRS_COLUMN_SPEC]
     sql += ','.join(column_spec_list)
 
+    sql += ', ' + LANGUAGE_COLUMN_NAME + " regconfig DEFAULT '" + DEFAULT_LANGUAGE + "' NOT NULL"
+
+    # a special column just for text search
+    sql += ', searchable_text tsvector GENERATED ALWAYS AS (' + SEARCHABLE_TEXT_SQL + ') STORED'
+
     sql += ');'
     cursor.execute(sql)
 
 
-def populate_crs_table(cursor, dataframe):
-    # write the dataframe to a buffer
-    byte_buffer = StringIO.StringIO()
-    columns_of_interest = [column_name for column_name, column_type in CRS_COLUMN_SPEC]
-    dataframe[columns_of_interest].to_csv(byte_buffer, header=False, index=False)
-    byte_buffer.seek(0)  # rewind to beginning of the buffer
+def add_crs_constraints(cursor):
+    """
+    Adds the primary and foreign keys to a loaded crs table, each is then built/checked in a single pass
+    """
+    cursor.execute('ALTER TABLE crs ADD PRIMARY KEY (crs_pk);')
 
-    # bulk-load the table from the buffer
-    copy_sql = "COPY crs({columns}) FROM STDIN WITH CSV".format(columns=",".join(columns_of_interest))
-    cursor.copy_expert(copy_sql, byte_buffer)
+    references = [(INCLUSION_COLUMN_NAME, 'tj_inclusion'), (CATEGORY_COLUMN_NAME, 'tj_category')]
+    for column_name, column_type in CRS_COLUMN_SPEC:
+        referenced_table = split_column_type(column_type)[1]
+        if referenced_table:
+            references.append((column_name, referenced_table))
+
+    foreign_key_template = 'ALTER TABLE crs ADD FOREIGN KEY ({column}) REFERENCES {table};'
+    for column, table in references:
+        cursor.execute(foreign_key_template.format(column=column, table=table))
+
+
+def record_data_version(cursor):
+    """
+    Records that the data has changed, so that the web app drops anything it has cached (see tj.db_layer)
+    """
+    cursor.execute('CREATE TABLE IF NOT EXISTS crs_data_version (data_version varchar(63));')
+    cursor.execute('DELETE FROM crs_data_version;')
+    cursor.execute('INSERT INTO crs_data_version VALUES (%(data_version)s);',
+                   {'data_version': datetime.datetime.utcnow().isoformat()})
+
+
+def analyze_tables(cursor, table_names=ANALYZED_TABLES):
+    """
+    Refreshes planner statistics once everything is loaded and indexed (or just for the given tables)
+    """
+    for table_name in table_names:
+        cursor.execute('ANALYZE ' + table_name + ';')
+
+
+def iter_batches(dataframes, batch_size):
+    """
+    Splits an iterable of dataframes into dataframes of at most batch_size rows
+    """
+    for dataframe in dataframes:
+        for start in xrange(0, len(dataframe), batch_size):
+            yield dataframe.iloc[start:start + batch_size]
 
 
-def index_crs_table(cursor):
+def iter_csv_chunks(dataframes, columns, batch_size=COPY_BATCH_SIZE, progress=None):
+    """
+    Yields the rows of an iterable of dataframes as CSV text, batch_size rows at a time.
+    progress, if given, is a dict that is kept updated with the number of rows and bytes produced so far.
+    """
+    start_time = time.time()
+    for batch in iter_batches(dataframes, batch_size):
+        byte_buffer = StringIO.StringIO()
+        batch[columns].to_csv(byte_buffer, header=False, index=False, encoding='utf-8')
+        csv_chunk = byte_buffer.getvalue()
+
+        if progress is not None:
+            progress['rows'] += len(batch)
+            progress['bytes'] += len(csv_chunk)
+            elapsed = max(time.time() - start_time, 1e-6)
+            print 'COPY: {rows} rows, {mb:.1f} MB ({rows_per_second:.0f} rows/s, {mb_per_second:.1f} MB/s)'.format(
+                rows=progress['rows'], mb=progress['bytes'] / 1e6,
+                rows_per_second=progress['rows'] / elapsed, mb_per_second=progress['bytes'] / 1e6 / elapsed)
+
+        yield csv_chunk
+
+
+def stream_crs_table(cursor, dataframes, table_name='crs', batch_size=COPY_BATCH_SIZE):
+    """
+    Bulk-loads an iterable of dataframes (e.g. crs_store.iter_store, or process_crs_data.read_psv_file with a
+    chunksize) into the crs table with a single COPY, producing the CSV input a batch at a time as COPY reads it.
+    Memory use depends on the batch size and the size of each dataframe, not on the total number of rows.
+    The language of each row is detected on the way, see with_language_column.
+    """
+    columns_of_interest = get_loaded_columns()
+    batches = (with_language_column(batch) for batch in iter_batches(dataframes, batch_size))
+    progress = {'rows': 0, 'bytes': 0}
+    csv_file = IteratorFile(iter_csv_chunks(batches, columns_of_interest, batch_size, progress))
+
+    copy_sql = "COPY {table_name}({columns}) FROM STDIN WITH CSV".format(table_name=table_name,
+                                                                         columns=",".join(columns_of_interest))
+    cursor.copy_expert(copy_sql, csv_file, size=COPY_READ_SIZE)
+    print "Loaded", progress['rows'], "rows into", table_name
+
+
+def populate_crs_table(cursor, dataframe, table_name='crs'):
+    stream_crs_table(cursor, [dataframe], table_name)
+
+
+def add_new_codes(cursor, dataframe):
+    """
+    Adds any codes (including agencies) in the dataframe that aren't in the code tables yet, e.g. a new donor
+    """
+    insert_template = 'INSERT INTO {table_name} SELECT v.code, v.name FROM (VALUES %s) AS v(code, name) ' \
+                      'WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE t.{code_column} = v.code);'
+
+    for filter_type in CODE_TABLES:
+        rows = get_all_name_code_pairs(dataframe, filter_type)
+        insert_sql = insert_template.format(table_name=filter_type, code_column=filter_type + 'code')
+        psycopg2.extras.execute_values(cursor, insert_sql, get_code_table_values(rows), page_size=INSERT_PAGE_SIZE)
+
+    rows = dataframe[['donorcode', 'agencycode', 'agencyname']].drop_duplicates()
+    insert_sql = 'INSERT INTO agency SELECT v.donorcode, v.agencycode, v.agencyname ' \
+                 'FROM (VALUES %s) AS v(donorcode, agencycode, agencyname) ' \
+                 'WHERE NOT EXISTS (SELECT 1 FROM agency a ' \
+                 'WHERE a.donorcode = v.donorcode AND a.agencycode = v.agencycode);'
+    psycopg2.extras.execute_values(cursor, insert_sql, get_agency_values(rows), page_size=INSERT_PAGE_SIZE)
+
+
+def get_natural_key_expressions(alias):
+    """
+    The NATURAL_KEY_COLUMNS of a table alias as SQL expressions, with nulls coalesced so that they can be compared
+    (and hash joined) like any other value
+    """
+    return ['coalesce({alias}.{column}, \'\')'.format(alias=alias, column=column)
+            if column in ('crsid', 'projectnumber') else 'coalesce({alias}.{column}, -1)'.format(alias=alias,
+                                                                                             column=column)
+            for column in NATURAL_KEY_COLUMNS]
+
+
+def get_key_ordinal_sql(alias, row_order_column):
+    """
+    Numbers the rows sharing a natural key, in an order that doesn't depend on crs_pk (see NATURAL_KEY_ORDER_COLUMNS),
+    so that the nth row of a key in the old data can be matched with the nth row of that key in the new data
+    """
+    order_columns = ['{alias}.{column}'.format(alias=alias, column=column) for column in NATURAL_KEY_ORDER_COLUMNS]
+    return 'row_number() OVER (PARTITION BY {keys} ORDER BY {order}, {alias}.{row_order_column})'.format(
+        keys=', '.join(get_natural_key_expressions(alias)), order=', '.join(order_columns), alias=alias,
+        row_order_column=row_order_column)
+
+
+def replace_crs_years(cursor, dataframes, years):
+    """
+    Replaces all crs rows for the given years with the rows of an iterable of dataframes (e.g. read in chunks),
+    which must hold every row of each of those years, not just the changed ones. Any new codes are added first.
+    Inclusion/category decisions are carried over one to one: the natural key isn't unique, so the nth old row of
+    each key (see get_key_ordinal_sql) passes its decision on to the nth new row of that key, if there is one.
+    Decisions that find no new row are kept in crs_unmatched_decisions rather than dropped.
+    crs_rollup is recomputed for those years as well.
+    """
+    # a staging copy of the new rows, without foreign keys, numbered in the order they were read
+    column_spec_list = ['staging_pk serial'] + [column_name + ' ' + split_column_type(column_type)[0]
+                                                for column_name, column_type in CRS_COLUMN_SPEC]
+    column_spec_list.append(LANGUAGE_COLUMN_NAME + ' regconfig')
+    cursor.execute('CREATE TEMP TABLE crs_staging (' + ','.join(column_spec_list) + ') ON COMMIT DROP;')
+
+    # the codes of each chunk are collected as it goes by, they can't be added while COPY is using the connection
+    code_frames = []
+
+    def iter_collecting_codes():
+        for dataframe in dataframes:
+            code_frames.append(dataframe[get_code_table_columns()].drop_duplicates())
+            yield dataframe
+
+    stream_crs_table(cursor, iter_collecting_codes(), table_name='crs_staging')
+    if code_frames:
+        add_new_codes(cursor, pd.concat(code_frames, ignore_index=True).drop_duplicates())
+
+    # remember the analysis done on the old rows, along with which of the rows of its key each one was
+    key_expressions = get_natural_key_expressions('c')
+    key_columns = ['key_' + column for column in NATURAL_KEY_COLUMNS]
+    decisions_sql = 'CREATE TEMP TABLE crs_decisions ON COMMIT DROP AS ' \
+                    'SELECT * FROM (SELECT {keys}, {ordinal} AS key_ordinal, c.{inclusion}, c.{category} ' \
+                    'FROM crs c WHERE c.year = ANY(%(years)s)) AS numbered ' \
+                    'WHERE {inclusion} IS NOT NULL OR {category} != 0;'.format(
+                        keys=', '.join(expression + ' AS ' + column
+                                       for expression, column in zip(key_expressions, key_columns)),
+                        ordinal=get_key_ordinal_sql('c', 'crs_pk'),
+                        inclusion=INCLUSION_COLUMN_NAME, category=CATEGORY_COLUMN_NAME)
+    cursor.execute(decisions_sql, {'years': years})
+
+    cursor.execute('DELETE FROM crs WHERE year = ANY(%(years)s);', {'years': years})
+
+    columns = get_loaded_columns()
+    join_conditions = ['s.{column} = d.{column}'.format(column=column) for column in key_columns + ['key_ordinal']]
+    insert_sql = 'INSERT INTO crs ({columns}, {inclusion}, {category}) ' \
+                 'SELECT {staging_columns}, d.{inclusion}, coalesce(d.{category}, 0) ' \
+                 'FROM (SELECT s.*, {keys}, {ordinal} AS key_ordinal FROM crs_staging s) AS s ' \
+                 'LEFT OUTER JOIN crs_decisions d ON ({join_conditions});'.format(
+                     columns=','.join(columns), staging_columns=','.join('s.' + column for column in columns),
+                     keys=', '.join(expression + ' AS ' + column
+                                    for expression, column in zip(get_natural_key_expressions('s'), key_columns)),
+                     ordinal=get_key_ordinal_sql('s', 'staging_pk'),
+                     inclusion=INCLUSION_COLUMN_NAME, category=CATEGORY_COLUMN_NAME,
+                     join_conditions=' AND '.join(join_conditions))
+    cursor.execute(insert_sql)
+    print "Replaced", cursor.rowcount, "rows for years", years
+
+    record_unmatched_decisions(cursor, key_columns)
+
+    refresh_rollup_years(cursor, years)
+
+
+def record_unmatched_decisions(cursor, key_columns):
+    """
+    Moves the decisions of crs_decisions that no new row was given (their key now has fewer rows, or is gone) into
+    crs_unmatched_decisions, so they can be looked over and reapplied by hand
+    """
+    cursor.execute('CREATE TABLE IF NOT EXISTS crs_unmatched_decisions (refreshed_at timestamp, {keys}, '
+                   'key_ordinal bigint, {inclusion} smallint, {category} smallint);'.format(
+                       keys=', '.join(column + ' ' + ('text' if column in ('key_crsid', 'key_projectnumber')
+                                                      else 'integer')
+                                      for column in key_columns),
+                       inclusion=INCLUSION_COLUMN_NAME, category=CATEGORY_COLUMN_NAME))
+
+    # the nth decision of a key found a row if the new data has at least n rows with that key
+    key_expressions = get_natural_key_expressions('s')
+    key_counts_sql = 'SELECT {keys}, count(*) AS key_count FROM crs_staging s GROUP BY {group_keys}'.format(
+        keys=', '.join(expression + ' AS ' + column for expression, column in zip(key_expressions, key_columns)),
+        group_keys=', '.join(key_expressions))
+    cursor.execute('INSERT INTO crs_unmatched_decisions '
+                   'SELECT now(), d.* FROM crs_decisions d LEFT OUTER JOIN ({key_counts}) AS k ON ({conditions}) '
+                   'WHERE d.key_ordinal > coalesce(k.key_count, 0);'.format(
+                       key_counts=key_counts_sql,
+                       conditions=' AND '.join('k.{column} = d.{column}'.format(column=column)
+                                               for column in key_columns)))
+
+    if cursor.rowcount:
+        print "Warning", cursor.rowcount, "inclusion/category decisions had no matching row in the new data, " \
+                                          "see crs_unmatched_decisions"
+
+
+def get_rollup_select_sql(where_clause=''):
+    sum_columns = ['count(*) AS row_count'] + ['coalesce(sum({column}), 0) AS {column}'.format(column=column)
+                                               for column in ROLLUP_SUM_COLUMNS]
+    return 'SELECT ' + ', '.join(ROLLUP_KEY_COLUMNS + sum_columns) + ' FROM crs ' + where_clause + \
+           ' GROUP BY ' + ', '.join(ROLLUP_KEY_COLUMNS)
+
+
+def build_rollup_table(cursor):
+    """
+    Creates crs_rollup, with the row count and summed amounts of crs for each combination of ROLLUP_KEY_COLUMNS.
+    The web app keeps it current as rows are analyzed (see tj.db_layer.update_analysis).
+    """
+    cursor.execute('DROP TABLE IF EXISTS crs_rollup;')
+    cursor.execute('CREATE TABLE crs_rollup AS ' + get_rollup_select_sql() + ';')
+    cursor.execute('CREATE UNIQUE INDEX crs_rollup_key_idx ON crs_rollup ' + ROLLUP_CONFLICT_TARGET + ';')
+
+
+def refresh_rollup_years(cursor, years):
+    """
+    Recomputes the crs_rollup rows of the given years, after their crs rows have been replaced
+    """
+    cursor.execute('DELETE FROM crs_rollup WHERE year = ANY(%(years)s);', {'years': years})
+    cursor.execute('INSERT INTO crs_rollup ' + get_rollup_select_sql('WHERE year = ANY(%(years)s)') + ';',
+                   {'years': years})
+
+
+def get_crs_index_statements():
+    """
+    Returns (index name, CREATE INDEX statement) tuples for all the indices on the crs table
+    """
+    # the text search index is by far the slowest to build, so list it first to have it start first
+    statements = [('crs_textsearch_idx', 'CREATE INDEX crs_textsearch_idx ON crs USING gin(searchable_text);')]
+
     # index code table columns in main crs table as we'll use them to filter queries
     code_index_template = 'CREATE INDEX {index_name} ON crs ({code_column});'
-
     for filter_type in CODE_TABLES:
         name_map = {'index_name': 'crs_' + filter_type + 'code_idx', 'code_column': filter_type + 'code'}
-        index_sql = code_index_template.format(**name_map)
-        cursor.execute(index_sql)
+        statements.append((name_map['index_name'], code_index_template.format(**name_map)))
 
     # also index the custom columns as they will be important for filtering
     # note these indices are on the only non-static data (maybe need to be rebuilt if ever used heavily?)
     custom_index_sql_template = 'CREATE INDEX {index_name} ON crs ({custom_column});'
     for custom_column in (INCLUSION_COLUMN_NAME, CATEGORY_COLUMN_NAME):
         name_map = {'index_name': 'crs_' + custom_column + '_idx', 'custom_column': custom_column}
-        custom_index_sql = custom_index_sql_template.format(**name_map)
-        cursor.execute(custom_index_sql)
+        statements.append((name_map['index_name'], custom_index_sql_template.format(**name_map)))
 
+    return statements
 
-    # Add a special column to crs just for text search, then index it.
 
-    alter_sql = 'ALTER TABLE crs ADD COLUMN searchable_text tsvector;'
-    cursor.execute(alter_sql)
+def index_crs_table(connect, num_connections=INDEX_BUILD_CONNECTIONS):
+    """
+    Builds the crs indices in parallel, each on its own connection (connect is a function returning a new one).
+    The crs table must already be committed, as the other connections can't see it otherwise.
+    """
+    def create_index(name_and_sql):
+        index_name, index_sql = name_and_sql
+        start_time = time.time()
+
+        connection = connect()
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute(index_sql)
+        cursor.close()
+        connection.close()
 
-    # Unfortunately we have to pick a language here, and our text columns are in several different languages.
-    # If we could figure out the language of each row (by donor, recipient, or text analysis?) and store it in
-    # a column, then we could use to_tsvector(language_column, text_column).
-    update_sql = "UPDATE crs SET searchable_text = to_tsvector('english'," \
-                 "coalesce(projecttitle,'') || ' ' || " \
-                 "coalesce(shortdescription,'') || ' ' || " \
-                 "coalesce(longdescription,''));"
-    cursor.execute(update_sql)
+        print 'Created {index_name} in {seconds:.1f}s'.format(index_name=index_name, seconds=time.time() - start_time)
 
-    text_index_sql = "CREATE INDEX crs_textsearch_idx ON crs USING gin(searchable_text);"
-    cursor.execute(text_index_sql)
+    start_time = time.time()
+    pool = ThreadPool(num_connections)
+    try:
+        pool.map(create_index, get_crs_index_statements())
+    finally:
+        pool.close()
+        pool.join()
+    print 'Created all crs indices in {seconds:.1f}s'.format(seconds=time.time() - start_time)
 
 
 if __name__ == "__main__":
@@ -258,18 +615,30 @@ if __name__ == "__main__":
     connection = get_db_connection(host, database, user, password)
     cursor = connection.cursor()
 
-    # dataframe = pd.read_pickle('/home/andrew/oecd/crs/processed/2014-01-30/all_data.pkl')
-    dataframe = pd.read_pickle('/home/andrew/oecd/crs/processed/2014-01-30/filtered.pkl')
+    # store_dir = '/home/andrew/oecd/crs/processed/2014-01-30/all_data'
+    store_dir = '/home/andrew/oecd/crs/processed/2014-01-30/filtered'
 
-    build_code_tables(cursor, dataframe)
-    build_agency_table(cursor, dataframe)
+    # only the distinct code/name pairs need to be in memory all at once
+    code_dataframe = pd.concat([partition.drop_duplicates()
+                                for partition in crs_store.iter_store(store_dir, columns=get_code_table_columns())],
+                               ignore_index=True)
+    build_code_tables(cursor, code_dataframe)
+    build_agency_table(cursor, code_dataframe)
 
     build_custom_data_tables(cursor)
 
     create_crs_table(cursor)
-    populate_crs_table(cursor, dataframe)
-    index_crs_table(cursor)
+    crs_columns = [column_name for column_name, column_type in CRS_COLUMN_SPEC]
+    stream_crs_table(cursor, crs_store.iter_store(store_dir, columns=crs_columns))
+    add_crs_constraints(cursor)
+    build_rollup_table(cursor)
+    connection.commit()
+
+    index_crs_table(lambda: get_db_connection(host, database, user, password))
 
+    analyze_tables(cursor)
+    record_data_version(cursor)
     connection.commit()
+
     cursor.close()
     connection.close()
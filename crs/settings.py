@@ -13,6 +13,7 @@ import dj_database_url
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 
 SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -52,6 +53,27 @@ WSGI_APPLICATION = 'crs.wsgi.application'
 # Parse database configuration from $DATABASE_URL
 DATABASES = {'default': dj_database_url.config()}
 
+# keep connections open between requests for up to DB_CONN_MAX_AGE seconds rather than reconnecting for each one,
+# there is one per worker thread so gunicorn's worker count bounds them (see tj.db_layer.get_db_connection)
+DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', 10 * 60))
+
+# server-side prepared statements don't survive transaction pooling (e.g. pgbouncer), set to False behind one
+DB_PREPARED_STATEMENTS = (os.environ.get('DB_PREPARED_STATEMENTS', 'True') == "True")
+
+
+# pages of query results are shared between the workers through the filesystem (see tj.result_cache)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'results': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('RESULT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'crs_tj_results')),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+}
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
@@ -0,0 +1,73 @@
+"""
+The parts of the CRS database schema that both the build scripts and the web app (tj.db_layer) need to know about.
+"""
+
+# list of (column name, postgres type) tuples for the columns in the CRS data
+# note that postgres will remove any capitalization, e.g. Year -> year
+CRS_COLUMN_SPEC = [
+    ('Year', 'integer'),
+    ('donorcode', 'integer REFERENCES donor'),
+    ('agencycode', 'integer'),
+    ('crsid', 'varchar (63)'),
+    ('projectnumber', 'varchar (63)'),
+    ('initialreport', 'integer'),
+    ('recipientcode', 'integer REFERENCES recipient'),
+    ('regioncode', 'integer REFERENCES region'),
+    ('incomegroupcode', 'integer REFERENCES incomegroup'),
+    ('flowcode', 'integer REFERENCES flow'),
+    ('bi_multi', 'integer'),
+    ('category', 'integer'),
+    ('finance_t', 'integer'),
+    ('aid_t', 'varchar (63)'),
+    ('usd_commitment', 'double precision'),
+    ('usd_disbursement', 'double precision'),
+    ('usd_received', 'double precision'),
+    ('usd_commitment_defl', 'double precision'),
+    ('usd_disbursement_defl', 'double precision'),
+    ('usd_received_defl', 'double precision'),
+    ('usd_adjustment', 'double precision'),
+    ('usd_adjustment_defl', 'double precision'),
+    ('usd_amountuntied', 'double precision'),
+    ('usd_amountpartialtied', 'double precision'),
+    ('usd_amounttied', 'double precision'),
+    ('usd_amountuntied_defl', 'double precision'),
+    ('usd_amountpartialtied_defl', 'double precision'),
+    ('usd_amounttied_defl', 'double precision'),
+    ('usd_IRTC', 'double precision'),
+    ('usd_expert_commitment', 'double precision'),
+    ('usd_expert_extended', 'double precision'),
+    ('usd_export_credit', 'double precision'),
+    ('currencycode', 'integer'),
+    ('commitment_national', 'double precision'),
+    ('disbursement_national', 'double precision'),
+    ('shortdescription', 'text'),
+    ('projecttitle', 'text'),
+    ('purposecode', 'integer REFERENCES purpose'),
+    ('sectorcode', 'integer REFERENCES sector'),
+    # should be 'integer REFERENCES channel', but pandas data has channelcode as float to handle nulls
+    ('channelcode', 'double precision'),
+    ('channelreportedname', 'text'),
+    ('geography', 'text'),
+    ('expectedstartdate', 'varchar (63)'),
+    ('completiondate', 'varchar (63)'),
+    ('longdescription', 'text'),
+    ('gender', 'double precision'),
+    ('trade', 'double precision'),
+    ('FTC', 'double precision'),
+    ('PBA', 'double precision')
+]
+
+# custom columns we want to add to the data
+CATEGORY_COLUMN_NAME = 'tj_category_id'
+INCLUSION_COLUMN_NAME = 'tj_inclusion_id'
+
+# the crs_rollup summary table holds row counts and sums of these amounts for each combination of the key columns
+ROLLUP_KEY_COLUMNS = ['year', 'recipientcode', 'donorcode', 'purposecode', INCLUSION_COLUMN_NAME, CATEGORY_COLUMN_NAME]
+ROLLUP_SUM_COLUMNS = ['usd_commitment', 'usd_disbursement', 'usd_commitment_defl', 'usd_disbursement_defl']
+# the key columns crs declares NOT NULL, the others can be null (tj_inclusion_id until a decision is made)
+ROLLUP_NOT_NULL_KEY_COLUMNS = [CATEGORY_COLUMN_NAME]
+# the unique key of crs_rollup, a plain unique index would never consider two nulls the same, so nullable columns are
+# coalesced to a value no code or id takes
+ROLLUP_CONFLICT_TARGET = '(' + ', '.join(column if column in ROLLUP_NOT_NULL_KEY_COLUMNS else
+                                         'coalesce({column}, -1)'.format(column=column)
+                                         for column in ROLLUP_KEY_COLUMNS) + ')'
@@ -0,0 +1,152 @@
+"""
+For storing processed CRS data on disk in a columnar format, partitioned by year.
+
+A store is a directory holding a manifest.json and one subdirectory per partition, with one file per column:
+a NumPy .npy file for numeric columns and a pickle for object (text) columns.
+Numeric columns are memory-mapped when read, so filtering on them doesn't require loading anything else, and readers
+only ever touch the partitions and columns they ask for.
+"""
+import collections
+import cPickle
+import json
+import os
+import numpy as np
+import pandas as pd
+
+MANIFEST_FILE_NAME = 'manifest.json'
+YEAR_COLUMN = 'Year'
+
+
+def get_manifest_path(store_dir):
+    return os.path.join(store_dir, MANIFEST_FILE_NAME)
+
+
+def read_manifest(store_dir):
+    """
+    Returns the manifest of a store, or an empty one if the store doesn't exist yet.
+    The manifest has the ordered list of column names and a list of partitions, each of which records its year,
+    its (relative) directory, its row count and the dtype of each of its columns.
+    """
+    manifest_path = get_manifest_path(store_dir)
+    if not os.path.exists(manifest_path):
+        return {'columns': [], 'partitions': []}
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(store_dir, manifest):
+    # write-then-rename so that a crash never leaves a half-written manifest behind
+    manifest_path = get_manifest_path(store_dir)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def is_object_dtype(dtype_str):
+    return np.dtype(str(dtype_str)) == np.object_
+
+
+def get_column_path(store_dir, partition, column):
+    extension = '.pkl' if is_object_dtype(partition['dtypes'][column]) else '.npy'
+    return os.path.join(store_dir, partition['path'], column + extension)
+
+
+def append_dataframe(store_dir, dataframe):
+    """
+    Writes the rows of a dataframe to a store, adding one new partition for each year present in it.
+    Years can be spread across several calls (e.g. when reading a file in chunks), each adds its own partitions.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    manifest = read_manifest(store_dir)
+
+    for column in dataframe.columns:
+        if column not in manifest['columns']:
+            manifest['columns'].append(column)
+
+    for year, year_frame in dataframe.groupby(YEAR_COLUMN):
+        year = int(year)
+        relative_path = os.path.join(str(year), str(len(manifest['partitions'])))
+        os.makedirs(os.path.join(store_dir, relative_path))
+
+        partition = {'year': year, 'path': relative_path, 'num_rows': len(year_frame), 'dtypes': {}}
+        for column in year_frame.columns:
+            values = year_frame[column].values
+            partition['dtypes'][column] = values.dtype.str
+
+            column_path = get_column_path(store_dir, partition, column)
+            if is_object_dtype(values.dtype):
+                with open(column_path, 'wb') as column_file:
+                    cPickle.dump(values, column_file, cPickle.HIGHEST_PROTOCOL)
+            else:
+                np.save(column_path, values)
+
+        manifest['partitions'].append(partition)
+
+    write_manifest(store_dir, manifest)
+
+
+def load_column(store_dir, partition, column, row_mask=None):
+    """
+    Loads one column of one partition, memory-mapping it unless it's an object column.
+    If a boolean row_mask is given, only the selected rows are copied into memory.
+    """
+    if column not in partition['dtypes']:
+        # column didn't exist in the source data for this partition
+        num_rows = partition['num_rows'] if row_mask is None else int(row_mask.sum())
+        return np.repeat(np.nan, num_rows)
+
+    column_path = get_column_path(store_dir, partition, column)
+    if is_object_dtype(partition['dtypes'][column]):
+        with open(column_path, 'rb') as column_file:
+            values = cPickle.load(column_file)
+    else:
+        values = np.load(column_path, mmap_mode='r')
+
+    if row_mask is not None:
+        return values[row_mask]
+
+    return np.array(values)
+
+
+def iter_store(store_dir, columns=None, year_predicate=None, purpose_predicate=None):
+    """
+    Reads a store one partition at a time, yielding a pandas DataFrame for each partition with matching rows.
+    columns: the columns to load (all of them by default).
+    year_predicate: function of a year, partitions for which it returns False are never opened.
+    purpose_predicate: function of an array of purpose codes returning a boolean mask of the rows to keep,
+    evaluated on the memory-mapped purposecode column before any other column is read.
+    """
+    manifest = read_manifest(store_dir)
+    if columns is None:
+        columns = manifest['columns']
+
+    for partition in manifest['partitions']:
+        if year_predicate is not None and not year_predicate(partition['year']):
+            continue
+
+        row_mask = None
+        if purpose_predicate is not None:
+            row_mask = np.asarray(purpose_predicate(load_column(store_dir, partition, 'purposecode')), dtype=bool)
+            if not row_mask.any():
+                continue
+
+        data = collections.OrderedDict((column, load_column(store_dir, partition, column, row_mask))
+                                       for column in columns)
+        yield pd.DataFrame(data, columns=columns)
+
+
+def read_store(store_dir, columns=None, year_predicate=None, purpose_predicate=None):
+    """
+    Reads a store back into a single pandas DataFrame, see iter_store for the arguments
+    """
+    if columns is None:
+        columns = read_manifest(store_dir)['columns']
+
+    frames = list(iter_store(store_dir, columns, year_predicate, purpose_predicate))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(frames, ignore_index=True)
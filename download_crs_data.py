@@ -6,39 +6,181 @@ import urllib2
 import re
 import os
 import datetime
+import hashlib
+import json
+from multiprocessing.pool import ThreadPool
 
 CRS_BASE_URL = 'http://stats.oecd.org'
-CRS_FILES_URL = CRS_BASE_URL + '/DownloadFiles.aspx?HideTopMenu=yes&DatasetCode=crs1'
+CRS_FILES_PATH = '/DownloadFiles.aspx?HideTopMenu=yes&DatasetCode=crs1'
+CRS_FILES_URL = CRS_BASE_URL + CRS_FILES_PATH
 CRS_DOWNLOAD_LINK_PATTERN = r"\.(/FileView2.aspx\?IDFile=.*?)'"
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_NUM_THREADS = 4
+# records the HTTP validators (ETag/Last-Modified) of everything downloaded into a directory, keyed by URL
+DOWNLOAD_MANIFEST_FILE_NAME = 'download_manifest.json'
+CONTENT_RANGE_PATTERN = r'bytes (\d+)-(\d+)/(\d+)'
 
-def get_crs_download_links():
+
+def get_crs_download_links(base_url=CRS_BASE_URL):
     """
-    Goes to the OECD Stats website and finds the URLs to download raw CRS data
+    Goes to the OECD Stats website (or whatever base_url points at) and finds the URLs to download raw CRS data
     """
-    response = urllib2.urlopen(CRS_FILES_URL)
+    response = urllib2.urlopen(base_url + CRS_FILES_PATH)
     download_text = response.read()
     relative_links = re.findall(CRS_DOWNLOAD_LINK_PATTERN, download_text)
-    return [CRS_BASE_URL + relative_link for relative_link in relative_links]
+    return [base_url + relative_link for relative_link in relative_links]
+
+
+def get_filename(response):
+    attachment_text = response.headers['content-disposition']
+    return attachment_text.replace('attachment; filename=', '').replace(';', '')
 
 
-def download_csv_file(url, dest_dir):
+def get_expected_size(response, resume_from=0):
     """
-    Downloads a file from a CRS URL, saving it to the specified directory
-    under the filename indicated in the HTTP headers
+    Returns the full size of the file being downloaded, for both full (200) and partial (206) responses,
+    or None if the server doesn't say.
+    A partial response should say in its Content-Range, failing that its Content-Length is taken to be the rest of the
+    file after resume_from.
     """
-    response = urllib2.urlopen(url)
+    content_length = response.headers.get('content-length')
 
-    attachment_text = response.headers['content-disposition']
-    filename = attachment_text.replace('attachment; filename=', '').replace(';', '')
+    if response.getcode() == 206:
+        content_range_match = re.match(CONTENT_RANGE_PATTERN, response.headers.get('content-range') or '')
+        if content_range_match:
+            return int(content_range_match.group(3))
+        return resume_from + int(content_length) if content_length is not None else None
 
-    content = response.read()
+    return int(content_length) if content_length is not None else None
 
+
+def download_csv_file(url, dest_dir, previous_download=None):
+    """
+    Downloads a file from a CRS URL, saving it to the specified directory
+    under the filename indicated in the HTTP headers.
+
+    The file is streamed to a temporary ".part" file that is only renamed into place once complete and of the
+    expected size. If a ".part" file is left over from an interrupted download, it is resumed with a Range request
+    (falling back to a full download if the file has changed on the server since).
+    If previous_download (as returned by an earlier call) is given and the server says the file is unchanged,
+    nothing is downloaded.
+
+    Returns a dict with the filename, size, etag and last_modified of the downloaded file.
+    """
+    part_path = os.path.join(dest_dir, hashlib.md5(url).hexdigest() + '.part')
+    validators_path = part_path + '.json'
+
+    request = urllib2.Request(url)
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    if resume_from and os.path.exists(validators_path):
+        with open(validators_path) as validators_file:
+            part_validators = json.load(validators_file)
+        request.add_header('Range', 'bytes={start}-'.format(start=resume_from))
+        # only resume if the file hasn't changed since the partial download started
+        if_range = part_validators.get('etag') or part_validators.get('last_modified')
+        if if_range:
+            request.add_header('If-Range', if_range)
+    elif previous_download and os.path.exists(os.path.join(dest_dir, previous_download['filename'])):
+        if previous_download.get('etag'):
+            request.add_header('If-None-Match', previous_download['etag'])
+        if previous_download.get('last_modified'):
+            request.add_header('If-Modified-Since', previous_download['last_modified'])
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as error:
+        if error.code == 304:
+            print "Unchanged " + url
+            return previous_download
+        if error.code == 416 and resume_from:
+            # the partial file is no good for resuming, start over
+            os.remove(part_path)
+            os.remove(validators_path)
+            return download_csv_file(url, dest_dir, previous_download)
+        raise
+
+    filename = get_filename(response)
     output_path = os.path.join(dest_dir, filename)
+    expected_size = get_expected_size(response, resume_from)
+    validators = {'etag': response.headers.get('etag'), 'last_modified': response.headers.get('last-modified')}
 
-    with open(output_path, 'wb') as filehandle:
+    if response.getcode() == 206:
+        print "Resuming " + url + " to " + output_path + " from byte " + str(resume_from)
+        mode = 'ab'
+    else:
         print "Writing " + url + " to " + output_path
-        filehandle.write(content)
+        mode = 'wb'
+        with open(validators_path, 'w') as validators_file:
+            json.dump(validators, validators_file)
+
+    with open(part_path, mode) as filehandle:
+        for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), ''):
+            filehandle.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        # leave the .part file behind so that the next attempt can resume it
+        raise IOError('Downloaded {size} bytes of {url}, expected {expected}'.format(size=size, url=url,
+                                                                                   expected=expected_size))
+
+    os.rename(part_path, output_path)
+    os.remove(validators_path)
+
+    return {'filename': filename, 'size': size,
+            'etag': validators['etag'], 'last_modified': validators['last_modified']}
+
+
+def read_download_manifest(dest_dir):
+    manifest_path = os.path.join(dest_dir, DOWNLOAD_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_download_manifest(dest_dir, manifest):
+    manifest_path = os.path.join(dest_dir, DOWNLOAD_MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def download_links(links, dest_dir, num_threads=DEFAULT_NUM_THREADS):
+    """
+    Downloads all the links into dest_dir using a pool of num_threads threads,
+    skipping those that are unchanged since they were last downloaded into the same directory.
+    """
+    manifest = read_download_manifest(dest_dir)
+
+    def download(link):
+        try:
+            return link, download_csv_file(link, dest_dir, manifest.get(link)), None
+        except (urllib2.URLError, IOError) as error:
+            return link, None, error
+
+    pool = ThreadPool(num_threads)
+    try:
+        results = pool.map(download, links)
+    finally:
+        pool.close()
+        pool.join()
+
+    # record whatever did succeed before reporting failures, so that those files are skipped next time
+    failures = []
+    for link, download_info, error in results:
+        if error is None:
+            manifest[link] = download_info
+        else:
+            failures.append((link, error))
+    write_download_manifest(dest_dir, manifest)
+
+    if failures:
+        for link, error in failures:
+            print "Failed to download " + link + ": " + str(error)
+        raise IOError('{count} downloads failed'.format(count=len(failures)))
 
 
 # could maybe create a CRSDownloader class and this would be a method on it?
@@ -56,12 +198,23 @@ def create_download_directory(base_dir):
     return download_dir_path
 
 
-def download_all_crs_data(base_dir):
+def download_all_crs_data(base_dir, num_threads=DEFAULT_NUM_THREADS):
     """
     Find the latest raw CRS data and download it to a subdirectory of the specified base_dir.
     Note: this method will download significant data and take significant time.
     """
     links = get_crs_download_links()
     download_dir = create_download_directory(base_dir)
-    for link in links:
-        download_csv_file(link, download_dir)
+    download_links(links, download_dir, num_threads)
+
+
+def update_crs_data(download_dir, num_threads=DEFAULT_NUM_THREADS, base_url=CRS_BASE_URL):
+    """
+    Brings a persistent download directory up to date with the latest raw CRS data,
+    only downloading files that changed since the last update (and resuming any interrupted downloads).
+    """
+    if not os.path.exists(download_dir):
+        os.makedirs(download_dir)
+
+    links = get_crs_download_links(base_url)
+    download_links(links, download_dir, num_threads)
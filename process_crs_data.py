@@ -1,14 +1,31 @@
 """
 For processing downloaded CRS data into a more manageable format
 """
+import codecs
+import hashlib
 import io
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import time
 import zipfile
+import numpy as np
 import pandas as pd
+import crs_schema
+import crs_store
 
 RAW_CRS_DELIMITER = '|'
 RAW_CRS_NUM_COLUMNS = 80
-MASTER_PICKLE_FILE_NAME = 'all_data.pkl'
+MASTER_STORE_DIR_NAME = 'all_data'
+FILTERED_STORE_DIR_NAME = 'filtered'
+# records which downloaded files a processed directory was built from, see find_changed_source_files
+SOURCE_MANIFEST_FILE_NAME = 'source_manifest.json'
+# rows read from a .psv file at a time when building the master store
+MASTER_READ_CHUNK_SIZE = 500000
+# number of (raw, utf-16) bytes read from a zipped CRS file at a time when cleaning it
+CLEANING_CHUNK_SIZE = 4 * 1024 * 1024
 
 
 def strip_additional_byte_order_marks(unicode_contents):
@@ -38,11 +55,17 @@ def clean_line_endings(unicode_contents):
     return unicode_contents.replace(u'\n', u'').replace(u'\r', u'\n')
 
 
+def count_bad_lines(lines):
+    return len([line for line in lines if len(line) > 0 and line.count(RAW_CRS_DELIMITER) != RAW_CRS_NUM_COLUMNS - 1])
+
+
+def warn_about_bad_lines(bad_line_count):
+    if bad_line_count:
+        print "Warning", bad_line_count, "bad lines found"
+
+
 def check_delimiter_counts(unicode_contents):
-    lines = unicode_contents.split('\n')
-    bad_lines = [line for line in lines if len(line) > 0 and line.count(RAW_CRS_DELIMITER) != RAW_CRS_NUM_COLUMNS - 1]
-    if bad_lines:
-        print "Warning", len(bad_lines), "bad lines found"
+    warn_about_bad_lines(count_bad_lines(unicode_contents.split('\n')))
 
 
 def clean_crs_file(raw_contents):
@@ -64,9 +87,62 @@ def clean_crs_file(raw_contents):
     return unicode_contents.encode('utf-8')
 
 
+def iter_clean_crs_chunks(raw_file, chunk_size=CLEANING_CHUNK_SIZE):
+    """
+    Streaming version of clean_crs_file: reads the (byte) contents of a raw CRS file-like object in fixed-size chunks
+    and yields "sanitized" unicode chunks.
+    The incremental decoder takes care of multi-byte characters that are split across chunks, and every cleaning step
+    works on single characters, so a "\r\n" pair that straddles two chunks still becomes a single "\n".
+    """
+    decoder = codecs.getincrementaldecoder('utf-16')()
+
+    while True:
+        raw_chunk = raw_file.read(chunk_size)
+        is_final = len(raw_chunk) == 0
+
+        unicode_chunk = decoder.decode(raw_chunk, final=is_final)
+        unicode_chunk = strip_additional_byte_order_marks(unicode_chunk)
+        unicode_chunk = strip_nulls(unicode_chunk)
+        unicode_chunk = clean_line_endings(unicode_chunk)
+
+        if unicode_chunk:
+            yield unicode_chunk
+
+        if is_final:
+            break
+
+
+def clean_crs_stream(raw_file, output_file, chunk_size=CLEANING_CHUNK_SIZE):
+    """
+    Cleans a raw CRS file-like object chunk by chunk, writing utf-8 to output_file as it goes, so that memory use
+    doesn't depend on the size of the file. Returns the number of bytes written.
+    """
+    bytes_written = 0
+    bad_line_count = 0
+    partial_line = u''  # the tail of the last chunk, which may not be a complete line yet
+
+    for unicode_chunk in iter_clean_crs_chunks(raw_file, chunk_size):
+        lines = (partial_line + unicode_chunk).split(u'\n')
+        partial_line = lines.pop()
+        bad_line_count += count_bad_lines(lines)
+
+        utf8_chunk = unicode_chunk.encode('utf-8')
+        output_file.write(utf8_chunk)
+        bytes_written += len(utf8_chunk)
+
+    bad_line_count += count_bad_lines([partial_line])
+
+    # the same sniff test as check_delimiter_counts
+    warn_about_bad_lines(bad_line_count)
+
+    return bytes_written
+
+
 def process_zip_file(zip_path, output_path):
     """
-    Unzips a downloaded CRS file and "cleans" the raw contents into a more manageable format
+    Unzips a downloaded CRS file and "cleans" the raw contents into a more manageable format.
+    The contents are streamed through the cleaner, so this runs in constant memory even for the largest files.
+    Returns the number of bytes written.
     """
     print 'Converting', zip_path, 'to', output_path
 
@@ -76,104 +152,316 @@ def process_zip_file(zip_path, output_path):
 
         inner_filename = namelist[0]
         inner_file = zipped.open(inner_filename)
-        cleaned_contents = clean_crs_file(inner_file.read())
 
         with io.open(output_path, 'wb') as output_file:
-            output_file.write(cleaned_contents)
+            return clean_crs_stream(inner_file, output_file)
 
 
-def convert_download_directory(download_dir, processed_dir):
+def timed_process_zip_file(source_and_dest_paths):
     """
-    Processes all files within a "download" directory and outputs them to a "processed" directory
+    Runs process_zip_file on a (source path, destination path) tuple, the single argument being handy for pool.imap.
+    Returns a (source path, bytes written, seconds taken) tuple.
+    """
+    source_path, dest_path = source_and_dest_paths
+
+    start_time = time.time()
+    bytes_written = process_zip_file(source_path, dest_path)
+
+    return source_path, bytes_written, time.time() - start_time
+
+
+def get_conversion_path_pairs(download_dir, processed_dir):
+    """
+    Returns (source path, destination path) tuples for all raw CRS files within a "download" directory
     """
     downloaded_files = os.listdir(download_dir)
+    path_pairs = []
     for source_file in sorted(downloaded_files):
         if source_file.startswith('CRS') and source_file.endswith('.zip'):
             source_path = os.path.join(download_dir, source_file)
             dest_path = os.path.join(processed_dir, source_file.replace(' ', '_')).replace('.zip', '.psv')
-            process_zip_file(source_path, dest_path)
+            path_pairs.append((source_path, dest_path))
+    return path_pairs
+
+
+def convert_files(path_pairs, num_workers=1):
+    """
+    Processes each (source path, destination path) pair.
+    Each file is independent of the others, so with num_workers > 1 they are converted in a pool of processes.
+    The output is the same either way.
+    """
+    start_time = time.time()
+    total_bytes = 0
+
+    pool = multiprocessing.Pool(num_workers) if num_workers > 1 else None
+    try:
+        if pool:
+            results = pool.imap_unordered(timed_process_zip_file, path_pairs)
+        else:
+            results = itertools.imap(timed_process_zip_file, path_pairs)
+
+        for source_path, bytes_written, seconds in results:
+            total_bytes += bytes_written
+            print 'Converted {path}: {bytes} bytes in {seconds:.1f}s'.format(path=source_path, bytes=bytes_written,
+                                                                          seconds=seconds)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    print 'Converted {count} files: {bytes} bytes in {seconds:.1f}s'.format(count=len(path_pairs), bytes=total_bytes,
+                                                                        seconds=time.time() - start_time)
+
+
+def convert_download_directory(download_dir, processed_dir, num_workers=1):
+    """
+    Processes all files within a "download" directory and outputs them to a "processed" directory
+    """
+    convert_files(get_conversion_path_pairs(download_dir, processed_dir), num_workers)
+
+
+def hash_file(path, chunk_size=CLEANING_CHUNK_SIZE):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(chunk_size), ''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def read_source_manifest(processed_dir):
+    """
+    Returns a map of downloaded file name -> {'sha256': content hash, 'psv': processed file name, 'years': [years]}
+    for the files a processed directory was built from (empty if there's no manifest yet)
+    """
+    manifest_path = os.path.join(processed_dir, SOURCE_MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_source_manifest(processed_dir, manifest):
+    manifest_path = os.path.join(processed_dir, SOURCE_MANIFEST_FILE_NAME)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def find_changed_source_files(download_dir, processed_dir):
+    """
+    Compares the content hashes of the files in a "download" directory with the manifest of a "processed" directory.
+    Returns the (source path, destination path) pairs of the new or changed files, and the updated manifest.
+    The years of the changed files are still the previous ones until record_processed_years is called on the manifest.
+    """
+    manifest = read_source_manifest(processed_dir)
+    changed_path_pairs = []
+
+    for source_path, dest_path in get_conversion_path_pairs(download_dir, processed_dir):
+        source_file = os.path.basename(source_path)
+        content_hash = hash_file(source_path)
+        if source_file in manifest and manifest[source_file]['sha256'] == content_hash:
+            continue
+
+        changed_path_pairs.append((source_path, dest_path))
+        previous_years = manifest[source_file]['years'] if source_file in manifest else []
+        manifest[source_file] = {'sha256': content_hash, 'psv': os.path.basename(dest_path), 'years': previous_years}
+
+    return changed_path_pairs, manifest
+
+
+def record_processed_years(processed_dir, manifest, path_pairs):
+    """
+    Reads the years present in each converted file into the manifest.
+    Returns the set of years affected by the conversion, i.e. those each file used to have as well as those it has now.
+    """
+    affected_years = set()
+    for source_path, dest_path in path_pairs:
+        entry = manifest[os.path.basename(source_path)]
+        years = sorted(int(year) for year in read_psv_file(dest_path, usecols=['Year']).Year.unique())
+        affected_years.update(entry['years'])
+        affected_years.update(years)
+        entry['years'] = years
+    return affected_years
+
+
+def get_psv_paths_for_years(processed_dir, manifest, years):
+    """
+    Returns the processed files (per the manifest) that contain rows for any of the given years
+    """
+    return [os.path.join(processed_dir, entry['psv']) for source_file, entry in sorted(manifest.iteritems())
+            if set(entry['years']) & set(years)]
+
+
+def get_crs_dtypes():
+    """
+    Returns a map of column name -> numpy dtype for reading processed CRS files, derived from CRS_COLUMN_SPEC.
+    pandas 0.12 has neither nullable integer nor categorical dtypes, so integer codes are read as float32 (exact for
+    codes and years, and able to hold NaN for the codes that are sometimes missing, like channelcode) and then
+    narrowed to int32 by compact_integer_columns wherever there turn out to be no nulls.
+    Text columns are always read as strings, rather than being guessed as numbers when they happen to look like them.
+    """
+    dtypes = {}
+    for column_name, column_type in crs_schema.CRS_COLUMN_SPEC:
+        if column_type.startswith('integer'):
+            dtypes[column_name] = np.float32
+        elif column_type.startswith('double precision'):
+            dtypes[column_name] = np.float64
+        else:
+            dtypes[column_name] = np.object_
+    return dtypes
+
+
+def get_integer_columns():
+    return [column_name for column_name, column_type in crs_schema.CRS_COLUMN_SPEC
+            if column_type.startswith('integer')]
 
 
-def build_master_file(processed_dir):
+def compact_integer_columns(dataframe):
     """
-    Concatenates the individual files into one pandas DataFrame and pickles that file back to the same directory
+    Converts the integer columns of a dataframe read with get_crs_dtypes to int32 where they have no missing values
+    """
+    for column in get_integer_columns():
+        if column in dataframe.columns and not dataframe[column].isnull().any():
+            dataframe[column] = dataframe[column].astype(np.int32)
+    return dataframe
+
+
+def read_psv_header(psv_path):
+    with io.open(psv_path, 'r', encoding='utf-8') as psv_file:
+        return psv_file.readline().rstrip('\n').split(RAW_CRS_DELIMITER)
+
+
+def read_psv_file(psv_path, usecols=None, chunksize=None):
+    """
+    Reads a processed CRS file with explicit dtypes (see get_crs_dtypes), optionally only reading the given columns.
+    Returns a DataFrame, or an iterator of DataFrames of chunksize rows if chunksize is given.
+    """
+    dtypes = get_crs_dtypes()
+    if usecols is not None:
+        dtypes = dict((column, dtype) for column, dtype in dtypes.iteritems() if column in usecols)
+
+    reader = pd.read_csv(psv_path, delimiter=RAW_CRS_DELIMITER, dtype=dtypes, usecols=usecols, chunksize=chunksize)
+
+    if chunksize is None:
+        return compact_integer_columns(reader)
+
+    return itertools.imap(compact_integer_columns, reader)
+
+
+def build_master_file(processed_dir, only_useful_columns=False):
+    """
+    Reads the individual files (in chunks) into a columnar store partitioned by year, in the same directory.
+    See crs_store for the format. Any previously built master store is replaced.
+    With only_useful_columns, the UNNECESSARY_COLUMNS are never read at all.
     """
     source_files = os.listdir(processed_dir)
     psv_files = [filename for filename in sorted(source_files) if filename.endswith(".psv")]
     psv_paths = [os.path.join(processed_dir, psv_file) for psv_file in psv_files]
-    crs_dataframes = [pd.read_csv(psv_path, delimiter=RAW_CRS_DELIMITER, low_memory=False) for psv_path in psv_paths]
-    master_frame = pd.concat(crs_dataframes, ignore_index=True)
-
-    output_path = os.path.join(processed_dir, MASTER_PICKLE_FILE_NAME)
-    master_frame.to_pickle(output_path)
-    print "Wrote", output_path
-
-
-def apply_purpose_code_filter(dataframe):
-    desired_purpose_code_prefixes =\
-        (11,  # Education
-         15,  # Government/CivilSociety
-         16,  # Other Social Infrastructure and Services
-         22,  # Communications
-         43,  # Other Multisector
-         72,  # Emergency Response
-         73,  # Reconstruction Relief and Rehabilitation
-         74,  # Disaster Prevention and Preparedness
-         99  # Unallocated
-    )
-
-    def is_desired_purpose_code(purpose_code):
-        purpose_code_prefix = purpose_code/1000
-        return purpose_code_prefix in desired_purpose_code_prefixes
-
-    return dataframe[dataframe.purposecode.apply(is_desired_purpose_code)]
-
-
-def apply_country_filter(dataframe):
-    desired_countries = ('Cambodia', 'Peru', 'Sierra Leone', 'Guatemala', 'Kenya')
-
-    return dataframe[dataframe.recipientname.apply(lambda x: x in desired_countries)]
-
-
-def apply_year_filter(dataframe):
-    # OECD puts big caveats on data before 2002 , but let's go back just a little into that period
-    return dataframe[dataframe.Year >= 2000]
-
-
-def remove_unnecessary_columns(dataframe):
-    del dataframe['environment']
-    del dataframe['pdgg']
-    del dataframe['biodiversity']
-    del dataframe['climateMitigation']
-    del dataframe['climateAdaptation']
-    del dataframe['desertification']
-    del dataframe['investmentproject']
-    del dataframe['assocfinance']
-    del dataframe['commitmentdate']
-    del dataframe['typerepayment']
-    del dataframe['numberrepayment']
-    del dataframe['interest1']
-    del dataframe['interest2']
-    del dataframe['repaydate1']
-    del dataframe['repaydate2']
-    del dataframe['grantelement']
-    del dataframe['usd_interest']
-    del dataframe['usd_outstanding']
-    del dataframe['usd_arrears_principal']
-    del dataframe['usd_arrears_interest']
-    del dataframe['usd_future_DS_principal']
-    del dataframe['usd_future_DS_interest']
-
-
-def filter_master_file(input_path, output_path):
-    master = pd.read_pickle(input_path)
-    filtered = apply_purpose_code_filter(master)
-    filtered = apply_year_filter(filtered)
+
+    output_dir = os.path.join(processed_dir, MASTER_STORE_DIR_NAME)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+
+    for psv_path in psv_paths:
+        usecols = get_useful_columns(read_psv_header(psv_path)) if only_useful_columns else None
+        for chunk in read_psv_file(psv_path, usecols=usecols, chunksize=MASTER_READ_CHUNK_SIZE):
+            crs_store.append_dataframe(output_dir, chunk)
+
+    print "Wrote", output_dir
+
+
+DESIRED_PURPOSE_CODE_PREFIXES =\
+    (11,  # Education
+     15,  # Government/CivilSociety
+     16,  # Other Social Infrastructure and Services
+     22,  # Communications
+     43,  # Other Multisector
+     72,  # Emergency Response
+     73,  # Reconstruction Relief and Rehabilitation
+     74,  # Disaster Prevention and Preparedness
+     99  # Unallocated
+)
+
+# OECD puts big caveats on data before 2002 , but let's go back just a little into that period
+FIRST_DESIRED_YEAR = 2000
+
+
+DESIRED_COUNTRIES = ('Cambodia', 'Peru', 'Sierra Leone', 'Guatemala', 'Kenya')
+
+
+def desired_purpose_code_mask(purpose_codes, purpose_code_prefixes=DESIRED_PURPOSE_CODE_PREFIXES):
+    """
+    Returns a boolean mask over an array of purpose codes, True for those whose prefix is one we're interested in
+    """
+    return np.in1d(np.asarray(purpose_codes) // 1000, purpose_code_prefixes)
+
+
+def is_desired_year(year):
+    return year >= FIRST_DESIRED_YEAR
+
+
+def apply_purpose_code_filter(dataframe, purpose_code_prefixes=DESIRED_PURPOSE_CODE_PREFIXES):
+    return dataframe[desired_purpose_code_mask(dataframe.purposecode.values, purpose_code_prefixes)]
+
+
+def apply_country_filter(dataframe, countries=DESIRED_COUNTRIES):
+    return dataframe[dataframe.recipientname.isin(countries).values]
+
+
+def apply_year_filter(dataframe, first_year=FIRST_DESIRED_YEAR):
+    return dataframe[dataframe.Year.values >= first_year]
+
+
+UNNECESSARY_COLUMNS = [
+    'environment',
+    'pdgg',
+    'biodiversity',
+    'climateMitigation',
+    'climateAdaptation',
+    'desertification',
+    'investmentproject',
+    'assocfinance',
+    'commitmentdate',
+    'typerepayment',
+    'numberrepayment',
+    'interest1',
+    'interest2',
+    'repaydate1',
+    'repaydate2',
+    'grantelement',
+    'usd_interest',
+    'usd_outstanding',
+    'usd_arrears_principal',
+    'usd_arrears_interest',
+    'usd_future_DS_principal',
+    'usd_future_DS_interest',
+]
+
+
+def get_useful_columns(columns, unnecessary_columns=UNNECESSARY_COLUMNS):
+    return [column for column in columns if column not in unnecessary_columns]
+
+
+def remove_unnecessary_columns(dataframe, unnecessary_columns=UNNECESSARY_COLUMNS):
+    for column in unnecessary_columns:
+        if column in dataframe.columns:
+            del dataframe[column]
+
+
+def filter_master_file(input_dir, output_dir):
+    """
+    Reads only the desired years, purposes and columns out of the master store and writes them to a new store
+    """
+    columns = get_useful_columns(crs_store.read_manifest(input_dir)['columns'])
+    filtered = crs_store.read_store(input_dir, columns=columns,
+                                    year_predicate=is_desired_year, purpose_predicate=desired_purpose_code_mask)
     # filtered = apply_country_filter(filtered)  # data reduction for testing
-    remove_unnecessary_columns(filtered)
 
-    filtered.to_pickle(output_path)
-    print "Wrote", output_path
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    crs_store.append_dataframe(output_dir, filtered)
+    print "Wrote", output_dir
 
 
 if __name__ == "__main__":
@@ -181,6 +469,6 @@ if __name__ == "__main__":
     processed_dir = download_dir.replace('downloads', 'processed')
 
     # os.makedirs(processed_dir)
-    # convert_download_directory(download_dir, processed_dir)
+    # convert_download_directory(download_dir, processed_dir, num_workers=multiprocessing.cpu_count())
     # build_master_file(processed_dir)
-    filter_master_file(processed_dir + MASTER_PICKLE_FILE_NAME, processed_dir + 'filtered.pkl')
+    filter_master_file(processed_dir + MASTER_STORE_DIR_NAME, processed_dir + FILTERED_STORE_DIR_NAME)
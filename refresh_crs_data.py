@@ -0,0 +1,71 @@
+"""
+For incrementally refreshing the CRS database from a new download, only re-ingesting the yearly files that changed.
+"""
+import os
+import build_crs_database
+import process_crs_data
+
+
+def iter_filtered_rows_for_years(processed_dir, manifest, years, chunksize=process_crs_data.MASTER_READ_CHUNK_SIZE):
+    """
+    Reads and filters all processed rows of the given years, from every file that has any of them,
+    yielding them chunksize rows at a time so memory use doesn't depend on the size of the files
+    """
+    for psv_path in process_crs_data.get_psv_paths_for_years(processed_dir, manifest, years):
+        usecols = process_crs_data.get_useful_columns(process_crs_data.read_psv_header(psv_path))
+        for dataframe in process_crs_data.read_psv_file(psv_path, usecols=usecols, chunksize=chunksize):
+            dataframe = dataframe[dataframe.Year.isin(years).values]
+            dataframe = process_crs_data.apply_purpose_code_filter(dataframe)
+            dataframe = process_crs_data.apply_year_filter(dataframe)
+            yield dataframe
+
+
+def refresh_crs_database(connection, download_dir, processed_dir, num_workers=1):
+    """
+    Converts the downloaded files whose contents changed since the last refresh into processed_dir, then replaces
+    the crs rows of the affected years, keeping analysts' inclusion/category decisions.
+    processed_dir is meant to be reused across refreshes, its source manifest is only updated once the database
+    changes are committed, so a failed refresh will be retried in full next time.
+    """
+    if not os.path.exists(processed_dir):
+        os.makedirs(processed_dir)
+
+    changed_path_pairs, manifest = process_crs_data.find_changed_source_files(download_dir, processed_dir)
+    if not changed_path_pairs:
+        print "No changed files in", download_dir
+        return
+
+    process_crs_data.convert_files(changed_path_pairs, num_workers)
+    affected_years = process_crs_data.record_processed_years(processed_dir, manifest, changed_path_pairs)
+    affected_years = [year for year in sorted(affected_years) if process_crs_data.is_desired_year(year)]
+
+    if affected_years:
+        # if the years have disappeared from the source data altogether, their rows are just deleted
+        dataframes = iter_filtered_rows_for_years(processed_dir, manifest, affected_years)
+
+        cursor = connection.cursor()
+        build_crs_database.replace_crs_years(cursor, dataframes, affected_years)
+        build_crs_database.record_data_version(cursor)
+        connection.commit()
+
+        # whole years were replaced, so refresh the planner statistics now rather than waiting for autovacuum
+        build_crs_database.analyze_tables(cursor, ['crs', 'crs_rollup'])
+        connection.commit()
+        cursor.close()
+
+    process_crs_data.write_source_manifest(processed_dir, manifest)
+
+
+if __name__ == "__main__":
+    host = os.environ['POSTGRES_HOST']
+    database = os.environ['POSTGRES_DB']
+    user = os.environ['POSTGRES_USER']
+    password = os.environ['POSTGRES_PASSWORD']
+
+    connection = build_crs_database.get_db_connection(host, database, user, password)
+
+    download_dir = '/home/andrew/oecd/crs/downloads/2014-01-30/'
+    processed_dir = '/home/andrew/oecd/crs/processed/incremental/'
+    refresh_crs_database(connection, download_dir, processed_dir)
+
+    connection.close()
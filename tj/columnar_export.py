@@ -0,0 +1,159 @@
+"""
+A typed, columnar binary format for exports, that analysis tools can load without re-parsing any text.
+
+An export is a compressed NumPy .npz archive. Numeric columns are stored as float64 arrays (with NaN for missing
+values, as in pandas). Text columns are stored the way Arrow stores strings: a buffer of UTF-8 bytes, an array of
+offsets into it and a mask of which values are present. Nothing has to be unpickled to read it back.
+"""
+import json
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+
+FORMAT_VERSION = 1
+COLUMNS_KEY = '__columns__'
+
+# the length of the header written at the start of each .npy file (magic string included), with room for any 1-d
+# shape so that it can be rewritten in place once the length of the array is known
+NPY_HEADER_LENGTH = 128
+
+NUMERIC_KIND = 'numeric'
+TEXT_KIND = 'text'
+
+
+def get_column_kinds(columns, column_spec):
+    """
+    Returns a map of column name to kind (numeric or text) for the columns, based on a list of
+    (column name, postgres type) pairs. Columns the spec doesn't mention (e.g. names from the code tables) are text.
+    """
+    spec_types = dict((column_name.lower(), column_type) for column_name, column_type in column_spec)
+
+    column_kinds = {}
+    for column in columns:
+        column_type = spec_types.get(column, '')
+        is_numeric = column_type.startswith('integer') or column_type.startswith('double precision')
+        column_kinds[column] = NUMERIC_KIND if is_numeric else TEXT_KIND
+
+    return column_kinds
+
+
+def encode_text_values(values):
+    """
+    Returns the (data, offsets, valid) arrays for a list of text values, any of which may be None
+    """
+    encoded_values = [value.encode('utf-8') if isinstance(value, unicode) else (value or '') for value in values]
+
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(encoded_value) for encoded_value in encoded_values])
+
+    data = np.frombuffer(''.join(encoded_values), dtype=np.uint8)
+    valid = np.array([value is not None for value in values], dtype=bool)
+
+    return data, offsets, valid
+
+
+def decode_text_values(data, offsets, valid):
+    text = data.tostring()
+    return [text[offsets[i]:offsets[i + 1]].decode('utf-8') if valid[i] else None for i in xrange(len(valid))]
+
+
+def get_npy_header(dtype, length):
+    """
+    Returns the NPY_HEADER_LENGTH bytes of the .npy (version 1.0) header of a 1-d array
+    """
+    magic = np.lib.format.magic(1, 0)
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (length,)})
+    # the header ends in a newline, and is padded out with spaces before it
+    header = header.ljust(NPY_HEADER_LENGTH - len(magic) - 2 - 1) + '\n'
+    return magic + struct.pack('<H', len(header)) + header
+
+
+class NpyFileWriter(object):
+    """
+    Writes a 1-d array to a .npy file a piece at a time, without holding it in memory.
+    The header is written with a length of 0 to start with, and rewritten by close().
+    """
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self.file = open(path, 'wb')
+        self.file.write(get_npy_header(self.dtype, 0))
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.file.write(values.tostring())
+        self.length += len(values)
+
+    def close(self):
+        self.file.seek(0)
+        self.file.write(get_npy_header(self.dtype, self.length))
+        self.file.close()
+
+
+def write_export(output_file, columns, column_kinds, row_chunks):
+    """
+    Writes rows (given as an iterable of lists of row tuples, in the order of columns) to output_file.
+    Each chunk is appended to temporary .npy files of the arrays as it arrives, so that only one chunk is held in
+    memory, and those files are then compressed into the archive one by one.
+    """
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # array name -> its NpyFileWriter, the arrays being named as np.savez names them
+        writers = {}
+
+        def add_writer(array_name, dtype):
+            writers[array_name] = NpyFileWriter(os.path.join(temp_dir, '%d.npy' % len(writers)), dtype)
+            return writers[array_name]
+
+        add_writer(COLUMNS_KEY, np.uint8).append(np.frombuffer(json.dumps(
+            {'version': FORMAT_VERSION, 'columns': columns, 'kinds': column_kinds}), dtype=np.uint8))
+
+        for column in columns:
+            if column_kinds[column] == NUMERIC_KIND:
+                add_writer(column, np.float64)
+            else:
+                add_writer(column + '.data', np.uint8)
+                add_writer(column + '.offsets', np.int64).append([0])
+                add_writer(column + '.valid', bool)
+
+        for rows in row_chunks:
+            for i, column in enumerate(columns):
+                values = [row[i] for row in rows]
+                if column_kinds[column] == NUMERIC_KIND:
+                    writers[column].append(np.array(values, dtype=np.float64))
+                else:
+                    data, offsets, valid = encode_text_values(values)
+                    # the offsets carry on from those of the chunks before
+                    writers[column + '.offsets'].append(offsets[1:] + writers[column + '.data'].length)
+                    writers[column + '.data'].append(data)
+                    writers[column + '.valid'].append(valid)
+
+        with zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for array_name, writer in writers.iteritems():
+                writer.close()
+                archive.write(writer.path, array_name + '.npy')
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def read_export(input_file):
+    """
+    Reads an export back into a pandas DataFrame, with the columns in their original order
+    """
+    archive = np.load(input_file)
+    header = json.loads(archive[COLUMNS_KEY].tostring())
+
+    data = {}
+    for column in header['columns']:
+        if header['kinds'][column] == NUMERIC_KIND:
+            data[column] = archive[column]
+        else:
+            data[column] = decode_text_values(archive[column + '.data'], archive[column + '.offsets'],
+                                              archive[column + '.valid'])
+
+    return pd.DataFrame(data, columns=header['columns'])
@@ -0,0 +1,106 @@
+"""
+A small in-process cache for data that rarely changes, like the code tables.
+"""
+import threading
+import time
+
+
+class DataCache(object):
+    """
+    Caches the results of loader functions by key, each for up to ttl seconds.
+    If a version_function is given, it is called at most every version_check_interval seconds and every entry is
+    dropped when the version it returns changes (e.g. when the database has been rebuilt).
+    """
+    def __init__(self, ttl, version_function=None, version_check_interval=60):
+        self.ttl = ttl
+        self.version_function = version_function
+        self.version_check_interval = version_check_interval
+
+        self.entries = {}
+        self.version = None
+        self.last_version_check = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self.lock = threading.RLock()
+
+    def check_version(self):
+        """
+        Calls version_function if a check is due, and drops every entry if the version has changed.
+        The version is fetched outside the lock, so that other threads carry on with the current one meanwhile.
+        """
+        if self.version_function is None:
+            return
+
+        with self.lock:
+            now = time.time()
+            if self.last_version_check is not None and now - self.last_version_check < self.version_check_interval:
+                return
+            # claims the check, no other thread starts one until the interval is up again
+            self.last_version_check = now
+            checked_version = self.version
+
+        version = self.version_function()
+
+        with self.lock:
+            # only if no other thread has moved the version on in the meantime
+            if self.version == checked_version and version != self.version:
+                self.version = version
+                if self.entries:
+                    self.invalidate()
+
+    def get_version(self):
+        """
+        Returns the current version, checking it first if a check is due
+        """
+        self.check_version()
+        with self.lock:
+            return self.version
+
+    def get(self, key, loader):
+        self.check_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        value = loader()
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+
+        return value
+
+    def peek(self, key):
+        """
+        Returns the cached value for a key, or None if there isn't a fresh one (nothing is loaded)
+        """
+        self.check_version()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return entry[1]
+
+            return None
+
+    def invalidate(self, key=None):
+        """
+        Drops one entry, or all of them if no key is given
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self.invalidations += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self.entries), 'version': self.version}
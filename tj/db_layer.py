@@ -1,8 +1,25 @@
 import pandas as pd
 import StringIO
 import collections
+import csv
+import hashlib
+import itertools
+import json
 import re
+import threading
+import time
+import uuid
+import weakref
+import zlib
+import django.conf
+import django.core.cache
 import django.db
+import django.db.backends.signals
+import django.db.transaction
+import crs_schema
+import columnar_export
+import data_cache
+import result_cache
 
 
 BASE_SQL = 'SELECT crs.*, recipient.recipientname, donor.donorname, channel.channelname, ' \
@@ -22,8 +39,68 @@ BASE_SQL = 'SELECT crs.*, recipient.recipientname, donor.donorname, channel.chan
            'LEFT OUTER JOIN tj_inclusion ON (crs.tj_inclusion_id = tj_inclusion.tj_inclusion_id) ' \
            'LEFT OUTER JOIN tj_category ON (crs.tj_category_id = tj_category.tj_category_id) '
 
+# the results pages only read the columns they show, with the names of codes looked up in the cached code tables
+# rather than joined in, and long descriptions cut short (see get_full_text for the rest)
+RESULT_PAGE_COLUMNS = ['crs_pk', 'year', 'recipientcode', 'donorcode', 'agencycode', 'channelcode', 'sectorcode',
+                       'purposecode', 'tj_inclusion_id', 'tj_category_id', 'usd_disbursement_defl', 'projecttitle',
+                       'shortdescription']
+RESULT_TEXT_PREVIEW_LENGTH = 300
+RESULT_PAGE_SQL = 'SELECT ' + ', '.join('crs.' + column for column in RESULT_PAGE_COLUMNS) + ', ' \
+                  'left(crs.longdescription, {length}) AS longdescription, ' \
+                  'coalesce(length(crs.longdescription), 0) > {length} AS longdescription_truncated ' \
+                  'FROM crs '.format(length=RESULT_TEXT_PREVIEW_LENGTH)
+# the code tables whose names are shown on the results pages (agencies are looked up by donor too)
+RESULT_CODE_TABLES = ['recipient', 'donor', 'channel', 'sector', 'purpose']
+FULL_TEXT_COLUMNS = ['projecttitle', 'shortdescription', 'longdescription']
+# the fields of a ResultRow: the columns of RESULT_PAGE_SQL, in order, then the names added by add_code_names
+RESULT_PAGE_FIELDS = RESULT_PAGE_COLUMNS + ['longdescription', 'longdescription_truncated']
+RESULT_NAME_FIELDS = [filter_type + 'name' for filter_type in RESULT_CODE_TABLES] + \
+                     ['agencyname', 'tj_inclusion_name', 'tj_category_name']
+
 ROW_LIMIT = 25
-NO_ROW_LIMIT = 10000000
+
+# rows are fetched from a server-side cursor, and written out, this many at a time when exporting
+EXPORT_FETCH_SIZE = 2000
+# zlib level for gzipped exports, trading a little size for keeping up with the database
+EXPORT_COMPRESSION_LEVEL = 6
+
+# the code tables (and tj_inclusion/tj_category) only change when the database is (re)built,
+# which records a new data version (see build_crs_database.record_data_version)
+CODE_TABLE_CACHE_TTL_SECONDS = 24 * 60 * 60
+DATA_VERSION_CHECK_SECONDS = 60
+
+# exact counts are cached until the data changes or rows are analyzed, though other processes only notice the latter
+# once their entry expires
+COUNT_CACHE_TTL_SECONDS = 10 * 60
+# queries the planner expects to match fewer rows than this are counted exactly straight away
+EXACT_COUNT_THRESHOLD = 10000
+
+# pages of results are cached in the 'results' cache shared by all workers, and the most recently used ones
+# also in each process up to this many bytes, keyed on the analysis token so that analyzing rows (in any worker)
+# moves every page on to a new key (see tj.result_cache)
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# the dimensions the analysis is summarized by, and the crs_rollup columns holding them
+AGGREGATE_DIMENSIONS = collections.OrderedDict([
+    ('inclusion', 'tj_inclusion_id'),
+    ('category', 'tj_category_id'),
+    ('year', 'year'),
+    ('recipient', 'recipientcode'),
+    ('donor', 'donorcode'),
+])
+# the breakdowns computed in one pass over crs_rollup: the inclusion/category crosstab with its marginals and
+# grand total, then inclusion by each of the other dimensions
+AGGREGATE_GROUPING_SETS = [
+    ('inclusion', 'category'), ('inclusion',), ('category',), (),
+    ('inclusion', 'year'), ('inclusion', 'recipient'), ('inclusion', 'donor'),
+]
+NO_INCLUSION_DECISION_NAME = 'No decision'
+# shared cache key of a token replaced by every analysis write, see get_analysis_aggregates
+ANALYSIS_TOKEN_KEY = 'crs_analysis_token'
+
+# text search configurations that rows' searchable_text may have been built with (crs.text_language)
+# keep in sync with build_crs_database.LANGUAGE_MARKER_WORDS
+TEXT_SEARCH_LANGUAGES = ['english', 'french', 'spanish']
 
 CSV_COLUMNS = [
     'tj_inclusion_name',
@@ -105,11 +182,119 @@ class QueryParams(object):
     def add_year_filter(self, year):
         self.yearfilters.append(year)
 
+    def get_normalized_key(self):
+        """
+        Returns a hashable key that is the same for any two QueryParams selecting the same rows,
+        whatever order their filters were added in
+        """
+        def normalize_filters(type_to_codes):
+            return tuple(sorted((filter_type, tuple(sorted(set(str(code) for code in codes))))
+                                for filter_type, codes in type_to_codes.iteritems() if codes))
+
+        search_terms = ' '.join(self.search_terms.split()) if self.search_terms else ''
+
+        return (search_terms, normalize_filters(self.codefilter_type_to_codes),
+                normalize_filters(self.customfilter_type_to_codes),
+                tuple(sorted(set(str(year) for year in self.yearfilters))))
+
+
+# how often get_db_connection checks that a persistent connection still works
+CONNECTION_CHECK_SECONDS = 30
+# the most prepared statements kept on each connection, the least recently used are deallocated first
+MAX_PREPARED_STATEMENTS = 100
+PREPARED_STATEMENT_PREFIX = 'tj_'
+
+connection_checks = threading.local()
+
+# raw (psycopg2) connection -> OrderedDict of the names of the statements prepared on it, in order of use
+prepared_statements = weakref.WeakKeyDictionary()
+
 
 def get_db_connection():
-    django.db.close_old_connections()  # otherwise it seems our connections are going stale?
+    """
+    Returns this thread's connection. Django keeps it open between requests for up to CONN_MAX_AGE seconds (see the
+    settings), outside of a transaction it is replaced once it is older than that, has failed, or fails a ping
+    (done at most every CONNECTION_CHECK_SECONDS).
+    """
+    connection = django.db.connection
+    if connection.in_atomic_block:
+        # closing it here would silently end the transaction
+        return connection
+
+    django.db.close_old_connections()
+
+    now = time.time()
+    if connection.connection is not None and \
+            now - getattr(connection_checks, 'last_check', 0) >= CONNECTION_CHECK_SECONDS:
+        if not connection.is_usable():
+            connection.close()
+        connection_checks.last_check = now
+
+    return connection
+
+
+def number_placeholders(sql):
+    """
+    Returns sql with its %s placeholders numbered ($1, $2...) as PREPARE wants them (and any %% unescaped),
+    along with the number of placeholders
+    """
+    placeholder_count = [0]
+
+    def replace_placeholder(match):
+        if match.group(1) == '%':
+            return '%'
+        placeholder_count[0] += 1
+        return '$' + str(placeholder_count[0])
+
+    return re.sub('%(s|%)', replace_placeholder, sql), placeholder_count[0]
+
+
+def force_custom_plans(sender, connection, **kwargs):
+    """
+    Has a new connection plan every execution of a prepared statement for its actual parameters, rather than letting
+    PostgreSQL switch to a generic plan after a few executions: a generic plan can't tell a rare search term (best
+    found through the text search index) from a common one (best found by walking crs_pk), nor a small code filter
+    from a large one. Statements are still only parsed once per connection.
+    """
+    if getattr(django.conf.settings, 'DB_PREPARED_STATEMENTS', True):
+        cursor = connection.connection.cursor()
+        cursor.execute('SET plan_cache_mode = force_custom_plan;')
+        cursor.close()
+
+
+django.db.backends.signals.connection_created.connect(force_custom_plans, dispatch_uid='tj_force_custom_plans')
+
+
+def execute_prepared(cursor, sql, params=()):
+    """
+    Like cursor.execute(sql, params), but through a server-side prepared statement, so that each distinct statement
+    is only parsed once per connection rather than on every request (it is still planned for each execution's
+    parameters, see force_custom_plans).
+    Meant for the fixed shapes of query (pages, counts, updates), where only the parameters change.
+    """
+    if not getattr(django.conf.settings, 'DB_PREPARED_STATEMENTS', True):
+        cursor.execute(sql, params)
+        return
+
+    raw_connection = django.db.connection.connection
+    statement_names = prepared_statements.setdefault(raw_connection, collections.OrderedDict())
+
+    sql = sql.strip().rstrip(';')
+    statement_name = PREPARED_STATEMENT_PREFIX + hashlib.sha1(sql).hexdigest()[:24]
+    numbered_sql, placeholder_count = number_placeholders(sql)
 
-    return django.db.connection
+    if statement_name in statement_names:
+        # move to the most recently used end
+        del statement_names[statement_name]
+    else:
+        if len(statement_names) >= MAX_PREPARED_STATEMENTS:
+            evicted_name = statement_names.popitem(last=False)[0]
+            cursor.execute('DEALLOCATE ' + evicted_name + ';')
+        cursor.execute('PREPARE ' + statement_name + ' AS ' + numbered_sql + ';')
+    statement_names[statement_name] = True
+
+    arguments = ' (' + ', '.join(['%s'] * placeholder_count) + ')' if placeholder_count else ''
+    cursor.execute('EXECUTE ' + statement_name + arguments + ';', list(params))
 
 
 def convert_to_tsquery(search_terms):
@@ -136,31 +321,29 @@ def generate_where_clause_and_params(query_params):
     params = []
 
     if query_params.search_terms:
-        where_clause += ' AND crs.searchable_text @@ to_tsquery(%s) '
-        params += [convert_to_tsquery(query_params.search_terms)]
+        # stem the query the same way as each row's text was stemmed, one (GIN indexable) condition per language
+        ts_query = convert_to_tsquery(query_params.search_terms)
+        # regconfig has no = of its own, without the cast the literal would be read as the oid it's compared as
+        language_conditions = ["(crs.text_language = '{language}'::regconfig AND "
+                               "crs.searchable_text @@ to_tsquery('{language}', %s))".format(language=language)
+                               for language in TEXT_SEARCH_LANGUAGES]
+        where_clause += ' AND (' + ' OR '.join(language_conditions) + ') '
+        params += [ts_query] * len(TEXT_SEARCH_LANGUAGES)
 
     # do an OR across all filters of a given filtertype, and then an AND across filter types
     # TODO fancier logic to properly handle agencies
     # TODO fancier logic to handle null channels
-    for filter_type, codes in query_params.codefilter_type_to_codes.iteritems():
-        column = 'crs.' + filter_type + 'code'
-
-        code_strings = [str(code) for code in codes]
-
-        # could use sql params here but if we make the assumption that these are ints we should be okay
-        # (for a commercial website we'd want to have sanitized these)
-        where_clause += ' AND ' + column + ' IN (' + ','.join(code_strings) + ') '
+    for filter_type, codes in sorted(query_params.codefilter_type_to_codes.iteritems()):
+        where_clause += ' AND crs.' + filter_type + 'code = ANY(%s) '
+        params.append([int(code) for code in codes])
 
-    for filter_type, codes in query_params.customfilter_type_to_codes.iteritems():
-        column = 'crs.tj_' + filter_type + '_id'
-
-        code_strings = [str(code) for code in codes]
-
-        # could use sql params here but ints are pretty safe to just write in explicitly
-        where_clause += ' AND ' + column + ' IN (' + ','.join(code_strings) + ') '
+    for filter_type, codes in sorted(query_params.customfilter_type_to_codes.iteritems()):
+        where_clause += ' AND crs.tj_' + filter_type + '_id = ANY(%s) '
+        params.append([int(code) for code in codes])
 
     if query_params.yearfilters:
-        where_clause += ' AND crs.year IN (' + ','.join(query_params.yearfilters) + ') '
+        where_clause += ' AND crs.year = ANY(%s) '
+        params.append([int(year) for year in query_params.yearfilters])
 
     return where_clause, params
 
@@ -174,66 +357,404 @@ def generate_where_clause_and_params_for_unanalyzed_data(query_params):
     return where_clause, params
 
 
-def get_matching_rows_for_query(query_params):
-    where_clause, params = generate_where_clause_and_params_for_unanalyzed_data(query_params)
+class ResultRow(object):
+    """
+    One row of a results page, with the RESULT_PAGE_FIELDS and RESULT_NAME_FIELDS as attributes.
+    Building these straight from the cursor's tuples (and reading them in the templates) is far cheaper than going
+    through a DataFrame and iterrows for a page of rows; pandas is kept for the bulk paths like exports.
+    """
+    __slots__ = RESULT_PAGE_FIELDS + RESULT_NAME_FIELDS
 
-    # could possibly accomplish this by only reading however many rows from the cursor?
-    # that's likely slower though, and then integrating with pandas might be a pain
-    limit_clause = 'ORDER BY crs.crs_pk LIMIT {row_limit};'.format(row_limit=ROW_LIMIT)
+    def __init__(self, values):
+        # any fields without a value (normally the names) start as None
+        for field, value in itertools.izip_longest(self.__slots__, values):
+            setattr(self, field, value)
 
-    return pd.read_sql(BASE_SQL + where_clause + limit_clause, get_db_connection(), index_col="crs_pk", params=params)
 
+def get_page_of_rows(where_clause, params, after_pk=None, before_pk=None):
+    """
+    Returns a page of (up to ROW_LIMIT) ResultRows matching a where clause, in crs_pk order,
+    seeking on crs_pk rather than using OFFSET, so that every page costs the same however deep it is.
+    By default this is the first page, otherwise the page following after_pk or the page preceding before_pk.
+    """
+    params = list(params)
 
-def get_count_of_matching_rows_for_query(query_params):
-    where_clause, params = generate_where_clause_and_params_for_unanalyzed_data(query_params)
+    order = 'ASC'
+    if after_pk is not None:
+        where_clause += ' AND crs.crs_pk > %s '
+        params.append(int(after_pk))
+    elif before_pk is not None:
+        # read backwards from before_pk, then flip the rows back into ascending order below
+        where_clause += ' AND crs.crs_pk < %s '
+        params.append(int(before_pk))
+        order = 'DESC'
+
+    limit_clause = 'ORDER BY crs.crs_pk {order} LIMIT {row_limit};'.format(order=order, row_limit=ROW_LIMIT)
+
+    cursor = get_db_connection().cursor()
+    execute_prepared(cursor, RESULT_PAGE_SQL + where_clause + limit_clause, params)
+    rows = [ResultRow(values) for values in cursor.fetchall()]
+    cursor.close()
 
+    if order == 'DESC':
+        rows.reverse()
+
+    add_code_names(rows)
+    return rows
+
+
+def get_exact_count_of_rows(where_clause, params):
+    """
+    Counts the rows matching a where clause, directly on crs without any of the joins of BASE_SQL
+    """
     count_sql = 'SELECT count(*) FROM crs ' + where_clause
 
     cursor = get_db_connection().cursor()
-    cursor.execute(count_sql, params)
+    execute_prepared(cursor, count_sql, params)
     rowcount = int(cursor.fetchone()[0])
     cursor.close()
 
     return rowcount
 
 
-def get_rows_for_analyzed_data(query_params, additional_where_condition):
+def get_estimated_count_of_rows(where_clause, params):
+    """
+    Returns the planner's estimate of the number of rows matching a where clause, which costs no more than planning
+    """
+    cursor = get_db_connection().cursor()
+    cursor.execute('EXPLAIN (FORMAT JSON) SELECT 1 FROM crs ' + where_clause, params)
+    plan = cursor.fetchone()[0]
+    cursor.close()
+
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def add_code_names(rows):
+    """
+    Fills in the names that BASE_SQL would have joined in, for a list of ResultRows
+    """
+    code_name_maps = [(filter_type + 'code', filter_type + 'name', get_code_name_map(filter_type))
+                      for filter_type in RESULT_CODE_TABLES]
+    code_name_maps.append(('tj_inclusion_id', 'tj_inclusion_name',
+                           get_name_map(get_all_inclusion_rows(as_filter=True))))
+    code_name_maps.append(('tj_category_id', 'tj_category_name', get_name_map(get_all_category_rows(as_filter=True))))
+    agency_names = get_agency_name_map()
+
+    for row in rows:
+        for code_field, name_field, name_map in code_name_maps:
+            setattr(row, name_field, name_map.get(getattr(row, code_field)))
+        row.agencyname = agency_names.get((row.donorcode, row.agencycode))
+
+
+def get_full_text(crs_pk):
+    """
+    Returns a map of each of FULL_TEXT_COLUMNS to its untruncated text for one row, or None if there's no such row
+    """
+    cursor = get_db_connection().cursor()
+    execute_prepared(cursor, 'SELECT ' + ', '.join(FULL_TEXT_COLUMNS) + ' FROM crs WHERE crs_pk = %s;', [int(crs_pk)])
+    row = cursor.fetchone()
+    cursor.close()
+
+    return dict(zip(FULL_TEXT_COLUMNS, row)) if row else None
+
+
+def get_count_of_rows(where_clause, params, count_key, exact=False):
+    """
+    Returns a (count, is_exact) pair for the rows matching a where clause.
+    Exact counts are cached under count_key. When none is cached, and unless exact is True, broad queries get the
+    planner's estimate instead, as counting them exactly can cost more than fetching a page of them.
+    """
+    # analyzing rows changes the counts, in every worker, so they are kept per analysis token
+    analysis_token = get_analysis_token()
+    if analysis_token != counted_analysis_token[0]:
+        count_cache.invalidate()
+        counted_analysis_token[0] = analysis_token
+    count_key = (analysis_token, count_key)
+
+    count = count_cache.peek(count_key)
+    if count is not None:
+        return count, True
+
+    if not exact:
+        estimated_count = get_estimated_count_of_rows(where_clause, params)
+        if estimated_count >= EXACT_COUNT_THRESHOLD:
+            return estimated_count, False
+
+    return count_cache.get(count_key, lambda: get_exact_count_of_rows(where_clause, params)), True
+
+
+def get_cached_page_of_rows(page_name, query_params, where_clause, params, after_pk=None, before_pk=None):
+    """
+    get_page_of_rows, through the result cache. page_name tells apart the different sets of rows (e.g. unanalyzed
+    or excluded) that query_params can be applied to.
+    """
+    after_pk = int(after_pk) if after_pk is not None else None
+    before_pk = int(before_pk) if before_pk is not None else None
+    # the token is read before the rows are, so a write landing while they're read leaves them under the old one
+    key = [page_name, get_cached_data_version(), get_analysis_token(), query_params.get_normalized_key(), after_pk,
+           before_pk]
+
+    return page_cache.get(key, lambda: get_page_of_rows(where_clause, params, after_pk, before_pk))
+
+
+def get_matching_rows_for_query(query_params, after_pk=None, before_pk=None):
+    where_clause, params = generate_where_clause_and_params_for_unanalyzed_data(query_params)
+    return get_cached_page_of_rows('unanalyzed', query_params, where_clause, params, after_pk, before_pk)
+
+
+def get_count_of_matching_rows_for_query(query_params, exact=False):
+    where_clause, params = generate_where_clause_and_params_for_unanalyzed_data(query_params)
+    return get_count_of_rows(where_clause, params, ('unanalyzed', query_params.get_normalized_key()), exact)
+
+
+# conditions selecting the rows of each of the "review" pages
+TJ_DATASET_CONDITION = '(crs.tj_inclusion_id > 0)'
+INCLUDED_BUT_UNCATEGORIZED_CONDITION = '((crs.tj_inclusion_id > 0) AND (crs.tj_category_id = 0))'
+CATEGORIZED_BUT_NO_INCLUSION_DECISION_CONDITION = '((crs.tj_inclusion_id IS NULL) AND (crs.tj_category_id != 0))'
+EXCLUDED_CONDITION = '(crs.tj_inclusion_id = 0)'
+
+
+def generate_where_clause_and_params_for_analyzed_data(query_params, additional_where_condition):
     where_clause, params = generate_where_clause_and_params(query_params)
     where_clause += ' AND ' + additional_where_condition
 
-    order_clause = ' ORDER BY crs.crs_pk;'
+    return where_clause, params
 
-    return pd.read_sql(BASE_SQL + where_clause + order_clause, get_db_connection(), index_col="crs_pk", params=params)
 
+def get_page_of_analyzed_rows(query_params, additional_where_condition, after_pk=None, before_pk=None):
+    where_clause, params = generate_where_clause_and_params_for_analyzed_data(query_params, additional_where_condition)
+    return get_cached_page_of_rows(additional_where_condition, query_params, where_clause, params, after_pk, before_pk)
 
-def get_tj_dataset_rows(query_params=QueryParams(None)):
-    return get_rows_for_analyzed_data(query_params, '(crs.tj_inclusion_id > 0)')
 
+def get_count_of_analyzed_rows(query_params, additional_where_condition, exact=False):
+    where_clause, params = generate_where_clause_and_params_for_analyzed_data(query_params, additional_where_condition)
+    count_key = (additional_where_condition, query_params.get_normalized_key())
+    return get_count_of_rows(where_clause, params, count_key, exact)
 
-def get_included_but_uncategorized_rows(query_params):
-    return get_rows_for_analyzed_data(query_params, '((crs.tj_inclusion_id > 0) AND (crs.tj_category_id = 0))')
 
+def format_value_for_csv(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, float):
+        # str() would round to 12 significant digits
+        return repr(value)
+    return value
 
-def get_categorized_but_no_inclusion_decision_rows(query_params):
-    return get_rows_for_analyzed_data(query_params, '((crs.tj_inclusion_id IS NULL) AND (crs.tj_category_id != 0))')
 
+def iter_export_row_chunks(query_params, additional_where_condition=TJ_DATASET_CONDITION,
+                           fetch_size=EXPORT_FETCH_SIZE):
+    """
+    Yields the analyzed rows matching the query (as tuples of CSV_COLUMNS values) in lists of up to fetch_size rows.
+    Rows are read through a server-side cursor, so memory use doesn't depend on how many rows there are.
+    """
+    where_clause, params = generate_where_clause_and_params_for_analyzed_data(query_params, additional_where_condition)
+    sql = 'SELECT ' + ', '.join(CSV_COLUMNS) + ' FROM (' + BASE_SQL + where_clause + ') AS export_rows ' \
+          'ORDER BY crs_pk;'
 
-def get_excluded_rows(query_params):
-    return get_rows_for_analyzed_data(query_params, '(crs.tj_inclusion_id = 0)')
+    # a named (server-side) cursor only lives as long as its transaction
+    connection = get_db_connection()
+    with django.db.transaction.atomic():
+        cursor = connection.connection.cursor(name='crs_export')
+        try:
+            cursor.execute(sql, params)
+
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
 
 
-def convert_to_csv_string_for_export(dataframe):
+def iter_csv_export(query_params, additional_where_condition=TJ_DATASET_CONDITION, fetch_size=EXPORT_FETCH_SIZE):
     """
-    Get a string containing a CSV representation of pandas rows.
-    Maybe belongs more in the view code directly but nice to keep pandas code all in one file.
+    Yields a CSV export (with a header row, and CSV_COLUMNS in order) of the analyzed rows matching the query,
+    as chunks of text of fetch_size rows each
     """
-    dataframe = dataframe[CSV_COLUMNS]
-
     stringio = StringIO.StringIO()
+    writer = csv.writer(stringio)
+
+    def take_chunk():
+        chunk = stringio.getvalue()
+        stringio.seek(0)
+        stringio.truncate()
+        return chunk
+
+    writer.writerow(CSV_COLUMNS)
+    yield take_chunk()
+
+    for rows in iter_export_row_chunks(query_params, additional_where_condition, fetch_size):
+        writer.writerows([format_value_for_csv(value) for value in row] for row in rows)
+        yield take_chunk()
+
+
+def iter_gzipped(chunks, compression_level=EXPORT_COMPRESSION_LEVEL):
+    """
+    Compresses chunks of bytes into a gzip stream as they come
+    """
+    # the extra 16 in wbits asks zlib for a gzip header and trailer
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if compressed_chunk:
+            yield compressed_chunk
+
+    yield compressor.flush()
+
+
+def write_columnar_export(output_file, query_params, additional_where_condition=TJ_DATASET_CONDITION):
+    """
+    Writes the analyzed rows matching the query to output_file in the typed format of tj.columnar_export,
+    numeric columns being those that CRS_COLUMN_SPEC says are numeric
+    """
+    column_kinds = columnar_export.get_column_kinds(CSV_COLUMNS, crs_schema.CRS_COLUMN_SPEC)
+    row_chunks = iter_export_row_chunks(query_params, additional_where_condition)
+    columnar_export.write_export(output_file, CSV_COLUMNS, column_kinds, row_chunks)
+
+
+def get_grouping_mask(grouping_set):
+    """
+    Returns what GROUPING() over all of AGGREGATE_DIMENSIONS gives for the rows of a grouping set:
+    a bit for each dimension that is aggregated away, with the first dimension as the highest bit
+    """
+    dimensions = AGGREGATE_DIMENSIONS.keys()
+    return sum(1 << (len(dimensions) - 1 - i) for i, dimension in enumerate(dimensions)
+               if dimension not in grouping_set)
+
+
+def load_analysis_aggregates():
+    """
+    Counts rows and sums usd_disbursement_defl for each of AGGREGATE_GROUPING_SETS, all in one GROUPING SETS query
+    over crs_rollup (which is far smaller than crs).
+    Returns a list of {'dimensions': [...], 'rows': [...]} breakdowns in the same order, each row having a value for
+    each of the breakdown's dimensions (None meaning no inclusion decision), a count and a usd_disbursement_defl.
+    """
+    dimensions = AGGREGATE_DIMENSIONS.keys()
+    columns = AGGREGATE_DIMENSIONS.values()
+    grouping_sets_sql = ', '.join('(' + ', '.join(AGGREGATE_DIMENSIONS[dimension] for dimension in grouping_set) + ')'
+                                  for grouping_set in AGGREGATE_GROUPING_SETS)
+
+    # analysis can leave crs_rollup groups empty rather than deleting them, hence the HAVING
+    sql = 'SELECT ' + ', '.join(columns) + ', GROUPING(' + ', '.join(columns) + '), ' \
+          'sum(row_count), sum(usd_disbursement_defl) ' \
+          'FROM crs_rollup GROUP BY GROUPING SETS (' + grouping_sets_sql + ') ' \
+          'HAVING sum(row_count) > 0;'
+
+    cursor = get_db_connection().cursor()
+    cursor.execute(sql)
+    result_rows = cursor.fetchall()
+    cursor.close()
+
+    mask_to_rows = dict((get_grouping_mask(grouping_set), []) for grouping_set in AGGREGATE_GROUPING_SETS)
+    for result_row in result_rows:
+        row = dict((dimension, result_row[i]) for i, dimension in enumerate(dimensions)
+                   if not result_row[len(dimensions)] & (1 << (len(dimensions) - 1 - i)))
+        row['count'] = int(result_row[len(dimensions) + 1])
+        row['usd_disbursement_defl'] = float(result_row[len(dimensions) + 2])
+        mask_to_rows[result_row[len(dimensions)]].append(row)
+
+    return [{'dimensions': list(grouping_set),
+             'rows': sorted(mask_to_rows[get_grouping_mask(grouping_set)],
+                            key=lambda row: [row[dimension] for dimension in grouping_set])}
+            for grouping_set in AGGREGATE_GROUPING_SETS]
+
+
+def get_aggregate_dimension_names():
+    """
+    Returns a map of dimension to a map of code to name, from the (cached) code tables
+    """
+    inclusion_names = dict(get_name_map(get_all_inclusion_rows(as_filter=True)))
+    inclusion_names[None] = NO_INCLUSION_DECISION_NAME
+
+    return {'inclusion': inclusion_names,
+            'category': get_name_map(get_all_category_rows(as_filter=True)),
+            'recipient': get_code_name_map('recipient'),
+            'donor': get_code_name_map('donor')}
+
+
+def get_analysis_aggregates():
+    """
+    Returns the breakdowns of load_analysis_aggregates, with a name alongside each code (e.g. recipient_name).
+    They are kept in the shared cache until the data changes or anything is analyzed, in any worker.
+    """
+    # read the token before the rows, so that an analysis write landing in between isn't hidden
+    analysis_token = get_analysis_token()
+
+    cache_key = 'crs_aggregates:' + hashlib.sha1(json.dumps([get_cached_data_version(), analysis_token])).hexdigest()
+    aggregates = results_cache_backend.get(cache_key)
+    if aggregates is None:
+        aggregates = load_analysis_aggregates()
+        results_cache_backend.set(cache_key, aggregates)
+
+    dimension_names = get_aggregate_dimension_names()
+    for breakdown in aggregates:
+        for row in breakdown['rows']:
+            for dimension in breakdown['dimensions']:
+                if dimension in dimension_names:
+                    row[dimension + '_name'] = dimension_names[dimension].get(row[dimension])
+
+    return aggregates
+
+
+def get_data_version():
+    """
+    Returns the version recorded by the last database build, or None if there isn't one
+    """
+    cursor = get_db_connection().cursor()
+    try:
+        # in a savepoint of its own, so that a missing table doesn't abort a surrounding transaction
+        with django.db.transaction.atomic():
+            cursor.execute('SELECT data_version FROM crs_data_version;')
+            row = cursor.fetchone()
+    except django.db.DatabaseError:
+        # a database built before versions were recorded
+        return None
+    finally:
+        cursor.close()
+
+    return row[0] if row else None
+
+
+code_table_cache = data_cache.DataCache(CODE_TABLE_CACHE_TTL_SECONDS, get_data_version, DATA_VERSION_CHECK_SECONDS)
+
+
+count_cache = data_cache.DataCache(COUNT_CACHE_TTL_SECONDS, get_data_version, DATA_VERSION_CHECK_SECONDS)
+
+
+# the analysis token the entries of count_cache were counted under
+counted_analysis_token = [None]
+
+
+def get_count_cache_stats():
+    return count_cache.get_stats()
+
+
+# shared by all the workers on a server
+results_cache_backend = django.core.cache.get_cache('results')
+
+page_cache = result_cache.ResultCache(results_cache_backend, RESULT_CACHE_MAX_BYTES)
+
+
+def get_page_cache_stats():
+    return page_cache.get_stats()
+
+
+def get_cached_data_version():
+    """
+    Like get_data_version, but only goes to the database every DATA_VERSION_CHECK_SECONDS
+    """
+    return code_table_cache.get_version()
 
-    dataframe.to_csv(stringio, index=False, encoding='utf-8')
 
-    return stringio.getvalue()
+def get_code_table_cache_stats():
+    return code_table_cache.get_stats()
 
 
 def get_all_rows_from_table(tablename):
@@ -242,12 +763,9 @@ def get_all_rows_from_table(tablename):
 
 def standardize_columns_for_filter(rows, code_column, name_column):
     return rows.rename(columns={code_column: 'code', name_column: 'name'})
-    
 
-def get_all_name_code_pairs(filtertype):
-    """
-    Returns a dataframe containing ___code/___name pairs.
-    """
+
+def load_all_name_code_pairs(filtertype):
     rows = get_all_rows_from_table(filtertype)
 
     code_column = filtertype + 'code'
@@ -257,22 +775,61 @@ def get_all_name_code_pairs(filtertype):
     return standardize_columns_for_filter(rows, code_column, name_column)
 
 
-def get_all_inclusion_rows(as_filter=False):
+def get_all_name_code_pairs(filtertype):
     """
-    Returns a dataframe of the tj_inclusion table.
+    Returns a dataframe containing ___code/___name pairs.
+    """
+    return code_table_cache.get(('name_code_pairs', filtertype), lambda: load_all_name_code_pairs(filtertype))
+
+
+def get_name_pairs(filter_rows):
+    """
+    Returns a list of (code, name) tuples of the rows of a filter (see standardize_columns_for_filter), in order
+    """
+    return zip(filter_rows['code'].tolist(), filter_rows['name'].tolist())
+
+
+def get_name_map(filter_rows):
+    """
+    Returns a dict of code to name for the rows of a filter (see standardize_columns_for_filter)
+    """
+    return dict(get_name_pairs(filter_rows))
+
+
+def get_code_name_map(filtertype):
+    return code_table_cache.get(('name_map', filtertype), lambda: get_name_map(get_all_name_code_pairs(filtertype)))
+
+
+def load_agency_name_map():
+    rows = get_all_rows_from_table('agency')
+    return dict(((donorcode, agencycode), agencyname) for donorcode, agencycode, agencyname
+                in zip(rows['donorcode'].tolist(), rows['agencycode'].tolist(), rows['agencyname'].tolist()))
+
+
+def get_agency_name_map():
     """
+    Returns a dict of (donorcode, agencycode) to agency name
+    """
+    return code_table_cache.get('agency_name_map', load_agency_name_map)
+
+
+def load_all_inclusion_rows(as_filter):
     rows = get_all_rows_from_table('tj_inclusion')
-    
+
     if as_filter:
         return standardize_columns_for_filter(rows, code_column='tj_inclusion_id', name_column='tj_inclusion_name')
     else:
         return rows
 
 
-def get_all_category_rows(as_filter=False):
+def get_all_inclusion_rows(as_filter=False):
     """
-    Returns a dataframe of the tj_category table.
+    Returns a dataframe of the tj_inclusion table.
     """
+    return code_table_cache.get(('inclusion', as_filter), lambda: load_all_inclusion_rows(as_filter))
+
+
+def load_all_category_rows(as_filter):
     rows = get_all_rows_from_table('tj_category')
 
     if as_filter:
@@ -281,35 +838,198 @@ def get_all_category_rows(as_filter=False):
         return rows
 
 
-def get_years_as_filter_rows():
+def get_all_category_rows(as_filter=False):
     """
-    This could be a db query, but we'll just fake it for now
+    Returns a dataframe of the tj_category table.
+    """
+    return code_table_cache.get(('category', as_filter), lambda: load_all_category_rows(as_filter))
+
+
+def get_inclusion_name_pairs():
+    """
+    Returns a list of (tj_inclusion_id, tj_inclusion_name) tuples, for the templates to loop over
+    """
+    return code_table_cache.get('inclusion_name_pairs', lambda: get_name_pairs(get_all_inclusion_rows(as_filter=True)))
+
+
+def get_category_name_pairs():
+    """
+    Returns a list of (tj_category_id, tj_category_name) tuples, for the templates to loop over
     """
+    return code_table_cache.get('category_name_pairs', lambda: get_name_pairs(get_all_category_rows(as_filter=True)))
+
+
+def load_years_as_filter_rows():
     years = range(2000, 2014)
     return pd.DataFrame({'code': years, 'name': years})
 
 
-def update_inclusions(inclusion_actions):
-    sql = 'UPDATE crs SET tj_inclusion_id=%(tj_inclusion_id)s WHERE crs_pk=%(crs_pk)s;'
+def get_years_as_filter_rows():
+    """
+    This could be a db query, but we'll just fake it for now
+    """
+    return code_table_cache.get('years', load_years_as_filter_rows)
 
-    connection = get_db_connection()
-    cursor = connection.cursor()
 
-    for crs_pk, tj_inclusion_id in inclusion_actions.iteritems():
-        cursor.execute(sql, {'tj_inclusion_id': tj_inclusion_id, 'crs_pk': crs_pk})
+def get_analysis_update_sql(where_clause, set_clauses):
+    """
+    Builds a statement that applies set_clauses (to tj_inclusion_id and/or tj_category_id) to the crs rows matching
+    a where clause, and moves each updated row's count and amounts from its old crs_rollup group to its new one.
+    It returns the crs_pks updated, and takes the where clause's params followed by those of the set clauses.
+    """
+    key_columns = crs_schema.ROLLUP_KEY_COLUMNS
+    sum_columns = crs_schema.ROLLUP_SUM_COLUMNS
+    analysis_columns = ['tj_inclusion_id', 'tj_category_id']
+
+    returning_columns = ['crs.crs_pk'] + ['crs.' + column for column in key_columns + sum_columns] + \
+                        ['old_rows.{column} AS old_{column}'.format(column=column) for column in analysis_columns]
+    old_key_columns = [('old_' + column if column in analysis_columns else column) + ' AS ' + column
+                       for column in key_columns]
+
+    # a row leaving a group, then the same row joining its new group (which may be the same one)
+    old_deltas_sql = 'SELECT ' + ', '.join(old_key_columns) + ', -1 AS row_count, ' + \
+                     ', '.join('-coalesce({column}, 0) AS {column}'.format(column=column) for column in sum_columns) + \
+                     ' FROM updated_rows'
+    new_deltas_sql = 'SELECT ' + ', '.join(key_columns) + ', 1 AS row_count, ' + \
+                     ', '.join('coalesce({column}, 0) AS {column}'.format(column=column) for column in sum_columns) + \
+                     ' FROM updated_rows'
+
+    upsert_sql = 'INSERT INTO crs_rollup ({key_columns}, row_count, {sum_columns}) ' \
+                 'SELECT {key_columns}, sum(row_count), {summed_columns} FROM rollup_deltas GROUP BY {key_columns} ' \
+                 'ON CONFLICT {conflict_target} DO UPDATE SET {updates}'.format(
+                     key_columns=', '.join(key_columns), sum_columns=', '.join(sum_columns),
+                     summed_columns=', '.join('sum({column})'.format(column=column) for column in sum_columns),
+                     conflict_target=crs_schema.ROLLUP_CONFLICT_TARGET,
+                     updates=', '.join('{column} = crs_rollup.{column} + EXCLUDED.{column}'.format(column=column)
+                                       for column in ['row_count'] + sum_columns))
+
+    # FOR UPDATE makes concurrent writers queue up, so that each sees the values the other left behind
+    return 'WITH old_rows AS (SELECT crs.crs_pk, crs.tj_inclusion_id, crs.tj_category_id FROM crs ' + \
+           where_clause + ' FOR UPDATE), ' \
+           'updated_rows AS (UPDATE crs SET ' + ', '.join(set_clauses) + ' FROM old_rows ' \
+           'WHERE crs.crs_pk = old_rows.crs_pk RETURNING ' + ', '.join(returning_columns) + '), ' \
+           'rollup_deltas AS (' + old_deltas_sql + ' UNION ALL ' + new_deltas_sql + '), ' \
+           'rollup_upsert AS (' + upsert_sql + ') ' \
+           'SELECT crs_pk FROM updated_rows;'
+
+
+def update_analysis_columns(cursor, where_clause, params, set_clauses, set_params):
+    """
+    Runs the statement of get_analysis_update_sql, returning the set of crs_pks updated
+    """
+    execute_prepared(cursor, get_analysis_update_sql(where_clause, set_clauses), list(params) + list(set_params))
+    return set(row[0] for row in cursor.fetchall())
 
-    connection.commit()
-    cursor.close()
 
+def update_column_by_pk(cursor, column, actions):
+    """
+    Sets a column of crs to the value given for each crs_pk in actions, with one UPDATE per distinct value.
+    Returns the set of crs_pks updated.
+    """
+    value_to_pks = collections.defaultdict(list)
+    for crs_pk, value in actions.iteritems():
+        value_to_pks[value].append(int(crs_pk))
 
-def update_categories(category_actions):
-    sql = 'UPDATE crs SET tj_category_id=%(tj_category_id)s WHERE crs_pk=%(crs_pk)s;'
+    updated_pks = set()
+    for value, crs_pks in value_to_pks.iteritems():
+        updated_pks |= update_analysis_columns(cursor, 'WHERE crs.crs_pk = ANY(%s)', [crs_pks],
+                                               [column + '=%s'], [value])
 
-    connection = get_db_connection()
-    cursor = connection.cursor()
+    return updated_pks
 
-    for crs_pk, tj_category_id in category_actions.iteritems():
-        cursor.execute(sql, {'tj_category_id': tj_category_id, 'crs_pk': crs_pk})
 
-    connection.commit()
-    cursor.close()
+def get_analysis_token():
+    """
+    Returns the token that is replaced (in the shared cache) whenever rows are analyzed, by any worker
+    """
+    analysis_token = results_cache_backend.get(ANALYSIS_TOKEN_KEY)
+    if analysis_token is None:
+        results_cache_backend.add(ANALYSIS_TOKEN_KEY, uuid.uuid4().hex, None)
+        analysis_token = results_cache_backend.get(ANALYSIS_TOKEN_KEY)
+
+    return analysis_token
+
+
+def invalidate_analyzed_rows():
+    # analyzing rows moves them between the unanalyzed and review queries, the cached counts and pages of every
+    # worker are keyed on the token
+    count_cache.invalidate()
+    results_cache_backend.set(ANALYSIS_TOKEN_KEY, uuid.uuid4().hex, None)
+
+
+def get_analysis_id(column, value):
+    """
+    Returns value as an int if it is one of the ids of column (tj_inclusion_id or tj_category_id), or None if it is
+    None and the column is tj_inclusion_id (taking back a decision). Otherwise raises ValueError, rather than leaving
+    the update to fail on the foreign key or on the NOT NULL tj_category_id (whose "none" is 0).
+    """
+    if value is None:
+        if column != 'tj_inclusion_id':
+            raise ValueError(column + ' can\'t be null')
+        return None
+
+    value = int(value)
+    rows = get_all_inclusion_rows() if column == 'tj_inclusion_id' else get_all_category_rows()
+    if value not in set(rows[column].tolist()):
+        raise ValueError('{value} is not a {column}'.format(value=value, column=column))
+
+    return value
+
+
+def update_analysis(inclusion_actions, category_actions):
+    """
+    Applies maps of crs_pk to tj_inclusion_id and to tj_category_id in a single transaction,
+    along with the matching changes to crs_rollup. Returns the number of rows updated.
+    Raises ValueError if any of the crs_pks or ids isn't valid, before anything is updated.
+    """
+    inclusion_actions = dict((int(crs_pk), get_analysis_id('tj_inclusion_id', value))
+                             for crs_pk, value in inclusion_actions.iteritems())
+    category_actions = dict((int(crs_pk), get_analysis_id('tj_category_id', value))
+                            for crs_pk, value in category_actions.iteritems())
+
+    with django.db.transaction.atomic():
+        cursor = get_db_connection().cursor()
+        updated_pks = update_column_by_pk(cursor, 'tj_inclusion_id', inclusion_actions)
+        updated_pks |= update_column_by_pk(cursor, 'tj_category_id', category_actions)
+        cursor.close()
+
+    invalidate_analyzed_rows()
+
+    return len(updated_pks)
+
+
+def update_analysis_for_rows(where_clause, params, tj_inclusion_id=None, tj_category_id=None):
+    """
+    Sets the tj_inclusion_id and/or tj_category_id (whichever aren't None) of every row matching a where clause,
+    and updates crs_rollup to match, in one statement. Returns the number of rows updated.
+    Raises ValueError if either id isn't valid (see get_analysis_id).
+    """
+    set_clauses = []
+    set_params = []
+    for column, value in (('tj_inclusion_id', tj_inclusion_id), ('tj_category_id', tj_category_id)):
+        if value is not None:
+            set_clauses.append(column + '=%s')
+            set_params.append(get_analysis_id(column, value))
+
+    if not set_clauses:
+        return 0
+
+    with django.db.transaction.atomic():
+        cursor = get_db_connection().cursor()
+        updated_pks = update_analysis_columns(cursor, where_clause, params, set_clauses, set_params)
+        cursor.close()
+
+    invalidate_analyzed_rows()
+
+    return len(updated_pks)
+
+
+def update_analysis_for_query(query_params, tj_inclusion_id=None, tj_category_id=None):
+    where_clause, params = generate_where_clause_and_params_for_unanalyzed_data(query_params)
+    return update_analysis_for_rows(where_clause, params, tj_inclusion_id, tj_category_id)
+
+
+def update_analysis_for_analyzed_rows(query_params, additional_where_condition, tj_inclusion_id=None,
+                                      tj_category_id=None):
+    where_clause, params = generate_where_clause_and_params_for_analyzed_data(query_params, additional_where_condition)
+    return update_analysis_for_rows(where_clause, params, tj_inclusion_id, tj_category_id)
@@ -0,0 +1,58 @@
+"""
+An in-memory index over the code/name pairs of one filter, for the filter option typeahead.
+Prefix lookups are a binary search over the sorted names. The code tables only hold a few thousand names, so
+substring lookups just scan them.
+"""
+import bisect
+
+PREFIX_MATCH = 'prefix'
+SUBSTRING_MATCH = 'substring'
+MATCH_TYPES = (PREFIX_MATCH, SUBSTRING_MATCH)
+
+
+def normalize_name(name):
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    return unicode(name).lower()
+
+
+class FilterOptionIndex(object):
+    """
+    Holds the (code, name) options of a filter in their display order, along with their normalized names and a
+    sorted list of (normalized name, option number) for prefix matches.
+    """
+    def __init__(self, codes, names):
+        self.options = zip(codes, names)
+
+        self.normalized_names = [normalize_name(name) for name in names]
+        self.prefix_keys = sorted((name, i) for i, name in enumerate(self.normalized_names))
+
+    @classmethod
+    def from_filter_rows(cls, filter_rows):
+        """
+        Builds the index from a dataframe with code and name columns (see db_layer.standardize_columns_for_filter)
+        """
+        return cls(filter_rows['code'].tolist(), filter_rows['name'].tolist())
+
+    def find_option_numbers(self, query, match):
+        query = normalize_name(query)
+        if not query:
+            return range(len(self.options))
+
+        if match != PREFIX_MATCH:
+            return [i for i, name in enumerate(self.normalized_names) if query in name]
+
+        start = bisect.bisect_left(self.prefix_keys, (query,))
+        end = bisect.bisect_left(self.prefix_keys, (query + u'\uffff',))
+
+        # in display order
+        return sorted(i for key, i in self.prefix_keys[start:end])
+
+    def search(self, query, match=SUBSTRING_MATCH, limit=None, offset=0):
+        """
+        Returns the total number of options whose name matches the query (case-insensitively) and the (code, name)
+        pairs of the requested slice of them, in display order
+        """
+        option_numbers = self.find_option_numbers(query, match)
+        end = None if limit is None else offset + limit
+        return len(option_numbers), [self.options[i] for i in option_numbers[offset:end]]
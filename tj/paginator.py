@@ -1,16 +1,20 @@
 """
-Django pagination doesn't work for pandas objects,
-and a customizable solution is perhaps nicer anyhow.
+Pages of query results fetched by seeking on crs_pk (keyset pagination), which Django's pagination, built around
+slicing a sequence with known length, doesn't fit.
 """
-import math
+import json
 
 
-class PandasPage(object):
+class KeysetPage(object):
     """
-    Represents a given "display page" of pandas data
+    Represents a given "display page" of row records (anything with a crs_pk attribute, see db_layer.ResultRow),
+    which are in rows.
+    prev_cursor/next_cursor are (JSON) keyset cursors to pass back when fetching the neighbouring pages.
+    num_items_is_exact is False when num_items is only an estimate.
     """
-    def __init__(self, data_frame, page_number, start_index, end_index, num_items):
-        self.data_frame = data_frame
+    def __init__(self, rows, page_number, start_index, end_index, num_items, prev_cursor=None, next_cursor=None,
+                 num_items_is_exact=True):
+        self.rows = rows
         self.page_number = page_number
         self.start_index = start_index
         self.end_index = end_index
@@ -22,22 +26,28 @@ class PandasPage(object):
         self.has_prev_page = start_index > 1
         self.has_next_page = end_index < num_items
 
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
 
-class PandasPaginator(object):
+        self.num_items_is_exact = num_items_is_exact
+
+
+def get_keyset_page(rows, page_number, count_per_page, num_items, num_items_is_exact=True):
     """
-    Splits pandas data_frames up into display pages.
+    Builds the page for a list of rows that was fetched by seeking on their crs_pk,
+    the cursors point just before the first row and just after the last one.
+    If num_items is only an estimate, it is adjusted to be consistent with the rows actually fetched:
+    a full page is assumed to have a next one, and a partial one to be the last.
     """
-    def __init__(self, data_frame, count_per_page):
-        self.count_per_page = count_per_page
-        self.data_frame = data_frame
-        self.num_items = len(data_frame)
-        self.num_pages = math.ceil(self.num_items/float(count_per_page))
-
-    def get_page(self, page_number):
-        if self.data_frame.empty:
-            return PandasPage(self.data_frame, 0, 0, 0, 0)
-
-        start_index = page_number * self.count_per_page + 1
-        end_index = min(start_index + self.count_per_page - 1, self.num_items)
-        data_slice = self.data_frame.iloc[start_index - 1:end_index]
-        return PandasPage(data_slice, page_number, start_index, end_index, self.num_items)
+    if not rows:
+        return KeysetPage(rows, 0, 0, 0, num_items if num_items_is_exact else 0)
+
+    start_index = page_number * count_per_page + 1
+    end_index = start_index + len(rows) - 1
+    if not num_items_is_exact:
+        num_items = max(num_items, end_index + 1) if len(rows) == count_per_page else end_index
+
+    prev_cursor = json.dumps({'before_pk': int(rows[0].crs_pk)})
+    next_cursor = json.dumps({'after_pk': int(rows[-1].crs_pk)})
+    return KeysetPage(rows, page_number, start_index, end_index, num_items, prev_cursor, next_cursor,
+                      num_items_is_exact)
@@ -0,0 +1,89 @@
+"""
+A cache for pages of query results, shared between the worker processes of one server.
+
+Entries live in a Django cache backend (see the 'results' cache in the settings) that all workers can reach, with
+the most recently used ones also kept in process, up to a memory bound.
+Entries are never updated in place: callers put whatever their results depend on (e.g. the data version and a token
+replaced whenever rows are analyzed, see tj.db_layer) into the key, so that a write moves readers on to new keys and
+the old entries age out of both levels.
+"""
+import collections
+import cPickle
+import hashlib
+import json
+import threading
+
+ENTRY_KEY_PREFIX = 'crs_results:'
+
+
+def get_entry_key(key):
+    return ENTRY_KEY_PREFIX + hashlib.sha1(json.dumps(key)).hexdigest()
+
+
+class ResultCache(object):
+    """
+    shared_cache: the Django cache backend that entries are kept in.
+    max_bytes: the most (pickled) result data to keep in process, least recently used entries are evicted first.
+    """
+    def __init__(self, shared_cache, max_bytes):
+        self.shared_cache = shared_cache
+        self.max_bytes = max_bytes
+
+        self.local_entries = collections.OrderedDict()
+        self.local_bytes = 0
+
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.RLock()
+
+    def store_locally(self, entry_key, value, size):
+        with self.lock:
+            if entry_key in self.local_entries:
+                self.local_bytes -= self.local_entries.pop(entry_key)[1]
+
+            if size > self.max_bytes:
+                return
+
+            self.local_entries[entry_key] = (value, size)
+            self.local_bytes += size
+
+            while self.local_bytes > self.max_bytes:
+                evicted_key, evicted_entry = self.local_entries.popitem(last=False)
+                self.local_bytes -= evicted_entry[1]
+                self.evictions += 1
+
+    def get(self, key, loader):
+        """
+        Returns the cached result for a key (any JSON-serializable value), or loads and caches it
+        """
+        entry_key = get_entry_key(key)
+
+        with self.lock:
+            local_entry = self.local_entries.pop(entry_key, None)
+            if local_entry is not None:
+                # move to the most recently used end
+                self.local_entries[entry_key] = local_entry
+                self.local_hits += 1
+                return local_entry[0]
+
+        pickled_value = self.shared_cache.get(entry_key)
+        if pickled_value is not None:
+            self.shared_hits += 1
+            value = cPickle.loads(pickled_value)
+        else:
+            self.misses += 1
+            value = loader()
+            pickled_value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+            self.shared_cache.set(entry_key, pickled_value)
+
+        self.store_locally(entry_key, value, len(pickled_value))
+        return value
+
+    def get_stats(self):
+        with self.lock:
+            return {'local_hits': self.local_hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'local_entries': len(self.local_entries),
+                    'local_bytes': self.local_bytes}
@@ -1,3 +1,971 @@
-from django.test import TestCase
+import BaseHTTPServer
+import collections
+import decimal
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+import zipfile
+import numpy as np
+import pandas as pd
+import django.db
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.urlresolvers import reverse
+from django.test import SimpleTestCase, TestCase
+import build_crs_database
+import crs_store
+import download_crs_data
+import process_crs_data
+from tj import columnar_export
+from tj import data_cache
+from tj import db_layer
+from tj import filter_index
+from tj import paginator
+from tj import result_cache
+from tj import views
 
-# Create your tests here.
+
+def make_raw_crs_line(fields):
+    """
+    Returns a (unicode) line of a raw CRS file with the given leading fields, padded out to RAW_CRS_NUM_COLUMNS
+    """
+    fields = list(fields) + [u''] * (process_crs_data.RAW_CRS_NUM_COLUMNS - len(fields))
+    return process_crs_data.RAW_CRS_DELIMITER.join(fields) + u'\r\n'
+
+
+def make_raw_crs_contents():
+    """
+    Returns the bytes of a small raw CRS file with all the oddities of the real ones: utf-16 with a BOM at the start of
+    each of the files that were cat'ed together, NULs, embedded newlines and characters outside the BMP
+    """
+    first_part = make_raw_crs_line([u'Year', u'donorname', u'projecttitle']) + \
+        make_raw_crs_line([u'2010', u'Fran\xe7ais', u'a title\nwith an embedded newline']) + \
+        make_raw_crs_line([u'2011', u'nul\0l', u'\U0001f600 outside the BMP'])
+    second_part = make_raw_crs_line([u'2012', u'\u65e5\u672c', u'from a second file'])
+
+    return first_part.encode('utf-16') + second_part.encode('utf-16')
+
+
+class CleanCrsChunksTest(SimpleTestCase):
+    def test_chunks_match_whole_file_cleaning(self):
+        raw_contents = make_raw_crs_contents()
+        expected = process_crs_data.clean_crs_file(raw_contents)
+
+        # odd sizes split the utf-16 code units, surrogate pairs and "\r\n" pairs across chunks
+        for chunk_size in (1, 2, 3, 5, 7, 64, len(raw_contents), len(raw_contents) + 1):
+            chunks = process_crs_data.iter_clean_crs_chunks(io.BytesIO(raw_contents), chunk_size)
+            self.assertEqual(''.join(chunk.encode('utf-8') for chunk in chunks), expected, chunk_size)
+
+    def test_stream_writes_whole_file_cleaning(self):
+        raw_contents = make_raw_crs_contents()
+        expected = process_crs_data.clean_crs_file(raw_contents)
+
+        for chunk_size in (1, 3, 4096):
+            output_file = io.BytesIO()
+            bytes_written = process_crs_data.clean_crs_stream(io.BytesIO(raw_contents), output_file, chunk_size)
+            self.assertEqual(output_file.getvalue(), expected)
+            self.assertEqual(bytes_written, len(expected))
+
+    def test_cleaning(self):
+        cleaned = process_crs_data.clean_crs_file(make_raw_crs_contents()).decode('utf-8')
+
+        self.assertNotIn(u'\ufeff', cleaned)
+        self.assertNotIn(u'\0', cleaned)
+        self.assertNotIn(u'\r', cleaned)
+        self.assertEqual(len(cleaned.split(u'\n')), 5)  # four rows and the empty string after the last one
+        self.assertIn(u'a titlewith an embedded newline', cleaned)
+
+
+class ConvertFilesTest(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.download_dir = os.path.join(self.temp_dir, 'download')
+        os.mkdir(self.download_dir)
+
+        for year in (2010, 2011, 2012):
+            raw_contents = make_raw_crs_contents() + make_raw_crs_line([unicode(year)]).encode('utf-16')
+            with zipfile.ZipFile(os.path.join(self.download_dir, 'CRS {0}.zip'.format(year)), 'w') as zipped:
+                zipped.writestr('CRS {0}.txt'.format(year), raw_contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def convert(self, num_workers):
+        processed_dir = os.path.join(self.temp_dir, 'processed_{0}'.format(num_workers))
+        os.mkdir(processed_dir)
+        process_crs_data.convert_download_directory(self.download_dir, processed_dir, num_workers)
+
+        contents = {}
+        for filename in os.listdir(processed_dir):
+            with open(os.path.join(processed_dir, filename), 'rb') as processed_file:
+                contents[filename] = processed_file.read()
+        return contents
+
+    def test_pool_matches_serial_conversion(self):
+        serial_contents = self.convert(1)
+
+        self.assertEqual(sorted(serial_contents), ['CRS_2010.psv', 'CRS_2011.psv', 'CRS_2012.psv'])
+        self.assertIn('\n2012|', serial_contents['CRS_2012.psv'])
+        self.assertEqual(self.convert(3), serial_contents)
+
+
+class CrsStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.store_dir = os.path.join(tempfile.mkdtemp(), 'store')
+        crs_store.append_dataframe(self.store_dir, pd.DataFrame({
+            'Year': [2009, 2009, 2010, 2011, 2011],
+            'purposecode': [15130, 12110, 15210, 15130, 15220],
+            'projecttitle': [u'a', u'b', u'c', u'd', u'e']}, columns=['Year', 'purposecode', 'projecttitle']))
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.store_dir))
+
+    def test_year_predicate_skips_partitions(self):
+        # a partition the predicate rejects is never opened, so it can even be missing
+        skipped_partition = [partition for partition in crs_store.read_manifest(self.store_dir)['partitions']
+                             if partition['year'] == 2010][0]
+        shutil.rmtree(os.path.join(self.store_dir, skipped_partition['path']))
+
+        rows = crs_store.read_store(self.store_dir, year_predicate=lambda year: year != 2010)
+        self.assertEqual(rows['projecttitle'].tolist(), [u'a', u'b', u'd', u'e'])
+
+    def test_purpose_predicate_selects_rows_of_every_column(self):
+        rows = crs_store.read_store(self.store_dir, purpose_predicate=lambda purpose_codes: purpose_codes // 100 == 152)
+        self.assertEqual(rows['purposecode'].tolist(), [15210, 15220])
+        self.assertEqual(rows['projecttitle'].tolist(), [u'c', u'e'])
+        self.assertEqual(rows['Year'].tolist(), [2010, 2011])
+
+    def test_predicates_combine(self):
+        frames = list(crs_store.iter_store(self.store_dir, columns=['projecttitle'],
+                                           year_predicate=lambda year: year >= 2010,
+                                           purpose_predicate=lambda purpose_codes: purpose_codes == 15130))
+        # the 2010 partition has no matching rows, so no frame is yielded for it
+        self.assertEqual([frame['projecttitle'].tolist() for frame in frames], [[u'd']])
+
+    def test_missing_column_reads_as_nan(self):
+        rows = crs_store.read_store(self.store_dir, columns=['projecttitle', 'channelcode'])
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(rows['channelcode'].isnull().all())
+
+
+class CrsFilterTest(SimpleTestCase):
+    def setUp(self):
+        self.psv_dir = tempfile.mkdtemp()
+        self.psv_path = os.path.join(self.psv_dir, 'CRS_2010.psv')
+
+        frame = make_crs_frame([
+            {'Year': 1999, 'purposecode': 15110, 'projecttitle': u'a'},
+            {'Year': 2000, 'purposecode': 15110, 'projecttitle': u'b', 'shortdescription': u'0012'},
+            {'Year': 2010, 'purposecode': 12220, 'projecttitle': u'c', 'recipientcode': np.nan},
+            {'Year': 2010, 'purposecode': 99810, 'projecttitle': u'd'},
+            {'Year': 2011, 'purposecode': 73010, 'projecttitle': u'e'}])
+        frame['recipientname'] = [u'Peru', u'Kenya', u'Peru', u'France', u'Sierra Leone']
+        frame.to_csv(self.psv_path, sep=process_crs_data.RAW_CRS_DELIMITER, index=False, encoding='utf-8')
+
+    def tearDown(self):
+        shutil.rmtree(self.psv_dir)
+
+    def test_read_with_schema_dtypes(self):
+        rows = process_crs_data.read_psv_file(self.psv_path)
+
+        self.assertEqual(rows['Year'].dtype, np.int32)
+        self.assertEqual(rows['recipientcode'].dtype, np.float32)  # has a missing value
+        self.assertTrue(np.isnan(rows['recipientcode'][2]))
+        self.assertEqual(rows['channelcode'].dtype, np.float64)
+        # text that looks like a number stays text
+        self.assertEqual(rows['shortdescription'][1], u'0012')
+
+        usecols = ['Year', 'projecttitle']
+        self.assertEqual(sorted(process_crs_data.read_psv_file(self.psv_path, usecols=usecols).columns), usecols)
+
+    def test_filters_match_row_wise_filters(self):
+        # the filters as they were applied row by row, to the file read without a schema
+        def is_desired_purpose_code(purpose_code):
+            return purpose_code / 1000 in process_crs_data.DESIRED_PURPOSE_CODE_PREFIXES
+
+        row_wise = pd.read_csv(self.psv_path, delimiter=process_crs_data.RAW_CRS_DELIMITER)
+        row_wise_filters = [
+            (process_crs_data.apply_purpose_code_filter,
+             lambda frame: frame[frame.purposecode.apply(is_desired_purpose_code)]),
+            (process_crs_data.apply_country_filter,
+             lambda frame: frame[frame.recipientname.apply(lambda x: x in process_crs_data.DESIRED_COUNTRIES)]),
+            (process_crs_data.apply_year_filter,
+             lambda frame: frame[frame.Year >= process_crs_data.FIRST_DESIRED_YEAR])]
+
+        rows = process_crs_data.read_psv_file(self.psv_path)
+        for vectorized_filter, row_wise_filter in row_wise_filters:
+            self.assertEqual(vectorized_filter(rows)['projecttitle'].tolist(),
+                             row_wise_filter(row_wise)['projecttitle'].tolist())
+
+        purpose_filtered = process_crs_data.apply_purpose_code_filter(rows)
+        self.assertEqual(purpose_filtered['projecttitle'].tolist(), [u'a', u'b', u'd', u'e'])
+
+
+def make_crs_frame(rows):
+    """
+    Returns a dataframe of processed CRS data with the given (partial) rows, everything else being empty or code 1
+    """
+    data = collections.OrderedDict()
+    for column, column_type in build_crs_database.CRS_COLUMN_SPEC:
+        is_numeric = column_type.startswith('integer') or column_type.startswith('double precision')
+        data[column] = [row.get(column, 1 if column_type.startswith('integer') else np.nan if is_numeric else u'')
+                        for row in rows]
+    for filter_type in build_crs_database.CODE_TABLES + ['agency']:
+        data[filter_type + 'name'] = [filter_type + ' name'] * len(rows)
+
+    return pd.DataFrame(data)
+
+
+def build_crs_tables(cursor, rows):
+    """
+    Builds the crs table (with its code tables and crs_rollup) from a dataframe of make_crs_frame, in the test database
+    """
+    build_crs_database.build_code_tables(cursor, rows)
+    build_crs_database.build_agency_table(cursor, rows)
+    build_crs_database.build_custom_data_tables(cursor)
+    build_crs_database.create_crs_table(cursor)
+    build_crs_database.stream_crs_table(cursor, [rows])
+    build_crs_database.add_crs_constraints(cursor)
+    build_crs_database.build_rollup_table(cursor)
+    build_crs_database.record_data_version(cursor)
+
+
+class ReplaceCrsYearsTest(TestCase):
+    def setUp(self):
+        self.cursor = django.db.connection.connection.cursor()
+
+        # three rows sharing a natural key, told apart by their amounts, one more with no crsid/projectnumber, and one
+        # that won't be in the new data
+        old_rows = make_crs_frame([
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 1.0, 'projecttitle': u'a'},
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 2.0, 'projecttitle': u'b'},
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 3.0, 'projecttitle': u'c'},
+            {'Year': 2010, 'crsid': None, 'projectnumber': None, 'usd_commitment': 1.0, 'projecttitle': u'd'},
+            {'Year': 2010, 'crsid': u'Y', 'projectnumber': u'P', 'usd_commitment': 1.0, 'projecttitle': u'e'},
+            {'Year': 2011, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 1.0, 'projecttitle': u'f'}])
+
+        build_crs_tables(self.cursor, old_rows)
+
+        for title, inclusion, category in ((u'a', 1, 0), (u'b', 0, 0), (u'd', 2, 3), (u'e', 1, 2), (u'f', 1, 1)):
+            self.cursor.execute('UPDATE crs SET tj_inclusion_id = %s, tj_category_id = %s WHERE projecttitle = %s;',
+                                [inclusion, category, title])
+
+    def get_decisions(self):
+        self.cursor.execute('SELECT projecttitle, tj_inclusion_id, tj_category_id FROM crs ORDER BY projecttitle;')
+        return self.cursor.fetchall()
+
+    def test_decisions_are_carried_over_one_to_one(self):
+        # the same rows again (with new titles), in a different order, over two chunks, and with a new recipient code
+        new_rows = make_crs_frame([
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 3.0, 'projecttitle': u'c2'},
+            {'Year': 2010, 'crsid': None, 'projectnumber': None, 'usd_commitment': 1.0, 'projecttitle': u'd2'},
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 1.0, 'projecttitle': u'a2'},
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 2.0, 'projecttitle': u'b2',
+             'recipientcode': 2}])
+        build_crs_database.replace_crs_years(self.cursor, [new_rows.iloc[:2], new_rows.iloc[2:]], [2010])
+
+        self.assertEqual(self.get_decisions(), [(u'a2', 1, 0), (u'b2', 0, 0), (u'c2', None, 0), (u'd2', 2, 3),
+                                                (u'f', 1, 1)])
+
+        self.cursor.execute('SELECT key_crsid, tj_inclusion_id, tj_category_id FROM crs_unmatched_decisions;')
+        self.assertEqual(self.cursor.fetchall(), [(u'Y', 1, 2)])
+
+        self.cursor.execute('SELECT tj_inclusion_id, tj_category_id, row_count FROM crs_rollup WHERE year = 2010 '
+                            'ORDER BY tj_inclusion_id, tj_category_id;')
+        self.assertEqual(self.cursor.fetchall(), [(0, 0, 1), (1, 0, 1), (2, 3, 1), (None, 0, 1)])
+
+    def test_fewer_rows_for_a_key(self):
+        new_rows = make_crs_frame([
+            {'Year': 2010, 'crsid': u'X', 'projectnumber': u'P', 'usd_commitment': 1.0, 'projecttitle': u'a2'}])
+        build_crs_database.replace_crs_years(self.cursor, [new_rows], [2010])
+
+        self.assertEqual(self.get_decisions(), [(u'a2', 1, 0), (u'f', 1, 1)])
+        self.cursor.execute('SELECT key_crsid, key_ordinal FROM crs_unmatched_decisions ORDER BY 1, 2;')
+        self.assertEqual(self.cursor.fetchall(), [(u'', 1), (u'X', 2), (u'Y', 1)])
+
+
+class AnalysisUpdateTest(TestCase):
+    def setUp(self):
+        self.cursor = django.db.connection.connection.cursor()
+        build_crs_tables(self.cursor, make_crs_frame([
+            {'Year': 2010, 'recipientcode': 1, 'projecttitle': u'a'},
+            {'Year': 2010, 'recipientcode': 2, 'projecttitle': u'b'},
+            {'Year': 2011, 'recipientcode': 1, 'projecttitle': u'c'}]))
+
+        User.objects.create_user('analyst', password='password')
+        self.client.login(username='analyst', password='password')
+
+    def get_inclusions(self):
+        self.cursor.execute('SELECT projecttitle, tj_inclusion_id FROM crs ORDER BY projecttitle;')
+        return self.cursor.fetchall()
+
+    def post_json(self, url_name, payload):
+        return self.client.post(reverse(url_name), json.dumps(payload), content_type='application/json')
+
+    def make_results_payload(self, **payload):
+        results_payload = {'search_terms': '', 'code_filters': {}, 'custom_filters': {}, 'years': []}
+        results_payload.update(payload)
+        return results_payload
+
+    def test_filters_are_passed_as_params(self):
+        query = db_layer.QueryParams(None)
+        query.add_code_filter('recipient', 1)
+        query.add_year_filter('2010')
+
+        where_clause, params = db_layer.generate_where_clause_and_params(query)
+        self.assertNotIn('2010', where_clause)
+        self.assertEqual(params, [[1], [2010]])
+
+        self.assertEqual(db_layer.update_analysis_for_query(query, tj_inclusion_id=2), 1)
+        self.assertEqual(self.get_inclusions(), [(u'a', 2), (u'b', None), (u'c', None)])
+
+    def test_search_terms_match_in_each_language(self):
+        self.cursor.execute("UPDATE crs SET shortdescription = 'appui aux projets', text_language = 'french' "
+                            "WHERE projecttitle = 'b';")
+
+        query = db_layer.QueryParams(u'projet')
+        where_clause, params = db_layer.generate_where_clause_and_params(query)
+        self.assertEqual(db_layer.get_exact_count_of_rows(where_clause, params), 1)
+        self.assertEqual([row.projecttitle for row in db_layer.get_page_of_rows(where_clause, params)], [u'b'])
+
+    def test_apply_to_all_checks_ids(self):
+        response = self.post_json('query_results',
+                                  self.make_results_payload(years=[2011], apply_to_all={'inclusion': 1}))
+        self.assertEqual(json.loads(response.content), {'rows_updated': 1})
+
+        response = self.post_json('query_results', self.make_results_payload(apply_to_all={'inclusion': 99}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_inclusions(), [(u'a', None), (u'b', None), (u'c', 1)])
+
+    def test_filters_must_be_integers_of_known_types(self):
+        for payload in ({'code_filters': {'recipient': ['1) OR (1=1']}}, {'years': ['2010; --']},
+                        {'code_filters': {'recipientcode IS NULL OR crs.recipient': [1]}}):
+            response = self.post_json('query_results', self.make_results_payload(count_only=True, **payload))
+            self.assertEqual(response.status_code, 400)
+
+    def test_commit_analysis_checks_ids(self):
+        self.cursor.execute("SELECT crs_pk FROM crs WHERE projecttitle = 'a';")
+        crs_pk = self.cursor.fetchone()[0]
+
+        response = self.post_json('query_commit_analysis', {'inclusionActions': {str(crs_pk): 1},
+                                                            'categoryActions': {str(crs_pk): 42}})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get_inclusions(), [(u'a', None), (u'b', None), (u'c', None)])
+
+        # tj_category_id is NOT NULL, unlike tj_inclusion_id
+        response = self.post_json('query_commit_analysis', {'inclusionActions': {str(crs_pk): None},
+                                                            'categoryActions': {str(crs_pk): None}})
+        self.assertEqual(response.status_code, 400)
+
+    def test_page_cursor_must_be_integers(self):
+        for url_name in ('query_results', 'review_tj_dataset_results'):
+            for payload in ({'page_number': 'x'}, {'after_pk': '1; --'}, {'before_pk': [1]}):
+                response = self.post_json(url_name, self.make_results_payload(**payload))
+                self.assertEqual(response.status_code, 400)
+
+            response = self.post_json(url_name, self.make_results_payload(page_number='1', after_pk='0'))
+            self.assertEqual(response.status_code, 200)
+
+    def test_results_list_inclusions_and_categories(self):
+        response = self.post_json('query_results', self.make_results_payload())
+        self.assertIn("applyInclusionToSelected('2', 'Maybe include')", response.content)
+        self.assertIn("applyToAllMatchingRows({category: '0'}", response.content)
+
+        response = self.client.get(reverse('review_tj_dataset'))
+        self.assertIn('id="inclusion_1"', response.content)
+        self.assertIn('id="category_0"', response.content)
+
+
+class RollupUpdateTest(TestCase):
+    def setUp(self):
+        self.cursor = django.db.connection.connection.cursor()
+        build_crs_tables(self.cursor, make_crs_frame([
+            {'Year': 2010, 'usd_commitment': 1.0, 'projecttitle': u'a'},
+            {'Year': 2010, 'usd_commitment': 2.0, 'projecttitle': u'b'},
+            {'Year': 2010, 'usd_commitment': 4.0, 'projecttitle': u'c'}]))
+
+        # recipientcode and purposecode are nullable, like tj_inclusion_id
+        self.cursor.execute("UPDATE crs SET recipientcode = NULL, purposecode = NULL WHERE projecttitle IN ('a', 'b');")
+        build_crs_database.build_rollup_table(self.cursor)
+
+    def get_rollup_rows(self, sql):
+        self.cursor.execute(sql + ' ORDER BY recipientcode, purposecode, tj_inclusion_id, tj_category_id;')
+        return self.cursor.fetchall()
+
+    def assert_rollup_matches_crs(self):
+        columns = 'recipientcode, purposecode, tj_inclusion_id, tj_category_id, row_count, usd_commitment'
+        recomputed_rows = self.get_rollup_rows('SELECT ' + columns + ' FROM (' +
+                                               build_crs_database.get_rollup_select_sql() + ') AS rollup')
+        self.assertEqual(self.get_rollup_rows('SELECT ' + columns + ' FROM crs_rollup WHERE row_count > 0'),
+                         recomputed_rows)
+
+    def set_inclusion(self, title, tj_inclusion_id):
+        self.cursor.execute('SELECT crs_pk FROM crs WHERE projecttitle = %s;', [title])
+        db_layer.update_analysis({self.cursor.fetchone()[0]: tj_inclusion_id}, {})
+
+    def test_rows_with_null_keys_move_between_groups(self):
+        self.set_inclusion(u'a', 1)
+        self.assert_rollup_matches_crs()
+
+        # moves b into the group a created, which only matches it if the null keys are coalesced
+        self.set_inclusion(u'b', 1)
+        self.set_inclusion(u'c', 1)
+        self.assert_rollup_matches_crs()
+        self.assertEqual(self.get_rollup_rows('SELECT recipientcode, tj_inclusion_id, row_count, usd_commitment '
+                                              'FROM crs_rollup WHERE row_count > 0'),
+                         [(1, 1, 1, 4.0), (None, 1, 2, 3.0)])
+
+        self.set_inclusion(u'a', 0)
+        self.assert_rollup_matches_crs()
+
+
+class FixedRowsConnection(object):
+    """
+    Stands in for a database connection whose cursors return the given rows for any query
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+def make_aggregate_row(grouping_set, count, usd_disbursement_defl, **values):
+    """
+    Returns a row as the GROUPING SETS query of load_analysis_aggregates gives it, for the given grouping set
+    """
+    return tuple(values.get(dimension) for dimension in db_layer.AGGREGATE_DIMENSIONS) + \
+        (db_layer.get_grouping_mask(grouping_set), decimal.Decimal(count), decimal.Decimal(usd_disbursement_defl))
+
+
+class AnalysisAggregatesTest(SimpleTestCase):
+    def setUp(self):
+        self.original_get_db_connection = db_layer.get_db_connection
+
+    def tearDown(self):
+        db_layer.get_db_connection = self.original_get_db_connection
+
+    def test_grouping_mask(self):
+        # inclusion, category, year, recipient, donor, with the first as the highest bit
+        self.assertEqual(db_layer.get_grouping_mask(('inclusion', 'category')), 0b00111)
+        self.assertEqual(db_layer.get_grouping_mask(('category',)), 0b10111)
+        self.assertEqual(db_layer.get_grouping_mask(('inclusion', 'year')), 0b01011)
+        self.assertEqual(db_layer.get_grouping_mask(()), 0b11111)
+
+    def test_rows_are_decoded_into_breakdowns(self):
+        db_layer.get_db_connection = lambda: FixedRowsConnection([
+            make_aggregate_row((), 3, '6.5'),
+            make_aggregate_row(('inclusion', 'category'), 1, '4.0', inclusion=1, category=2),
+            make_aggregate_row(('inclusion', 'category'), 2, '2.5', category=0),
+            make_aggregate_row(('inclusion',), 1, '4.0', inclusion=1),
+            # a null inclusion is no decision, rather than the inclusion being aggregated away
+            make_aggregate_row(('inclusion',), 2, '2.5'),
+            make_aggregate_row(('inclusion', 'year'), 3, '6.5', year=2010, category=99)])
+
+        breakdowns = db_layer.load_analysis_aggregates()
+
+        self.assertEqual([breakdown['dimensions'] for breakdown in breakdowns],
+                         [list(grouping_set) for grouping_set in db_layer.AGGREGATE_GROUPING_SETS])
+        breakdown_rows = dict((tuple(breakdown['dimensions']), breakdown['rows']) for breakdown in breakdowns)
+
+        self.assertEqual(breakdown_rows[('inclusion', 'category')],
+                         [{'inclusion': None, 'category': 0, 'count': 2, 'usd_disbursement_defl': 2.5},
+                          {'inclusion': 1, 'category': 2, 'count': 1, 'usd_disbursement_defl': 4.0}])
+        self.assertEqual(breakdown_rows[('inclusion',)],
+                         [{'inclusion': None, 'count': 2, 'usd_disbursement_defl': 2.5},
+                          {'inclusion': 1, 'count': 1, 'usd_disbursement_defl': 4.0}])
+        self.assertEqual(breakdown_rows[()], [{'count': 3, 'usd_disbursement_defl': 6.5}])
+        # the category value is dropped, as the mask says it is aggregated away
+        self.assertEqual(breakdown_rows[('inclusion', 'year')],
+                         [{'inclusion': None, 'year': 2010, 'count': 3, 'usd_disbursement_defl': 6.5}])
+        self.assertEqual(breakdown_rows[('category',)], [])
+        self.assertIsInstance(breakdown_rows[()][0]['count'], int)
+
+    def test_crosstab(self):
+        def row(count, **values):
+            values.update({'count': count, 'usd_disbursement_defl': float(count)})
+            return values
+
+        included_a = row(1, inclusion=1, inclusion_name='Include', category=1, category_name='A')
+        undecided_b = row(2, inclusion=None, inclusion_name='No decision', category=2, category_name='B')
+        inclusion_totals = [row(2, inclusion=None, inclusion_name='No decision'),
+                            row(1, inclusion=1, inclusion_name='Include')]
+        category_totals = [row(1, category=1, category_name='A'), row(2, category=2, category_name='B')]
+        grand_totals = [row(3)]
+
+        category_names, crosstab_rows = views.get_crosstab([
+            {'dimensions': ['inclusion', 'category'], 'rows': [undecided_b, included_a]},
+            {'dimensions': ['inclusion'], 'rows': inclusion_totals},
+            {'dimensions': ['category'], 'rows': category_totals},
+            {'dimensions': [], 'rows': grand_totals},
+            {'dimensions': ['inclusion', 'year'], 'rows': []}])
+
+        self.assertEqual(category_names, ['A', 'B'])
+        self.assertEqual(crosstab_rows, [('No decision', [None, undecided_b, inclusion_totals[0]]),
+                                         ('Include', [included_a, None, inclusion_totals[1]]),
+                                         ('Total', category_totals + grand_totals)])
+
+
+class CrsFileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves one file the way the OECD site does, honouring Range/If-Range and If-None-Match.
+    The tests set the contents, the ETag and how (if at all) to misbehave, and look at the requests made.
+    """
+    contents = ''
+    etag = '"1"'
+    misbehavior = None
+    requests = []
+
+    def do_GET(self):
+        if self.path.startswith(download_crs_data.CRS_FILES_PATH.split('?')[0]):
+            # the page listing the files
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write("<a onclick=\"openFile('./FileView2.aspx?IDFile=1')\">CRS 2010</a>")
+            return
+
+        self.requests.append(dict(self.headers))
+
+        if self.headers.get('if-none-match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        range_match = re.match(r'bytes=(\d+)-$', self.headers.get('range', ''))
+        if range_match and self.headers.get('if-range', self.etag) == self.etag:
+            start = int(range_match.group(1))
+            if start >= len(self.contents):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(self.contents))
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            if self.misbehavior != 'no_content_range':
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.contents) - 1,
+                                                                      len(self.contents)))
+        else:
+            self.send_response(200)
+
+        body = self.contents[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Disposition', 'attachment; filename=CRS_2010.zip')
+        self.end_headers()
+
+        if self.misbehavior == 'truncate':
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadCsvFileTest(SimpleTestCase):
+    def setUp(self):
+        CrsFileHandler.contents = ''.join(chr(i % 256) for i in xrange(10000))
+        CrsFileHandler.etag = '"1"'
+        CrsFileHandler.misbehavior = None
+        CrsFileHandler.requests = []
+
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CrsFileHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.url = self.base_url + '/FileView2.aspx?IDFile=1'
+        self.dest_dir = tempfile.mkdtemp()
+        self.part_path = os.path.join(self.dest_dir, hashlib.md5(self.url).hexdigest() + '.part')
+        self.output_path = os.path.join(self.dest_dir, 'CRS_2010.zip')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dest_dir)
+
+    def write_part_file(self, contents, etag):
+        with open(self.part_path, 'wb') as part_file:
+            part_file.write(contents)
+        with open(self.part_path + '.json', 'w') as validators_file:
+            json.dump({'etag': etag, 'last_modified': None}, validators_file)
+
+    def read_output(self):
+        with open(self.output_path, 'rb') as output_file:
+            return output_file.read()
+
+    def test_download(self):
+        download_info = download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(download_info, {'filename': 'CRS_2010.zip', 'size': 10000, 'etag': '"1"',
+                                         'last_modified': None})
+        self.assertEqual(os.listdir(self.dest_dir), ['CRS_2010.zip'])
+
+    def test_resume(self):
+        self.write_part_file(CrsFileHandler.contents[:4000], '"1"')
+
+        download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(CrsFileHandler.requests[0]['range'], 'bytes=4000-')
+        self.assertEqual(CrsFileHandler.requests[0]['if-range'], '"1"')
+
+    def test_resume_without_content_range(self):
+        CrsFileHandler.misbehavior = 'no_content_range'
+        self.write_part_file(CrsFileHandler.contents[:4000], '"1"')
+
+        download_info = download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(download_info['size'], 10000)
+
+    def test_changed_file_restarts(self):
+        # the part file is of an older version, so the server ignores the Range and sends the whole file
+        self.write_part_file('x' * 4000, '"0"')
+
+        download_info = download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(download_info['etag'], '"1"')
+
+    def test_unsatisfiable_range_restarts(self):
+        self.write_part_file('x' * 20000, '"1"')
+
+        download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(len(CrsFileHandler.requests), 2)
+        self.assertNotIn('range', CrsFileHandler.requests[1])
+
+    def test_unchanged_file_is_skipped(self):
+        previous_download = download_crs_data.download_csv_file(self.url, self.dest_dir)
+
+        self.assertEqual(download_crs_data.download_csv_file(self.url, self.dest_dir, previous_download),
+                         previous_download)
+        self.assertEqual(CrsFileHandler.requests[1]['if-none-match'], '"1"')
+        self.assertEqual(os.listdir(self.dest_dir), ['CRS_2010.zip'])
+
+    def test_short_download_keeps_part_file(self):
+        CrsFileHandler.misbehavior = 'truncate'
+
+        self.assertRaises(IOError, download_crs_data.download_csv_file, self.url, self.dest_dir)
+
+        self.assertFalse(os.path.exists(self.output_path))
+        with open(self.part_path, 'rb') as part_file:
+            self.assertEqual(part_file.read(), CrsFileHandler.contents[:5000])
+
+        # and the next attempt picks up where it left off
+        CrsFileHandler.misbehavior = None
+        download_crs_data.download_csv_file(self.url, self.dest_dir)
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+        self.assertEqual(CrsFileHandler.requests[-1]['range'], 'bytes=5000-')
+
+    def test_update_crs_data(self):
+        download_crs_data.update_crs_data(self.dest_dir, base_url=self.base_url)
+        self.assertEqual(self.read_output(), CrsFileHandler.contents)
+
+        # nothing has changed the second time round
+        download_crs_data.update_crs_data(self.dest_dir, base_url=self.base_url)
+        self.assertEqual([request.get('if-none-match') for request in CrsFileHandler.requests], [None, '"1"'])
+        self.assertEqual(sorted(os.listdir(self.dest_dir)),
+                         ['CRS_2010.zip', download_crs_data.DOWNLOAD_MANIFEST_FILE_NAME])
+
+
+class ColumnarExportTest(SimpleTestCase):
+    def test_chunks_round_trip(self):
+        columns = ['year', 'projecttitle', 'usd_disbursement']
+        column_kinds = {'year': columnar_export.NUMERIC_KIND, 'projecttitle': columnar_export.TEXT_KIND,
+                        'usd_disbursement': columnar_export.NUMERIC_KIND}
+        row_chunks = [[(2010, u'caf\xe9', 1.5), (2011, None, None)], [], [(2012, '', 2.25), (None, u'\u65e5', 0.0)]]
+
+        export_file = io.BytesIO()
+        columnar_export.write_export(export_file, columns, column_kinds, iter(row_chunks))
+        export_file.seek(0)
+        rows = columnar_export.read_export(export_file)
+
+        self.assertEqual(list(rows.columns), columns)
+        self.assertEqual(rows['projecttitle'].tolist(), [u'caf\xe9', None, u'', u'\u65e5'])
+        np.testing.assert_array_equal(rows['year'].values, [2010, 2011, 2012, np.nan])
+        np.testing.assert_array_equal(rows['usd_disbursement'].values, [1.5, np.nan, 2.25, 0.0])
+
+    def test_no_rows(self):
+        export_file = io.BytesIO()
+        columnar_export.write_export(export_file, ['year', 'projecttitle'],
+                                     {'year': columnar_export.NUMERIC_KIND, 'projecttitle': columnar_export.TEXT_KIND},
+                                     [])
+        export_file.seek(0)
+        self.assertEqual(len(columnar_export.read_export(export_file)), 0)
+
+
+class DetectLanguageTest(SimpleTestCase):
+    def test_detect_language(self):
+        self.assertEqual(build_crs_database.detect_language(u'Support for the courts of the province'), 'english')
+        self.assertEqual(build_crs_database.detect_language(u"Appui aux victimes et \xe0 la r\xe9paration"), 'french')
+        self.assertEqual(build_crs_database.detect_language(u'Apoyo a las v\xedctimas del conflicto'), 'spanish')
+        self.assertEqual(build_crs_database.detect_language(u''), build_crs_database.DEFAULT_LANGUAGE)
+
+    def test_ties_are_broken_in_priority_order(self):
+        # one French marker word and one Spanish one
+        self.assertEqual(build_crs_database.detect_language(u'les los'), 'french')
+        self.assertEqual(build_crs_database.detect_language(u'los les'), 'french')
+        self.assertEqual(build_crs_database.detect_language(u'the les los'), 'english')
+
+
+PageRow = collections.namedtuple('PageRow', ['crs_pk'])
+
+
+class KeysetPageTest(SimpleTestCase):
+    def test_cursors_point_around_the_page(self):
+        rows = [PageRow(crs_pk) for crs_pk in (11, 15, 30)]
+        page = paginator.get_keyset_page(rows, 2, 3, 20)
+
+        self.assertEqual(json.loads(page.prev_cursor), {'before_pk': 11})
+        self.assertEqual(json.loads(page.next_cursor), {'after_pk': 30})
+        self.assertEqual((page.start_index, page.end_index), (7, 9))
+        self.assertEqual((page.prev_page_number, page.next_page_number), (1, 3))
+        self.assertTrue(page.has_prev_page)
+        self.assertTrue(page.has_next_page)
+
+    def test_first_and_last_pages(self):
+        first_page = paginator.get_keyset_page([PageRow(1), PageRow(2)], 0, 2, 3)
+        self.assertFalse(first_page.has_prev_page)
+        self.assertTrue(first_page.has_next_page)
+
+        last_page = paginator.get_keyset_page([PageRow(3)], 1, 2, 3)
+        self.assertTrue(last_page.has_prev_page)
+        self.assertFalse(last_page.has_next_page)
+
+    def test_empty_page(self):
+        page = paginator.get_keyset_page([], 0, 25, 0)
+        self.assertEqual((page.start_index, page.end_index, page.num_items), (0, 0, 0))
+        self.assertIsNone(page.prev_cursor)
+        self.assertIsNone(page.next_cursor)
+        self.assertFalse(page.has_next_page)
+
+
+class EstimatedCountTest(SimpleTestCase):
+    def test_full_page_has_a_next_one(self):
+        rows = [PageRow(crs_pk) for crs_pk in xrange(1, 26)]
+
+        # an estimate that's too low is raised to leave room for a next page
+        page = paginator.get_keyset_page(rows, 3, 25, 50, num_items_is_exact=False)
+        self.assertEqual(page.num_items, 101)
+        self.assertTrue(page.has_next_page)
+        self.assertFalse(page.num_items_is_exact)
+
+        page = paginator.get_keyset_page(rows, 0, 25, 5000, num_items_is_exact=False)
+        self.assertEqual(page.num_items, 5000)
+
+    def test_partial_page_is_the_last(self):
+        page = paginator.get_keyset_page([PageRow(1), PageRow(2)], 4, 25, 5000, num_items_is_exact=False)
+        self.assertEqual(page.num_items, 102)
+        self.assertFalse(page.has_next_page)
+
+    def test_no_rows_means_no_items(self):
+        self.assertEqual(paginator.get_keyset_page([], 0, 25, 5000, num_items_is_exact=False).num_items, 0)
+        self.assertEqual(paginator.get_keyset_page([], 0, 25, 7).num_items, 7)
+
+
+class DataCacheTest(SimpleTestCase):
+    def test_version_is_fetched_outside_the_lock(self):
+        versions = ['1']
+        checking = threading.Event()
+        release = threading.Event()
+
+        def get_version():
+            if versions:
+                return versions.pop()
+            checking.set()
+            release.wait(10)
+            return '2'
+
+        cache = data_cache.DataCache(60, get_version, version_check_interval=0)
+        self.assertEqual(cache.get('key', lambda: 'first'), 'first')
+
+        checker = threading.Thread(target=cache.get_version)
+        checker.start()
+        self.assertTrue(checking.wait(10))
+
+        # another thread isn't held up by the slow version check, it starts no second one and keeps the entries
+        cache.version_check_interval = 60
+        self.assertEqual(cache.get('key', lambda: 'second'), 'first')
+
+        release.set()
+        checker.join()
+        self.assertEqual(cache.get_version(), '2')
+        self.assertEqual(cache.get('key', lambda: 'second'), 'second')
+
+
+class DataVersionTest(TestCase):
+    def test_missing_version_table_leaves_transaction_usable(self):
+        # TestCase runs each test in a transaction, which a failed query would otherwise abort
+        self.assertIsNone(db_layer.get_data_version())
+
+        cursor = django.db.connection.cursor()
+        cursor.execute('SELECT 1;')
+        self.assertEqual(cursor.fetchone(), (1,))
+
+
+class CountCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.exact_counts = []
+        self.original_get_exact_count_of_rows = db_layer.get_exact_count_of_rows
+
+        def get_exact_count_of_rows(where_clause, params):
+            self.exact_counts.append(where_clause)
+            return 42
+
+        db_layer.get_exact_count_of_rows = get_exact_count_of_rows
+
+    def tearDown(self):
+        db_layer.get_exact_count_of_rows = self.original_get_exact_count_of_rows
+
+    def test_counts_are_dropped_when_any_worker_analyzes_rows(self):
+        count_key = ('test', uuid.uuid4().hex)
+        self.assertEqual(db_layer.get_count_of_rows('WHERE 1=1', [], count_key, exact=True), (42, True))
+        self.assertEqual(db_layer.get_count_of_rows('WHERE 1=1', [], count_key), (42, True))
+        self.assertEqual(len(self.exact_counts), 1)
+
+        # what another worker's invalidate_analyzed_rows does to the shared cache
+        db_layer.results_cache_backend.set(db_layer.ANALYSIS_TOKEN_KEY, uuid.uuid4().hex, None)
+
+        self.assertEqual(db_layer.get_count_of_rows('WHERE 1=1', [], count_key, exact=True), (42, True))
+        self.assertEqual(len(self.exact_counts), 2)
+
+
+class ResultCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.page_loads = []
+        self.original_get_page_of_rows = db_layer.get_page_of_rows
+        self.original_get_cached_data_version = db_layer.get_cached_data_version
+
+        def get_page_of_rows(where_clause, params, after_pk, before_pk):
+            self.page_loads.append(where_clause)
+            return [PageRow(1), PageRow(2)]
+
+        db_layer.get_page_of_rows = get_page_of_rows
+        db_layer.get_cached_data_version = lambda: 'test'
+
+    def tearDown(self):
+        db_layer.get_page_of_rows = self.original_get_page_of_rows
+        db_layer.get_cached_data_version = self.original_get_cached_data_version
+
+    def get_page(self, query):
+        return db_layer.get_cached_page_of_rows('test', query, 'WHERE 1=1', [])
+
+    def test_workers_share_entries(self):
+        # two workers sharing one backend
+        shared_cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION=uuid.uuid4().hex)
+        workers = [result_cache.ResultCache(shared_cache, 1024 * 1024) for i in xrange(2)]
+        loads = []
+
+        for worker in workers * 2:
+            self.assertEqual(worker.get(['page', 1], lambda: loads.append(1) or [1, 2]), [1, 2])
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual([(worker.get_stats()['shared_hits'], worker.get_stats()['local_hits']) for worker in workers],
+                         [(0, 1), (1, 1)])
+
+    def test_pages_are_dropped_when_any_worker_analyzes_rows(self):
+        query = db_layer.QueryParams(uuid.uuid4().hex)
+        self.assertEqual([row.crs_pk for row in self.get_page(query)], [1, 2])
+        self.get_page(query)
+        self.assertEqual(len(self.page_loads), 1)
+
+        # what another worker's invalidate_analyzed_rows does to the shared cache
+        db_layer.results_cache_backend.set(db_layer.ANALYSIS_TOKEN_KEY, uuid.uuid4().hex, None)
+        self.get_page(query)
+        self.assertEqual(len(self.page_loads), 2)
+
+    def test_write_during_load_is_not_hidden(self):
+        query = db_layer.QueryParams(uuid.uuid4().hex)
+
+        def get_page_of_rows(where_clause, params, after_pk, before_pk):
+            self.page_loads.append(where_clause)
+            # committed after the rows were read
+            db_layer.results_cache_backend.set(db_layer.ANALYSIS_TOKEN_KEY, uuid.uuid4().hex, None)
+            return [PageRow(1)]
+
+        db_layer.get_page_of_rows = get_page_of_rows
+        self.get_page(query)
+        self.get_page(query)
+        self.assertEqual(len(self.page_loads), 2)
+
+
+class PreparedStatementTest(TestCase):
+    def test_placeholders_are_numbered(self):
+        self.assertEqual(db_layer.number_placeholders("SELECT %s WHERE title LIKE '100%%' AND code = ANY(%s)"),
+                         ("SELECT $1 WHERE title LIKE '100%' AND code = ANY($2)", 2))
+        self.assertEqual(db_layer.number_placeholders('SELECT 1'), ('SELECT 1', 0))
+
+    def test_connections_plan_for_each_execution(self):
+        cursor = django.db.connection.cursor()
+        cursor.execute('SHOW plan_cache_mode;')
+        self.assertEqual(cursor.fetchone()[0], 'force_custom_plan')
+
+
+class CacheStatsTest(TestCase):
+    def test_only_staff_see_cache_stats(self):
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, 403)
+
+        User.objects.create_user('analyst', password='password')
+        self.client.login(username='analyst', password='password')
+        self.assertEqual(self.client.get(reverse('cache_stats')).status_code, 403)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('cache_stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(json.loads(response.content)), ['code_tables', 'counts', 'results'])
+
+
+class FilterOptionIndexTest(SimpleTestCase):
+    def setUp(self):
+        # in display order, which isn't alphabetical
+        self.index = filter_index.FilterOptionIndex([3, 1, 2, 4], [u'Peru', u'Bolivia', u'Per\xfa Norte', u'Kenya'])
+
+    def test_substring_search(self):
+        self.assertEqual(self.index.search(u'er'), (2, [(3, u'Peru'), (2, u'Per\xfa Norte')]))
+        self.assertEqual(self.index.search(u'IVI'), (1, [(1, u'Bolivia')]))
+        self.assertEqual(self.index.search(u'nort'), (1, [(2, u'Per\xfa Norte')]))
+        self.assertEqual(self.index.search(u'xyz'), (0, []))
+
+    def test_prefix_search(self):
+        self.assertEqual(self.index.search(u'pe', filter_index.PREFIX_MATCH),
+                         (2, [(3, u'Peru'), (2, u'Per\xfa Norte')]))
+        self.assertEqual(self.index.search(u'er', filter_index.PREFIX_MATCH), (0, []))
+
+    def test_repeated_matches_are_counted_once(self):
+        # "i" is in Bolivia twice
+        self.assertEqual(self.index.search(u'i'), (1, [(1, u'Bolivia')]))
+
+    def test_empty_query_pages_through_everything(self):
+        self.assertEqual(self.index.search(u'', limit=2), (4, [(3, u'Peru'), (1, u'Bolivia')]))
+        self.assertEqual(self.index.search(u'', limit=2, offset=3), (4, [(4, u'Kenya')]))
+
+    def test_lazy_and_full_modals_are_cached_apart(self):
+        lazy_html = views.render_filter_modal('year', lazy=True)
+        full_html = views.render_filter_modal('year')
+        self.assertNotEqual(lazy_html, full_html)
+        self.assertIn('2013', full_html)
+        self.assertEqual(views.render_filter_modal('year', lazy=True), lazy_html)
+
+    def test_utf8_queries(self):
+        self.assertEqual(self.index.search('per\xc3\xba'), (1, [(2, u'Per\xfa Norte')]))
@@ -11,10 +11,13 @@ urlpatterns = patterns('',
     url(r'^logout$', 'django.contrib.auth.views.logout_then_login', {'login_url': 'login'}, name='logout'),
 
     url(r'^query/build$', views.query_build, name='query_build'),
+    url(r'^filter_options/(?P<filter_type>\w+)$', views.filter_options, name='filter_options'),
     url(r'^query/results$', views.query_results, name='query_results'),
     url(r'^query/commit_analysis$', views.commit_analysis, name='query_commit_analysis'),
+    url(r'^row_text/(?P<crs_pk>\d+)$', views.row_text, name='row_text'),
 
     url(r'^review_analysis$', views.review_analysis, name='review_analysis'),
+    url(r'^analysis_aggregates$', views.analysis_aggregates, name='analysis_aggregates'),
     url(r'^review_tj_dataset$', views.review_tj_dataset, name='review_tj_dataset'),
     url(r'^review_tj_dataset_results$', views.review_tj_dataset_results, name='review_tj_dataset_results'),
     url(r'^review_excluded$', views.review_excluded, name='review_excluded'),
@@ -24,4 +27,5 @@ urlpatterns = patterns('',
     url(r'^review_unincluded$', views.review_unincluded, name='review_unincluded'),
     url(r'^review_unincluded_results$', views.review_unincluded_results, name='review_unincluded_results'),
     url(r'^export_csv$', views.export_csv, name='export_csv'),
+    url(r'^cache_stats$', views.cache_stats, name='cache_stats'),
 )
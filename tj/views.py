@@ -1,12 +1,44 @@
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from tj.models import CODE_FILTER_TYPES
 import db_layer
+import filter_index
 import paginator
 
+import collections
 import json
 import datetime
+import hashlib
+import tempfile
+from wsgiref.util import FileWrapper
+
+DATA_VERSION_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+# the filters that aren't code tables, all short enough to render in full
+CUSTOM_FILTER_ROW_FUNCTIONS = {
+    'year': db_layer.get_years_as_filter_rows,
+    'inclusion': lambda: db_layer.get_all_inclusion_rows(as_filter=True),
+    'category': lambda: db_layer.get_all_category_rows(as_filter=True),
+}
+
+CUSTOM_FILTER_TYPES = ('inclusion', 'category')
+
+# export format name -> (content type, file extension), the first is the default
+EXPORT_FORMATS = collections.OrderedDict([
+    ('csv', ('text/csv', 'csv')),
+    ('csv.gz', ('application/gzip', 'csv.gz')),
+    ('npz', ('application/x-npz', 'npz')),
+])
+EXPORT_CONTENT_TYPE_ALIASES = {'application/x-gzip': 'csv.gz', 'application/octet-stream': 'npz'}
+EXPORT_FILE_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_FILTER_OPTION_LIMIT = 100
+MAX_FILTER_OPTION_LIMIT = 1000
 
 
 def index(request):
@@ -15,23 +47,91 @@ def index(request):
 def about(request):
     return render(request, 'tj/about.html')
 
+def get_filter_rows_function(filter_type):
+    """
+    Returns the function giving the code/name rows of a filter, or None if there is no such filter
+    """
+    if filter_type in CODE_FILTER_TYPES:
+        return lambda: db_layer.get_all_name_code_pairs(filter_type)
+
+    return CUSTOM_FILTER_ROW_FUNCTIONS.get(filter_type)
+
+
+def get_filter_option_index(filter_type):
+    return db_layer.code_table_cache.get(
+        ('filter_option_index', filter_type),
+        lambda: filter_index.FilterOptionIndex.from_filter_rows(get_filter_rows_function(filter_type)()))
+
+
+def render_filter_modal(filter_type, lazy=False):
+    """
+    Returns the HTML of one filter modal, rendered once per data version (the option lists only change on a rebuild).
+    Lazy modals start out empty and fetch their options from filter_options as they are opened and searched.
+    """
+    def render_modal():
+        context = {'filter_type': filter_type, 'lazy': lazy}
+        if not lazy:
+            context['filter_options'] = db_layer.get_name_pairs(get_filter_rows_function(filter_type)())
+        return render_to_string('tj/filter_modal.html', context)
+
+    return db_layer.code_table_cache.get(('filter_modal_html', filter_type, lazy), render_modal)
+
+
+def get_data_version_datetime():
+    data_version = db_layer.get_cached_data_version()
+    if data_version is None:
+        return None
+
+    for version_format in DATA_VERSION_FORMATS:
+        try:
+            return datetime.datetime.strptime(data_version, version_format)
+        except ValueError:
+            pass
+
+    return None
+
+
+def data_version_etag(request, *args, **kwargs):
+    """
+    The query builder pages (and filter options) only change with the data, apart from the csrf token they embed
+    """
+    data_version = db_layer.get_cached_data_version()
+    if data_version is None:
+        return None
+
+    return hashlib.md5('|'.join([request.get_full_path(), data_version, get_token(request)])).hexdigest()
+
+
+def data_version_last_modified(request, *args, **kwargs):
+    return get_data_version_datetime()
+
+
+def revalidated_with_data_version(view):
+    """
+    Decorates a view whose response only depends on the data, so that browsers keep the response but revalidate it
+    on every load, which only costs a 304 until the data changes
+    """
+    view = condition(etag_func=data_version_etag, last_modified_func=data_version_last_modified)(view)
+    return cache_control(private=True, max_age=0, must_revalidate=True)(view)
+
+
 # consider using a parameters object rather than a map to better manage this complexity?
 def construct_query_builder_context(title, results_view, parents):
     """
     Build the base context object for the query_builder template
     """
-    code_filter_map = {}
-    for filter_type in CODE_FILTER_TYPES:
-        code_filter_map[filter_type] = db_layer.get_all_name_code_pairs(filter_type)
+    # the code tables can have thousands of entries, so their options are only loaded on demand
+    filter_modals = [render_filter_modal('year')]
+    filter_modals += [render_filter_modal(filter_type, lazy=True) for filter_type in CODE_FILTER_TYPES]
 
     return {'title': title,
             'results_url': reverse(results_view),
             'parents': [(name, reverse(view)) for name, view in parents],
-            'year_filter_rows': db_layer.get_years_as_filter_rows(),
             # pass the types explicitly as list, as order is important
-            'code_filter_types': CODE_FILTER_TYPES, 'code_filter_map': code_filter_map}
+            'code_filter_types': CODE_FILTER_TYPES, 'filter_modals': filter_modals}
 
 
+@revalidated_with_data_version
 def query_build(request):
     context = construct_query_builder_context(
         title='Query Unanalyzed Data', results_view='query_results', parents=[('Home', 'home')])
@@ -40,37 +140,133 @@ def query_build(request):
 
 
 def show_results(request, page):
-    inclusions = db_layer.get_all_inclusion_rows()
-    categories = db_layer.get_all_category_rows()
+    inclusions = db_layer.get_inclusion_name_pairs()
+    categories = db_layer.get_category_name_pairs()
 
     return render(request, 'tj/query_results.html',
                   {'page': page, 'inclusions': inclusions, 'categories': categories})
 
 
+@revalidated_with_data_version
+def filter_options(request, filter_type):
+    """
+    Returns a page of the options of one filter as JSON, optionally only those whose name matches the q parameter
+    (anywhere in the name, or only at its start if match=prefix). limit and offset select the page.
+    """
+    if get_filter_rows_function(filter_type) is None:
+        raise Http404
+
+    query = request.GET.get('q', '')
+    match = request.GET.get('match', filter_index.SUBSTRING_MATCH)
+    if match not in filter_index.MATCH_TYPES:
+        return HttpResponseBadRequest('match must be one of ' + ', '.join(filter_index.MATCH_TYPES))
+
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_FILTER_OPTION_LIMIT)), 0), MAX_FILTER_OPTION_LIMIT)
+        offset = max(int(request.GET.get('offset', 0)), 0)
+    except ValueError:
+        return HttpResponseBadRequest('limit and offset must be integers')
+
+    total, options = get_filter_option_index(filter_type).search(query, match, limit, offset)
+
+    return HttpResponse(json.dumps({'filter_type': filter_type, 'total': total, 'offset': offset,
+                                    'options': [{'code': code, 'name': name} for code, name in options]}),
+                        content_type='application/json')
+
+
+def count_response(row_count, count_is_exact):
+    """
+    Answers a results request that only asked for (an exact) count of the matching rows
+    """
+    return HttpResponse(json.dumps({'count': row_count, 'is_exact': count_is_exact}), content_type='application/json')
+
+
+def apply_to_all_response(request, json_payload, update_rows):
+    """
+    Answers a results request asking to set the inclusion and/or category of every row matching the query,
+    update_rows is called with the tj_inclusion_id and tj_category_id (either may be None)
+    """
+    if not request.user.is_authenticated():
+        return HttpResponse('Unauthorized', status=401)
+
+    actions = json_payload['apply_to_all']
+    try:
+        row_count = update_rows(actions.get('inclusion'), actions.get('category'))
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest('inclusion and category must be the ids of existing ones')
+
+    return HttpResponse(json.dumps({'rows_updated': row_count}), content_type='application/json')
+
+
+def get_query_params_from_payload(json_payload, with_custom_filters=False):
+    """
+    Builds QueryParams from the JSON payload of a results request, with its custom (inclusion and category) filters
+    only if with_custom_filters. Raises ValueError if any filter type is unknown, or any code or year isn't an integer.
+    """
+    query = db_layer.QueryParams(json_payload['search_terms'])
+
+    filter_types = [(CODE_FILTER_TYPES, json_payload['code_filters'], query.add_code_filter)]
+    if with_custom_filters:
+        filter_types.append((CUSTOM_FILTER_TYPES, json_payload['custom_filters'], query.add_custom_column_filter))
+
+    for known_filter_types, filter_type_to_codes, add_filter in filter_types:
+        for filter_type, codes in filter_type_to_codes.iteritems():
+            if filter_type not in known_filter_types:
+                raise ValueError('unknown filter type ' + filter_type)
+            for code in codes:
+                add_filter(filter_type, int(code))
+
+    for year in json_payload['years']:
+        query.add_year_filter(str(int(year)))
+
+    return query
+
+
+def get_page_cursor_from_payload(json_payload):
+    """
+    Returns the page number, after_pk and before_pk of a results request's JSON payload as ints.
+    Keyset pagination: the cursor (if any) says which row the requested page comes after/before, either pk may be
+    None. Raises ValueError or TypeError if any of them isn't an integer.
+    """
+    page_number = int(json_payload.get('page_number') or 0)
+    after_pk, before_pk = [None if json_payload.get(name) is None else int(json_payload[name])
+                           for name in ('after_pk', 'before_pk')]
+    return page_number, after_pk, before_pk
+
+
 def query_results(request):
     payload = request.read()
     json_payload = json.loads(payload)
 
-    query = db_layer.QueryParams(json_payload['search_terms'])
+    try:
+        query = get_query_params_from_payload(json_payload)
+        page_number, after_pk, before_pk = get_page_cursor_from_payload(json_payload)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest('filter types must be known, and codes, years and page cursors integers')
 
-    for filter_type, codes in json_payload['code_filters'].iteritems():
-        for code in codes:
-            query.add_code_filter(filter_type, code)
+    if json_payload.get('count_only'):
+        return count_response(*db_layer.get_count_of_matching_rows_for_query(query, exact=True))
 
-    for year in json_payload['years']:
-        query.add_year_filter(year)
+    if json_payload.get('apply_to_all'):
+        return apply_to_all_response(request, json_payload, lambda inclusion_id, category_id:
+                                     db_layer.update_analysis_for_query(query, inclusion_id, category_id))
 
-    possible_row_count = db_layer.get_count_of_matching_rows_for_query(query)
-    result_rows = db_layer.get_matching_rows_for_query(query)
+    possible_row_count, count_is_exact = db_layer.get_count_of_matching_rows_for_query(query)
+    result_rows = db_layer.get_matching_rows_for_query(query, after_pk=after_pk, before_pk=before_pk)
 
-    pandas_paginator = paginator.PandasPaginator(result_rows, db_layer.ROW_LIMIT)
-    pandas_paginator.num_items = possible_row_count  # explicitly set this (a bit of a hack)
-    page = pandas_paginator.get_page(0)
-    page.has_next_page = False  # explicitly disable this
+    page = paginator.get_keyset_page(result_rows, page_number, db_layer.ROW_LIMIT, possible_row_count, count_is_exact)
 
     return show_results(request, page)
 
 
+def row_text(request, crs_pk):
+    full_text = db_layer.get_full_text(crs_pk)
+    if full_text is None:
+        raise Http404
+
+    return HttpResponse(json.dumps(full_text), content_type='application/json')
+
+
 def commit_analysis(request):
     if not request.user.is_authenticated():
         return HttpResponse('Unauthorized', status=401)
@@ -78,32 +274,136 @@ def commit_analysis(request):
     payload = request.read()
     json_payload = json.loads(payload)
 
-    db_layer.update_inclusions(json_payload['inclusionActions'])
-    db_layer.update_categories(json_payload['categoryActions'])
+    try:
+        row_count = db_layer.update_analysis(json_payload['inclusionActions'], json_payload['categoryActions'])
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest('rows must be crs_pks, and inclusions and categories the ids of existing ones')
+
+    return HttpResponse(json.dumps({'rows_updated': row_count}), content_type='application/json')
+
+
+def get_query_params_from_request_args(args):
+    """
+    Builds QueryParams from GET arguments: q for the search terms, and any number of year, inclusion, category and
+    code filter type (e.g. recipient) arguments. Raises ValueError if any of the codes isn't an integer.
+    """
+    query = db_layer.QueryParams(args.get('q'))
+
+    for filter_type in CODE_FILTER_TYPES:
+        for code in args.getlist(filter_type):
+            query.add_code_filter(filter_type, int(code))
+
+    for filter_type in CUSTOM_FILTER_TYPES:
+        for code in args.getlist(filter_type):
+            query.add_custom_column_filter(filter_type, int(code))
+
+    for year in args.getlist('year'):
+        query.add_year_filter(str(int(year)))
+
+    return query
 
-    return HttpResponse('OK')
+
+def get_export_format(request):
+    """
+    Picks an export format from the format argument if there is one, otherwise from the Accept header
+    (the first content type in it that we can produce), defaulting to plain CSV
+    """
+    if 'format' in request.GET:
+        return request.GET['format'] if request.GET['format'] in EXPORT_FORMATS else None
+
+    for accepted_type in request.META.get('HTTP_ACCEPT', '').split(','):
+        accepted_type = accepted_type.split(';')[0].strip()
+        for export_format, (content_type, extension) in EXPORT_FORMATS.iteritems():
+            if accepted_type == content_type:
+                return export_format
+        if accepted_type in EXPORT_CONTENT_TYPE_ALIASES:
+            return EXPORT_CONTENT_TYPE_ALIASES[accepted_type]
+
+    return EXPORT_FORMATS.keys()[0]
 
 
 def export_csv(request):
-    dataframe = db_layer.get_tj_dataset_rows()
-    csv_text = db_layer.convert_to_csv_string_for_export(dataframe)
+    """
+    Exports the TJ dataset, optionally filtered like the review pages (see get_query_params_from_request_args),
+    as CSV, gzipped CSV or the typed columnar format of tj.columnar_export (see get_export_format).
+    The CSV formats are streamed as they are read; the columnar one has to be assembled before it can be sent.
+    """
+    try:
+        query = get_query_params_from_request_args(request.GET)
+    except ValueError:
+        return HttpResponseBadRequest('filter codes and years must be integers')
+
+    export_format = get_export_format(request)
+    if export_format is None:
+        return HttpResponseBadRequest('format must be one of ' + ', '.join(EXPORT_FORMATS))
+    content_type, extension = EXPORT_FORMATS[export_format]
+
+    if export_format == 'csv':
+        response = StreamingHttpResponse(db_layer.iter_csv_export(query), content_type=content_type)
+    elif export_format == 'csv.gz':
+        response = StreamingHttpResponse(db_layer.iter_gzipped(db_layer.iter_csv_export(query)),
+                                         content_type=content_type)
+    else:
+        export_file = tempfile.TemporaryFile()
+        db_layer.write_columnar_export(export_file, query)
+        export_size = export_file.tell()
+        export_file.seek(0)
+
+        response = StreamingHttpResponse(FileWrapper(export_file, EXPORT_FILE_CHUNK_SIZE), content_type=content_type)
+        response['Content-Length'] = str(export_size)
 
     timestamp_string = datetime.datetime.utcnow().isoformat()
-
-    response = HttpResponse(csv_text, content_type="text/csv")
-    response['Content-Disposition'] = 'attachment; filename="CRS_TJ_{timestamp}.csv"'.format(timestamp=timestamp_string)
+    response['Content-Disposition'] = 'attachment; filename="CRS_TJ_{timestamp}.{extension}"'.format(
+        timestamp=timestamp_string, extension=extension)
+    response['Vary'] = 'Accept'
 
     return response
 
 
-def review_analysis(request):
-    # TODO a data table with marginals... maybe use pandas crosstab?
-    # Count by inclusion, category
-    # USD disbursed defl by inclusion, category
+def cache_stats(request):
+    if not request.user.is_staff:
+        return HttpResponse('Forbidden', status=403)
+
+    return HttpResponse(json.dumps({'code_tables': db_layer.get_code_table_cache_stats(),
+                                    'counts': db_layer.get_count_cache_stats(),
+                                    'results': db_layer.get_page_cache_stats()}),
+                        content_type='application/json')
+
 
-    # TODO also include nulls in this categorization?
+def analysis_aggregates(request):
+    return HttpResponse(json.dumps(db_layer.get_analysis_aggregates()), content_type='application/json')
 
-    return render(request, 'tj/review_analysis.html', {})
+
+def get_crosstab(aggregates):
+    """
+    Lays out the inclusion/category breakdowns as a table: returns the category names (for the header, followed by
+    a total) and a list of (inclusion name, cells) rows ending with a totals row, each cell being an aggregate row
+    (with count and usd_disbursement_defl) or None
+    """
+    breakdowns = dict((tuple(breakdown['dimensions']), breakdown['rows']) for breakdown in aggregates)
+
+    cells = dict(((row['inclusion'], row['category']), row) for row in breakdowns[('inclusion', 'category')])
+    inclusion_totals = breakdowns[('inclusion',)]
+    category_totals = breakdowns[('category',)]
+    grand_totals = breakdowns[()]
+
+    categories = [row['category'] for row in category_totals]
+
+    rows = []
+    for inclusion_total in inclusion_totals:
+        row_cells = [cells.get((inclusion_total['inclusion'], category)) for category in categories]
+        rows.append((inclusion_total['inclusion_name'], row_cells + [inclusion_total]))
+
+    rows.append(('Total', category_totals + grand_totals))
+
+    return [row['category_name'] for row in category_totals], rows
+
+
+def review_analysis(request):
+    category_names, crosstab_rows = get_crosstab(db_layer.get_analysis_aggregates())
+
+    return render(request, 'tj/review_analysis.html',
+                  {'category_names': category_names, 'crosstab_rows': crosstab_rows})
 
 
 def show_review(request, title, results_view):
@@ -112,70 +412,70 @@ def show_review(request, title, results_view):
 
     context['submit_on_load'] = True
 
-    context['custom_filter_types'] = ('inclusion', 'category')
+    context['custom_filter_types'] = CUSTOM_FILTER_TYPES
 
-    context['custom_filter_map'] = {
-        'inclusion': db_layer.get_all_inclusion_rows(as_filter=True),
-        'category': db_layer.get_all_category_rows(as_filter=True)
-    }
+    context['filter_modals'] += [render_filter_modal(filter_type) for filter_type in context['custom_filter_types']]
 
     return render(request, 'tj/query_builder.html', context)
 
 
+@revalidated_with_data_version
 def review_tj_dataset(request):
     return show_review(request, title='Review TJ Dataset', results_view='review_tj_dataset_results')
 
 
+@revalidated_with_data_version
 def review_excluded(request):
     return show_review(request, title='Review Excluded Results', results_view='review_excluded_results')
 
 
+@revalidated_with_data_version
 def review_uncategorized(request):
     return show_review(request, title='Review Uncategorized Results', results_view='review_uncategorized_results')
 
 
+@revalidated_with_data_version
 def review_unincluded(request):
     return show_review(request, title='Review Unincluded Results', results_view='review_unincluded_results')
 
 
-def review_results(request, results_function):
+def review_results(request, analyzed_condition):
     payload = request.read()
     json_payload = json.loads(payload)
 
-    query = db_layer.QueryParams(json_payload['search_terms'])
-
-    for filter_type, codes in json_payload['code_filters'].iteritems():
-        for code in codes:
-            query.add_code_filter(filter_type, code)
-
-    for filter_type, codes in json_payload['custom_filters'].iteritems():
-        for code in codes:
-            query.add_custom_column_filter(filter_type, code)
+    try:
+        query = get_query_params_from_payload(json_payload, with_custom_filters=True)
+        page_number, after_pk, before_pk = get_page_cursor_from_payload(json_payload)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest('filter types must be known, and codes, years and page cursors integers')
 
-    for year in json_payload['years']:
-        query.add_year_filter(year)
+    if json_payload.get('count_only'):
+        return count_response(*db_layer.get_count_of_analyzed_rows(query, analyzed_condition, exact=True))
 
-    results = results_function(query)
+    if json_payload.get('apply_to_all'):
+        return apply_to_all_response(request, json_payload, lambda inclusion_id, category_id:
+                                     db_layer.update_analysis_for_analyzed_rows(query, analyzed_condition,
+                                                                                inclusion_id, category_id))
 
-    pandas_paginator = paginator.PandasPaginator(results, db_layer.ROW_LIMIT)
+    row_count, count_is_exact = db_layer.get_count_of_analyzed_rows(query, analyzed_condition)
+    result_rows = db_layer.get_page_of_analyzed_rows(query, analyzed_condition, after_pk=after_pk, before_pk=before_pk)
 
-    page_number = int(json_payload['page_number'])
-    page = pandas_paginator.get_page(page_number)
+    page = paginator.get_keyset_page(result_rows, page_number, db_layer.ROW_LIMIT, row_count, count_is_exact)
 
     return show_results(request, page)
 
 
 def review_tj_dataset_results(request):
-    return review_results(request, db_layer.get_tj_dataset_rows)
+    return review_results(request, db_layer.TJ_DATASET_CONDITION)
 
 
 def review_excluded_results(request):
-    return review_results(request, db_layer.get_excluded_rows)
+    return review_results(request, db_layer.EXCLUDED_CONDITION)
 
 
 def review_uncategorized_results(request):
-    return review_results(request, db_layer.get_included_but_uncategorized_rows)
+    return review_results(request, db_layer.INCLUDED_BUT_UNCATEGORIZED_CONDITION)
 
 
 def review_unincluded_results(request):
-    return review_results(request, db_layer.get_categorized_but_no_inclusion_decision_rows)
+    return review_results(request, db_layer.CATEGORIZED_BUT_NO_INCLUSION_DECISION_CONDITION)